@@ -2,35 +2,159 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import collections
+import errno
+import gzip
+import hashlib
+import itertools
+import json
 import os
 import posixpath
 import re
+import select
 import shutil
+import socket
+import stat
+import struct
 import subprocess
+import tarfile
 import tempfile
+import threading
 import time
 import traceback
+import uuid
+import zlib
 
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 from distutils import dir_util
 
 
+def _stdout_file(spool_size):
+    """Returns the file object used to hold a command's stdout. If
+    spool_size is set, the output is held in memory until it exceeds
+    spool_size bytes, at which point it is spilled to a temporary
+    file."""
+    if spool_size:
+        return tempfile.SpooledTemporaryFile(max_size=spool_size)
+    return tempfile.TemporaryFile()
+
+
 class ADBProcess(object):
     """ADBProcess encapsulates the data related to executing the adb process."""
 
-    def __init__(self, args):
+    def __init__(self, args, spool_size=None):
         #: command argument argument list.
         self.args = args
-        #: Temporary file handle to be used for stdout.
-        self.stdout_file = tempfile.TemporaryFile()
+        #: File handle to be used for stdout. If spool_size is set,
+        #: stdout is read through a pipe into memory and is only
+        #: written to a temporary file once it exceeds spool_size
+        #: bytes. Otherwise adb writes directly to a temporary file.
+        self.stdout_file = _stdout_file(spool_size)
         #: boolean indicating if the command timed out.
         self.timedout = None
         #: exitcode of the process.
         self.exitcode = None
-        #: subprocess Process object used to execute the command.
-        self.proc = subprocess.Popen(args,
-                                     stdout=self.stdout_file,
-                                     stderr=subprocess.STDOUT)
+        # The child inherits the write end of the exit pipe. When the
+        # child exits, the pipe is closed and the read end becomes
+        # readable which allows wait() to return immediately rather
+        # than at the next polling interval.
+        exit_fd, child_fd = os.pipe()
+        try:
+            #: subprocess Process object used to execute the command.
+            self.proc = subprocess.Popen(
+                args,
+                stdout=subprocess.PIPE if spool_size else self.stdout_file,
+                stderr=subprocess.STDOUT)
+        except:
+            os.close(exit_fd)
+            raise
+        finally:
+            os.close(child_fd)
+        self._exit_fd = exit_fd
+        self._stdout_fd = self.proc.stdout.fileno() if spool_size else None
+
+    def _drain_stdout(self, block=False):
+        """Copy the available output from the stdout pipe into
+        stdout_file. If block is False, return once the pipe is
+        empty, otherwise return after a single read."""
+        while self._stdout_fd is not None:
+            if not block and not select.select([self._stdout_fd],
+                                               [], [], 0)[0]:
+                return
+            data = os.read(self._stdout_fd, 65536)
+            if not data:
+                self.proc.stdout.close()
+                self._stdout_fd = None
+                return
+            self.stdout_file.seek(0, os.SEEK_END)
+            self.stdout_file.write(data)
+            if block:
+                return
+
+    def _close_exit_fd(self):
+        if self._exit_fd is not None:
+            os.close(self._exit_fd)
+            self._exit_fd = None
+
+    def wait(self, timeout, polling_interval=0.1, use_exit_pipe=True):
+        """Wait for the process to exit.
+
+        :param timeout: The maximum time in seconds to wait.
+        :param polling_interval: The maximum time in seconds between
+            checks of the process' status.
+        :param bool use_exit_pipe: If True, return as soon as the
+            process exits. Otherwise sleep polling_interval seconds
+            between checks of the process' status.
+        :returns: the exitcode of the process or None if the process
+            did not exit within timeout seconds. The process is not
+            killed.
+
+        The exit pipe can be held open by a grandchild of the process,
+        for example when adb starts the adb server, so the process'
+        status is still checked every polling_interval seconds.
+        """
+        start_time = time.time()
+        exitcode = self.proc.poll()
+        while exitcode is None:
+            remaining = timeout - (time.time() - start_time)
+            if remaining < 0:
+                break
+            fds = []
+            if self._stdout_fd is not None:
+                fds.append(self._stdout_fd)
+            if use_exit_pipe and self._exit_fd is not None:
+                fds.append(self._exit_fd)
+            if fds:
+                try:
+                    readable = select.select(fds, [], [],
+                                             min(remaining, polling_interval))[0]
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+                if self._stdout_fd in readable:
+                    self._drain_stdout(block=True)
+                if self._exit_fd is not None and self._exit_fd in readable:
+                    # The process may have closed its inherited fds
+                    # without exiting, so keep polling its status
+                    # against the timeout rather than blocking.
+                    self._close_exit_fd()
+            else:
+                time.sleep(polling_interval)
+            exitcode = self.proc.poll()
+        if exitcode is not None:
+            self._close_exit_fd()
+            self._drain_stdout()
+        return exitcode
+
+    def kill(self):
+        """Kill the process and return its exitcode."""
+        self.proc.kill()
+        self._close_exit_fd()
+        exitcode = self.proc.wait()
+        self._drain_stdout()
+        return exitcode
 
     @property
     def stdout(self):
@@ -102,6 +226,717 @@ class ADBTimeoutError(Exception):
     pass
 
 
+class ADBServerProcess(ADBProcess):
+    """ADBServerProcess encapsulates the data related to executing a
+    command over a socket connected to the adb server. It provides the
+    same interface as ADBProcess but does not spawn an adb process."""
+
+    def __init__(self, args, spool_size=None):
+        #: command argument list.
+        self.args = args
+        #: File handle to be used for stdout.
+        self.stdout_file = _stdout_file(spool_size)
+        #: boolean indicating if the command timed out.
+        self.timedout = None
+        #: exitcode of the command.
+        self.exitcode = None
+        #: There is no subprocess when talking to the adb server.
+        self.proc = None
+        self._exit_fd = None
+        self._stdout_fd = None
+
+
+class ADBServerClient(object):
+    """ADBServerClient implements the client side of the adb server
+    wire protocol which the adb executable uses to talk to the adb
+    server listening on port 5037. It is used by ADBDevice to execute
+    shell commands, query the device state and transfer files without
+    forking an adb process for each call.
+
+    Each request is sent as a 4 digit hex length followed by the
+    request. The server responds with OKAY or with FAIL followed by a
+    4 digit hex length and an error message. Once a connection has
+    been switched to a device via host:transport:<serial> it is
+    consumed by the next service request, so shell commands require a
+    new connection each time. The sync: service however can transfer
+    any number of files over a single connection which push_files and
+    pull_files take advantage of.
+
+    ::
+
+       client = ADBServerClient()
+       adb_process = client.shell('0123456789ABCDEF', 'id; echo rc=$?')
+    """
+
+    SYNC_DATA_MAX = 64 * 1024
+
+    def __init__(self, host=None, port=None, timeout=300, spool_size=None):
+        """Initializes the ADBServerClient object.
+
+        :param host: host of the adb server. Defaults to 127.0.0.1.
+        :type host: str or None
+        :param port: port of the adb server. Defaults to 5037.
+        :type port: integer or None
+        :param integer timeout: default timeout in seconds for
+            requests to the adb server.
+        :param spool_size: number of bytes of shell output to hold in
+            memory before spilling to a temporary file. If None,
+            output is always written to a temporary file.
+        :type spool_size: integer or None
+        """
+        self._host = host or '127.0.0.1'
+        self._port = port or 5037
+        self._timeout = timeout
+        self._spool_size = spool_size
+
+    def _connect(self, timeout):
+        try:
+            sock = socket.create_connection((self._host, self._port),
+                                            timeout=timeout)
+        except socket.timeout:
+            raise ADBTimeoutError('Timed out connecting to adb server %s:%s' %
+                                  (self._host, self._port))
+        except socket.error as e:
+            raise ADBError('Unable to connect to adb server %s:%s: %s' %
+                           (self._host, self._port, e))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    @staticmethod
+    def _recv_exactly(sock, length):
+        data = ''
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                raise ADBError('adb server closed connection after %d of %d '
+                               'bytes' % (len(data), length))
+            data += chunk
+        return data
+
+    def _request(self, sock, request):
+        """Send a host request and raise ADBError if the server does not
+        respond with OKAY."""
+        sock.sendall('%04x%s' % (len(request), request))
+        status = self._recv_exactly(sock, 4)
+        if status == 'OKAY':
+            return
+        if status == 'FAIL':
+            length = int(self._recv_exactly(sock, 4), 16)
+            raise ADBError('%s: %s' % (request,
+                                       self._recv_exactly(sock, length)))
+        raise ADBError('%s: unexpected adb server response %r' % (request,
+                                                                  status))
+
+    def _read_string(self, sock):
+        length = int(self._recv_exactly(sock, 4), 16)
+        return self._recv_exactly(sock, length)
+
+    def _transport(self, device_serial, timeout):
+        """Return a socket connected to the device's transport."""
+        sock = self._connect(timeout)
+        try:
+            if device_serial:
+                self._request(sock, 'host:transport:%s' % device_serial)
+            else:
+                self._request(sock, 'host:transport-any')
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def version(self, timeout=None):
+        """Returns the integer version of the adb server."""
+        if timeout is None:
+            timeout = self._timeout
+        sock = self._connect(timeout)
+        try:
+            self._request(sock, 'host:version')
+            return int(self._read_string(sock), 16)
+        finally:
+            sock.close()
+
+    def get_state(self, device_serial, timeout=None):
+        """Returns the device's state as reported by the adb server."""
+        if timeout is None:
+            timeout = self._timeout
+        if device_serial:
+            request = 'host-serial:%s:get-state' % device_serial
+        else:
+            request = 'host:get-state'
+        sock = self._connect(timeout)
+        try:
+            try:
+                self._request(sock, request)
+                return self._read_string(sock)
+            except socket.timeout:
+                raise ADBTimeoutError('%s timed out' % request)
+        finally:
+            sock.close()
+
+    def shell(self, device_serial, cmd, timeout=None):
+        """Executes a shell command on the device via the shell: service.
+
+        :param device_serial: serial number of the device or None to
+            use the only attached device.
+        :param str cmd: The command to be executed.
+        :param timeout: The maximum time in seconds to wait for the
+            command to complete.
+        :type timeout: integer or None
+        :returns: :class:`ADBServerProcess`
+
+        The output of the command is written to the stdout_file of
+        the returned ADBServerProcess. If the adb server refuses the
+        request, the error is written to stdout_file and exitcode is
+        set to 1 as the adb executable would have done. If the command
+        does not complete within timeout seconds, timedout is set.
+        """
+        if timeout is None:
+            timeout = self._timeout
+        adb_process = ADBServerProcess(['shell:%s' % cmd],
+                                       spool_size=self._spool_size)
+        deadline = time.time() + timeout
+        sock = None
+        try:
+            try:
+                sock = self._transport(device_serial, timeout)
+                self._request(sock, 'shell:%s' % cmd)
+                while True:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout()
+                    sock.settimeout(remaining)
+                    data = sock.recv(self.SYNC_DATA_MAX)
+                    if not data:
+                        break
+                    adb_process.stdout_file.write(data)
+                adb_process.exitcode = 0
+            except (socket.timeout, ADBTimeoutError):
+                adb_process.timedout = True
+            except (socket.error, ADBError) as e:
+                adb_process.stdout_file.write('error: %s\n' % e)
+                adb_process.exitcode = 1
+        finally:
+            if sock:
+                sock.close()
+        adb_process.stdout_file.seek(0, os.SEEK_SET)
+        return adb_process
+
+    def _sync_request(self, sock, sync_id, data):
+        sock.sendall(sync_id + struct.pack('<I', len(data)) + data)
+
+    def _sync_response(self, sock):
+        header = self._recv_exactly(sock, 8)
+        sync_id = header[:4]
+        length = struct.unpack('<I', header[4:])[0]
+        return sync_id, length
+
+    def _sync_send(self, sock, local, remote):
+        mode = stat.S_IMODE(os.stat(local).st_mode) | stat.S_IFREG
+        self._sync_request(sock, 'SEND', '%s,%d' % (remote, mode))
+        with open(local, 'rb') as local_file:
+            while True:
+                data = local_file.read(self.SYNC_DATA_MAX)
+                if not data:
+                    break
+                self._sync_request(sock, 'DATA', data)
+        sock.sendall('DONE' + struct.pack('<I', int(os.path.getmtime(local))))
+        sync_id, length = self._sync_response(sock)
+        if sync_id == 'FAIL':
+            raise ADBError('push %s %s: %s' % (
+                local, remote, self._recv_exactly(sock, length)))
+        if sync_id != 'OKAY':
+            raise ADBError('push %s %s: unexpected sync response %r' % (
+                local, remote, sync_id))
+
+    def _sync_recv(self, sock, remote, local):
+        self._sync_request(sock, 'RECV', remote)
+        with open(local, 'wb') as local_file:
+            while True:
+                sync_id, length = self._sync_response(sock)
+                if sync_id == 'DATA':
+                    local_file.write(self._recv_exactly(sock, length))
+                elif sync_id == 'DONE':
+                    break
+                elif sync_id == 'FAIL':
+                    raise ADBError('pull %s %s: %s' % (
+                        remote, local, self._recv_exactly(sock, length)))
+                else:
+                    raise ADBError('pull %s %s: unexpected sync response %r' %
+                                   (remote, local, sync_id))
+
+    def stat(self, device_serial, remote, timeout=None):
+        """Returns a (mode, size, mtime) tuple for the remote path using
+        the sync: STAT request. mode is 0 if the path does not exist.
+        """
+        result = []
+
+        def _stat(sock, remote, unused):
+            self._sync_request(sock, 'STAT', remote)
+            header = self._recv_exactly(sock, 16)
+            if header[:4] != 'STAT':
+                raise ADBError('stat %s: unexpected sync response %r' % (
+                    remote, header[:4]))
+            result.append(struct.unpack('<III', header[4:]))
+
+        self._sync(device_serial, _stat, [(remote, None)], timeout)
+        return result[0]
+
+    def _sync(self, device_serial, transfer, pairs, timeout):
+        if timeout is None:
+            timeout = self._timeout
+        sock = self._transport(device_serial, timeout)
+        try:
+            try:
+                self._request(sock, 'sync:')
+                for source, destination in pairs:
+                    transfer(sock, source, destination)
+                self._sync_request(sock, 'QUIT', '')
+            except socket.timeout:
+                raise ADBTimeoutError('sync timed out transferring %s' % pairs)
+            except socket.error as e:
+                raise ADBError('sync failed transferring %s: %s' % (pairs, e))
+        finally:
+            sock.close()
+
+    def push_files(self, device_serial, pairs, timeout=None):
+        """Pushes files to the device over a single sync connection.
+
+        :param device_serial: serial number of the device or None.
+        :param list pairs: list of (local, remote) file name tuples.
+        :param timeout: The maximum time in seconds for any socket
+            operation to complete.
+        :type timeout: integer or None
+        :raises: * ADBTimeoutError
+                 * ADBError
+        """
+        self._sync(device_serial, self._sync_send, pairs, timeout)
+
+    def pull_files(self, device_serial, pairs, timeout=None):
+        """Pulls files from the device over a single sync connection.
+
+        :param device_serial: serial number of the device or None.
+        :param list pairs: list of (remote, local) file name tuples.
+        :param timeout: The maximum time in seconds for any socket
+            operation to complete.
+        :type timeout: integer or None
+        :raises: * ADBTimeoutError
+                 * ADBError
+        """
+        self._sync(device_serial, self._sync_recv, pairs, timeout)
+
+
+class ADBShellSessionProcess(ADBServerProcess):
+    """ADBShellSessionProcess encapsulates the data related to executing
+    a command in a persistent adb shell session. It provides the same
+    interface as ADBProcess but does not spawn an adb process."""
+    pass
+
+
+class ADBShellSession(object):
+    """ADBShellSession holds open a single interactive adb shell on a
+    device to which commands are written on stdin. Each command's
+    output is framed by unique sentinel lines, the last of which
+    carries the command's exit code. This avoids the cost of starting
+    a new adb process and device shell for each command.
+
+    Each command is run in a subshell with stdin redirected from
+    /dev/null so that it can neither change the session's state nor
+    consume the commands which follow it.
+
+    ::
+
+       session = ADBShellSession(['adb', '-s', serial, 'shell'])
+       exitcode, output = session.run('ps', timeout=60)
+       session.close()
+    """
+
+    def __init__(self, args, su_cmd=None, timeout=60):
+        """Initializes the ADBShellSession object and starts the shell.
+
+        :param list args: the adb command line used to start an
+            interactive shell.
+        :param su_cmd: command written to the shell to switch to a
+            root shell, e.g. 'su 0 sh', or None for an unprivileged
+            session.
+        :type su_cmd: str or None
+        :param integer timeout: the maximum time in seconds to wait
+            for the shell to start.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+        """
+        self._args = args
+        self._su_cmd = su_cmd
+        self._token = 'autophone-session-%s' % uuid.uuid4().hex
+        self._count = 0
+        self._proc = None
+        self._buffer = ''
+        self.start(timeout)
+
+    @property
+    def alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self, timeout):
+        """Start or restart the adb shell."""
+        self.close()
+        try:
+            self._proc = subprocess.Popen(self._args,
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise ADBError('Unable to start shell session %s: %s' %
+                           (self._args, e))
+        self._buffer = ''
+        try:
+            if self._su_cmd:
+                self._write('%s\n' % self._su_cmd)
+                exitcode, output = self.run('id', timeout=timeout)
+                if exitcode is None or 'uid=0' not in output:
+                    raise ADBRootError('Shell session %s is not root: %s' %
+                                       (self._su_cmd, output))
+            else:
+                exitcode, output = self.run('true', timeout=timeout)
+            if exitcode is None:
+                raise ADBTimeoutError('Timed out starting shell session %s' %
+                                      self._args)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self._proc is None:
+            return
+        if self._proc.poll() is None:
+            try:
+                self._proc.stdin.write('exit\n')
+                if self._su_cmd:
+                    self._proc.stdin.write('exit\n')
+                self._proc.stdin.close()
+            except IOError:
+                pass
+            self._proc.kill()
+        self._proc.wait()
+        self._proc.stdout.close()
+        self._proc = None
+
+    def _write(self, data):
+        try:
+            self._proc.stdin.write(data)
+            self._proc.stdin.flush()
+        except IOError as e:
+            self.close()
+            raise ADBError('Shell session %s lost: %s' % (self._args, e))
+
+    def _readline(self, deadline):
+        """Returns the next line of output without its line ending or
+        None if the deadline passes. Raises ADBError if the shell
+        exits."""
+        fd = self._proc.stdout.fileno()
+        while '\n' not in self._buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            try:
+                readable = select.select([fd], [], [], remaining)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if not readable:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                self.close()
+                raise ADBError('Shell session %s exited' % self._args)
+            self._buffer += data
+        line, _, self._buffer = self._buffer.partition('\n')
+        return line.rstrip('\r')
+
+    def run(self, cmd, timeout):
+        """Runs cmd in the session.
+
+        :param str cmd: The command to be executed.
+        :param integer timeout: The maximum time in seconds to wait for
+            the command to complete.
+        :returns: tuple (exitcode, output). exitcode is None if the
+            command timed out in which case the session is closed.
+        :raises: ADBError if the session exited.
+        """
+        self._count += 1
+        begin = '%s:%d' % (self._token, self._count)
+        re_end = re.compile('(.*)%s:(\d+)$' % re.escape(begin))
+        self._write('echo %s; ( %s ) </dev/null 2>&1; echo %s:$?\n' % (
+            begin, cmd, begin))
+        deadline = time.time() + timeout
+        output = None
+        while True:
+            line = self._readline(deadline)
+            if line is None:
+                self.close()
+                return None, '\n'.join(output or [])
+            if output is None:
+                if line == begin:
+                    output = []
+                continue
+            match = re_end.match(line)
+            if match:
+                if match.group(1):
+                    output.append(match.group(1))
+                return int(match.group(2)), '\n'.join(output)
+            output.append(line)
+
+
+class ADBLogcatFollower(object):
+    """ADBLogcatFollower runs a single long lived adb logcat process
+    for a device in a background thread and keeps its most recent
+    output in a bounded ring buffer.
+
+    Each line is assigned a monotonically increasing sequence number
+    so that readers can keep a cursor into the buffer and retrieve
+    only the lines they have not yet seen without dumping and
+    comparing the device's logcat buffer. If the adb process exits,
+    for example when the device reboots, it is restarted and the lines
+    of the restarted process' initial dump which are still in the
+    ring buffer are skipped.
+
+    ::
+
+       follower = ADBLogcatFollower(['adb', '-s', serial, 'logcat', '-v', 'time'])
+       follower.start()
+       lines, cursor = follower.get_lines(0)
+       ...
+       lines, cursor = follower.get_lines(cursor)
+       follower.stop()
+    """
+
+    def __init__(self, args, max_lines=100000, restart_wait=1, logger=None):
+        """Initializes the ADBLogcatFollower object.
+
+        :param list args: the adb logcat command line.
+        :param integer max_lines: the maximum number of lines kept in
+            the ring buffer.
+        :param restart_wait: the time in seconds to wait before
+            restarting the adb process after it exits.
+        :param logger: optional logger.
+        """
+        self._args = args
+        self._lines = collections.deque(maxlen=max_lines)
+        self._next_sequence = 0
+        self._restart_wait = restart_wait
+        self._logger = logger
+        self._lock = threading.Condition()
+        self._proc = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def sequence(self):
+        """The sequence number which will be assigned to the next line."""
+        with self._lock:
+            return self._next_sequence
+
+    @property
+    def alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.alive:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='ADBLogcatFollower')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        proc = self._proc
+        if proc and proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        if self._thread:
+            self._thread.join(10)
+            self._thread = None
+
+    def _run(self):
+        restarted = False
+        while not self._stopped.is_set():
+            try:
+                self._proc = subprocess.Popen(self._args,
+                                              stdout=subprocess.PIPE,
+                                              stderr=subprocess.STDOUT)
+            except OSError as e:
+                if self._logger:
+                    self._logger.warning('Unable to start %s: %s' %
+                                         (self._args, e))
+                self._stopped.wait(self._restart_wait)
+                continue
+            seen = None
+            if restarted:
+                # The restarted process dumps the device's logcat
+                # buffer before following it. Skip its lines until the
+                # first one which has not already been seen.
+                with self._lock:
+                    seen = set(self._lines)
+            for line in iter(self._proc.stdout.readline, ''):
+                line = line.rstrip('\r\n')
+                if seen is not None:
+                    if line in seen:
+                        continue
+                    seen = None
+                with self._lock:
+                    self._lines.append(line)
+                    self._next_sequence += 1
+                    self._lock.notify_all()
+            self._proc.wait()
+            self._proc.stdout.close()
+            restarted = True
+            if not self._stopped.is_set():
+                if self._logger:
+                    self._logger.debug('%s exited with %s, restarting' %
+                                       (self._args, self._proc.returncode))
+                self._stopped.wait(self._restart_wait)
+
+    def wait_for_lines(self, sequence, timeout):
+        """Waits until a line with a sequence number of at least
+        sequence is available or timeout seconds have passed.
+
+        :returns: True if the line is available.
+        """
+        with self._lock:
+            if self._next_sequence <= sequence:
+                self._lock.wait(timeout)
+            return self._next_sequence > sequence
+
+    def get_lines(self, sequence):
+        """Returns the lines with sequence numbers of at least sequence.
+
+        :param integer sequence: the sequence number of the first line
+            to return, usually the cursor returned by the previous
+            call.
+        :returns: tuple (lines, cursor) where cursor is the sequence
+            number of the line following the last returned line. If
+            lines have been dropped from the ring buffer before they
+            were read, the oldest lines still available are returned.
+        """
+        with self._lock:
+            first_sequence = self._next_sequence - len(self._lines)
+            if sequence < first_sequence:
+                if self._logger:
+                    self._logger.warning(
+                        'ADBLogcatFollower: %d lines were dropped before '
+                        'they were read' % (first_sequence - sequence))
+                sequence = first_sequence
+            lines = list(itertools.islice(self._lines,
+                                          sequence - first_sequence, None))
+            return lines, self._next_sequence
+
+
+class ADBPropertyCache(object):
+    """ADBPropertyCache holds values such as read only properties and
+    detected capabilities which are expensive to query from a device
+    but do not change while the device is running.
+
+    Values are retrieved with get(key, value_type, loader) where loader
+    is called to query the device when the key is not cached or the
+    cached value is not of value_type. If path is set, the cache is
+    loaded from and saved to that file as json so that the values
+    survive restarts of the process.
+
+    ::
+
+       cache = ADBPropertyCache('/tmp/0123456789ABCDEF.json')
+       model = cache.get('prop:ro.product.model', str,
+                         lambda: adbdevice.shell_output('getprop ro.product.model'))
+    """
+
+    def __init__(self, path=None, logger=None):
+        self._path = path
+        self._logger = logger
+        self._values = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as cache_file:
+                    self._values = json.load(cache_file)
+            except (IOError, ValueError) as e:
+                if logger:
+                    logger.warning('Ignoring property cache %s: %s' % (path, e))
+
+    @staticmethod
+    def _coerce(value, value_type):
+        # json returns unicode rather than str.
+        if value_type is str and isinstance(value, unicode):
+            return str(value)
+        if value_type is bool and not isinstance(value, bool):
+            return None
+        if value_type is int and (isinstance(value, bool) or
+                                  not isinstance(value, (int, long))):
+            return None
+        if isinstance(value, value_type):
+            return value
+        return None
+
+    def get(self, key, value_type, loader):
+        """Returns the cached value for key, calling loader to obtain
+        and cache it if it is not already cached.
+
+        :param str key: name of the cached value.
+        :param type value_type: the type of the value, one of str,
+            bool or int.
+        :param loader: callable returning the value.
+        """
+        if key in self._values:
+            value = self._coerce(self._values[key], value_type)
+            if value is not None:
+                return value
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def peek(self, key, value_type):
+        """Returns the cached value for key or None if it is not cached."""
+        if key not in self._values:
+            return None
+        return self._coerce(self._values[key], value_type)
+
+    def set(self, key, value):
+        if key in self._values and self._values[key] == value:
+            return
+        self._values[key] = value
+        self.save()
+
+    @property
+    def persistent(self):
+        """True if the cache is saved to a file."""
+        return bool(self._path)
+
+    def flush(self, keep=()):
+        """Discard all cached values except those of the keys in keep."""
+        self._values = dict([(key, self._values[key])
+                             for key in keep if key in self._values])
+        self.save()
+
+    def save(self):
+        if not self._path:
+            return
+        try:
+            parent = os.path.dirname(self._path)
+            if parent and not os.path.isdir(parent):
+                os.makedirs(parent)
+            temp_path = '%s.%d.tmp' % (self._path, os.getpid())
+            with open(temp_path, 'w') as cache_file:
+                json.dump(self._values, cache_file, indent=2, sort_keys=True)
+            os.rename(temp_path, self._path)
+        except (IOError, OSError) as e:
+            if self._logger:
+                self._logger.warning('Unable to save property cache %s: %s' %
+                                     (self._path, e))
+
+
 class ADBCommand(object):
     """ADBCommand provides a basic interface to adb commands
     which is used to provide the 'command' methods for the
@@ -128,7 +963,8 @@ class ADBCommand(object):
                  adb_port=None,
                  logger_name='adb',
                  timeout=300,
-                 verbose=False):
+                 verbose=False,
+                 spool_size=None):
         """Initializes the ADBCommand object.
 
         :param str adb: path to adb executable. Defaults to 'adb'.
@@ -137,6 +973,10 @@ class ADBCommand(object):
         :param adb_port: port of the adb server.
         :type adb_port: integer or None
         :param str logger_name: logging logger name. Defaults to 'adb'.
+        :param spool_size: number of bytes of adb output to hold in
+            memory before spilling to a temporary file. If None, adb
+            output is always written to a temporary file.
+        :type spool_size: integer or None
 
         :raises: * ADBError
                  * ADBTimeoutError
@@ -151,6 +991,10 @@ class ADBCommand(object):
         self._adb_port = adb_port
         self._timeout = timeout
         self._polling_interval = 0.1
+        self._spool_size = spool_size
+        # Set to False to fall back to sleeping _polling_interval
+        # seconds between checks for the completion of adb processes.
+        self._wait_for_exit = True
         self._adb_version = ''
 
         self._logger.debug("%s: %s" % (self.__class__.__name__,
@@ -226,21 +1070,17 @@ class ADBCommand(object):
             args.extend(['-s', device_serial, 'wait-for-device'])
         args.extend(cmds)
 
-        adb_process = ADBProcess(args)
+        adb_process = ADBProcess(args, spool_size=self._spool_size)
 
         if timeout is None:
             timeout = self._timeout
 
-        start_time = time.time()
-        adb_process.exitcode = adb_process.proc.poll()
-        while ((time.time() - start_time) <= timeout and
-               adb_process.exitcode is None):
-            time.sleep(self._polling_interval)
-            adb_process.exitcode = adb_process.proc.poll()
+        adb_process.exitcode = adb_process.wait(
+            timeout, polling_interval=self._polling_interval,
+            use_exit_pipe=self._wait_for_exit)
         if adb_process.exitcode is None:
-            adb_process.proc.kill()
             adb_process.timedout = True
-            adb_process.exitcode = adb_process.proc.poll()
+            adb_process.exitcode = adb_process.kill()
 
         adb_process.stdout_file.seek(0, os.SEEK_SET)
 
@@ -293,7 +1133,8 @@ class ADBCommand(object):
 
             return output
         finally:
-            if adb_process and isinstance(adb_process.stdout_file, file):
+            if adb_process and isinstance(adb_process.stdout_file,
+                                          (file, tempfile.SpooledTemporaryFile)):
                 adb_process.stdout_file.close()
 
 
@@ -315,7 +1156,8 @@ class ADBHost(ADBCommand):
                  adb_port=None,
                  logger_name='adb',
                  timeout=300,
-                 verbose=False):
+                 verbose=False,
+                 spool_size=None):
         """Initializes the ADBHost object.
 
         :param str adb: path to adb executable. Defaults to 'adb'.
@@ -324,13 +1166,18 @@ class ADBHost(ADBCommand):
         :param adb_port: port of the adb server.
         :type adb_port: integer or None
         :param str logger_name: logging logger name. Defaults to 'adb'.
+        :param spool_size: number of bytes of adb output to hold in
+            memory before spilling to a temporary file. If None, adb
+            output is always written to a temporary file.
+        :type spool_size: integer or None
 
         :raises: * ADBError
                  * ADBTimeoutError
         """
         ADBCommand.__init__(self, adb=adb, adb_host=adb_host,
                             adb_port=adb_port, logger_name=logger_name,
-                            timeout=timeout, verbose=verbose)
+                            timeout=timeout, verbose=verbose,
+                            spool_size=spool_size)
 
     def command(self, cmds, timeout=None):
         """Executes an adb command on the host.
@@ -509,7 +1356,10 @@ class ADBDevice(ADBCommand):
                  timeout=300,
                  verbose=False,
                  device_ready_retry_wait=20,
-                 device_ready_retry_attempts=3):
+                 device_ready_retry_attempts=3,
+                 use_adb_server_socket=False,
+                 spool_size=None,
+                 property_cache_dir=None):
         """Initializes the ADBDevice object.
 
         :param device: When a string is passed, it is interpreted as the
@@ -539,6 +1389,19 @@ class ADBDevice(ADBCommand):
             reboot.
         :param integer device_ready_retry_attempts: number of attempts when
             checking if a device is ready.
+        :param bool use_adb_server_socket: if True, shell, get_state,
+            push and pull talk to the adb server directly over its
+            socket rather than spawning an adb process for each call.
+        :param spool_size: number of bytes of adb output to hold in
+            memory before spilling to a temporary file. If None, adb
+            output is always written to a temporary file.
+        :type spool_size: integer or None
+        :param property_cache_dir: directory in which the device's
+            read only properties and capabilities are saved so that
+            they are not probed again when a new ADBDevice is created
+            for the device. If None, the values are only cached for
+            the life of the ADBDevice.
+        :type property_cache_dir: str or None
 
         :raises: * ADBError
                  * ADBTimeoutError
@@ -546,8 +1409,22 @@ class ADBDevice(ADBCommand):
         """
         ADBCommand.__init__(self, adb=adb, adb_host=adb_host,
                             adb_port=adb_port, logger_name=logger_name,
-                            timeout=timeout, verbose=verbose)
+                            timeout=timeout, verbose=verbose,
+                            spool_size=spool_size)
         self._device_serial = self._get_device_serial(device)
+        cache_path = None
+        if property_cache_dir and self._device_serial:
+            cache_path = os.path.join(
+                property_cache_dir,
+                '%s.json' % re.sub(r'[^\w.-]', '_', self._device_serial))
+        self._property_cache = ADBPropertyCache(cache_path,
+                                                logger=self._logger)
+        if use_adb_server_socket:
+            self._adb_server = ADBServerClient(host=adb_host, port=adb_port,
+                                               timeout=timeout,
+                                               spool_size=spool_size)
+        else:
+            self._adb_server = None
         self._initial_test_root = test_root
         self._test_root = None
         self._device_ready_retry_wait = device_ready_retry_wait
@@ -555,6 +1432,14 @@ class ADBDevice(ADBCommand):
         self._have_root_shell = False
         self._have_su = False
         self._have_android_su = False
+        self._ls = None
+        #: Maximum age in seconds of the process list snapshot shared
+        #: by process_exist, processes_exist and get_process_list. 0
+        #: disables the snapshot.
+        self.process_list_ttl = 0
+        self._process_snapshot = None
+        self._shell_session_depth = 0
+        self._shell_sessions = {}
 
         # Catch exceptions due to the potential for segfaults
         # calling su when using an improperly rooted device.
@@ -570,64 +1455,153 @@ class ADBDevice(ADBCommand):
         # rebooted again. Therefore this check will need to be
         # performed again after a reboot.
 
+        self._check_build_fingerprint(timeout=timeout)
         self._check_adb_root(timeout=timeout)
+        self._detect_capabilities(timeout=timeout)
 
-        uid = 'uid=0'
-        # Do we have a 'Superuser' sh like su?
-        try:
-            if self.shell_output("su -c id", timeout=timeout).find(uid) != -1:
-                self._have_su = True
-                self._logger.info("su -c supported")
-        except ADBError:
-            self._logger.debug("Check for su -c failed")
+        self._logger.debug("ADBDevice: %s" % self.__dict__)
 
-        # Do we have Android's su?
-        try:
-            if self.shell_output("su 0 id", timeout=timeout).find(uid) != -1:
-                self._have_android_su = True
-                self._logger.info("su 0 supported")
-        except ADBError:
-            self._logger.debug("Check for su 0 failed")
-
-        self._mkdir_p = None
-        # Force the use of /system/bin/ls or /system/xbin/ls in case
-        # there is /sbin/ls which embeds ansi escape codes to colorize
-        # the output.  Detect if we are using busybox ls. We want each
-        # entry on a single line and we don't want . or ..
-        if self.shell_bool("/system/bin/ls /data/local/tmp", timeout=timeout):
-            self._ls = "/system/bin/ls"
-        elif self.shell_bool("/system/xbin/ls /data/local/tmp", timeout=timeout):
-            self._ls = "/system/xbin/ls"
-        else:
-            raise ADBError("ADBDevice.__init__: ls not found")
+    def _check_build_fingerprint(self, timeout=None):
+        """Discard the saved property cache if the device has been
+        reflashed or upgraded since it was saved, that is if its
+        ro.build.fingerprint has changed.
+        """
+        cache = self._property_cache
+        if not cache.persistent:
+            return
         try:
-            self.shell_output("%s -1A /data/local/tmp" % self._ls, timeout=timeout)
-            self._ls += " -1A"
+            fingerprint = self.shell_output('getprop ro.build.fingerprint',
+                                            timeout=timeout)
         except ADBError:
-            self._ls += " -a"
+            self._logger.debug("Check for build fingerprint failed")
+            return
+        cached_fingerprint = cache.peek('build_fingerprint', str)
+        if cached_fingerprint == fingerprint:
+            return
+        if cached_fingerprint is not None:
+            self._logger.info("Build fingerprint changed from %s to %s, "
+                              "discarding property cache" % (
+                                  cached_fingerprint, fingerprint))
+        cache.flush()
+        cache.set('build_fingerprint', fingerprint)
+
+    def _detect_capabilities(self, timeout=None):
+        """Detect the su variants and the ls, cp and chmod -R support
+        on the device. The results are kept in the property cache so
+        that they are only probed once per device.
+        """
+        cache = self._property_cache
+
+        uid = 'uid=0'
+
+        def have_su():
+            # Do we have a 'Superuser' sh like su?
+            try:
+                if self.shell_output("su -c id", timeout=timeout).find(uid) != -1:
+                    return True
+            except ADBError:
+                self._logger.debug("Check for su -c failed")
+            return False
+
+        def have_android_su():
+            # Do we have Android's su?
+            try:
+                if self.shell_output("su 0 id", timeout=timeout).find(uid) != -1:
+                    return True
+            except ADBError:
+                self._logger.debug("Check for su 0 failed")
+            return False
 
+        self._have_su = cache.get('have_su', bool, have_su)
+        if self._have_su:
+            self._logger.info("su -c supported")
+        self._have_android_su = cache.get('have_android_su', bool,
+                                          have_android_su)
+        if self._have_android_su:
+            self._logger.info("su 0 supported")
+
+        def ls():
+            # Force the use of /system/bin/ls or /system/xbin/ls in case
+            # there is /sbin/ls which embeds ansi escape codes to colorize
+            # the output.  Detect if we are using busybox ls. We want each
+            # entry on a single line and we don't want . or ..
+            if self.shell_bool("/system/bin/ls /data/local/tmp", timeout=timeout):
+                ls = "/system/bin/ls"
+            elif self.shell_bool("/system/xbin/ls /data/local/tmp", timeout=timeout):
+                ls = "/system/xbin/ls"
+            else:
+                raise ADBError("ADBDevice.__init__: ls not found")
+            try:
+                self.shell_output("%s -1A /data/local/tmp" % ls, timeout=timeout)
+                ls += " -1A"
+            except ADBError:
+                ls += " -a"
+            return ls
+
+        self._ls = cache.get('ls', str, ls)
         self._logger.info("%s supported" % self._ls)
 
+        self._mkdir_p = cache.peek('mkdir_p', bool)
+
         # Do we have cp?
-        self._have_cp = self.shell_bool("type cp", timeout=timeout)
+        self._have_cp = cache.get('have_cp', bool,
+                                  lambda: self.shell_bool("type cp",
+                                                          timeout=timeout))
         self._logger.info("Native cp support: %s" % self._have_cp)
 
-        # Do we have chmod -R?
-        try:
-            self._chmod_R = False
+        def chmod_R():
+            # Do we have chmod -R?
             re_recurse = re.compile(r'[-]R')
-            chmod_output = self.shell_output("chmod --help", timeout=timeout)
-            match = re_recurse.search(chmod_output)
-            if match:
-                self._chmod_R = True
-        except (ADBError, ADBTimeoutError) as e:
-            self._logger.debug('Check chmod -R: %s' % e)
-            match = re_recurse.search(e.message)
-            if match:
-                self._chmod_R = True
+            try:
+                chmod_output = self.shell_output("chmod --help", timeout=timeout)
+                return re_recurse.search(chmod_output) is not None
+            except (ADBError, ADBTimeoutError) as e:
+                self._logger.debug('Check chmod -R: %s' % e)
+                return re_recurse.search(e.message) is not None
+
+        self._chmod_R = cache.get('chmod_R', bool, chmod_R)
         self._logger.info("Native chmod -R support: %s" % self._chmod_R)
 
-        self._logger.debug("ADBDevice: %s" % self.__dict__)
+        # Do we have tar? push_tree and pull_tree fall back to push
+        # and pull when it is missing.
+        self._have_tar = cache.get('have_tar', bool,
+                                   lambda: self.shell_bool("type tar",
+                                                           timeout=timeout))
+        self._logger.info("Native tar support: %s" % self._have_tar)
+
+        # Do we have md5sum and find? sync_files uses them to compare
+        # the files on the device with the local files.
+        self._have_md5sum = cache.get('have_md5sum', bool,
+                                      lambda: self.shell_bool(
+                                          "type md5sum && type find",
+                                          timeout=timeout))
+        self._logger.info("Native md5sum support: %s" % self._have_md5sum)
+
+        # Do we have gzip? get_logcat uses it to compress dumps of the
+        # logcat buffer on the device before they are transferred.
+        self._have_gzip = cache.get('have_gzip', bool,
+                                    lambda: self.shell_bool("type gzip",
+                                                            timeout=timeout))
+        self._logger.info("Native gzip support: %s" % self._have_gzip)
+
+    def flush_property_cache(self, timeout=None):
+        """Discard the cached properties and capabilities of the device
+        and detect the capabilities again.
+
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :raises: * ADBTimeoutError
+                 * ADBError
+        """
+        self._property_cache.flush(keep=['build_fingerprint'])
+        self._property_cache.set('have_root_shell', self._have_root_shell)
+        self._test_root = None
+        self._detect_capabilities(timeout=timeout)
 
     def _get_device_serial(self, device):
         if device is None:
@@ -683,6 +1657,17 @@ class ADBDevice(ADBCommand):
         except ADBError:
             self._logger.debug("Check for root adbd failed")
 
+        # The capabilities detected depend on whether adbd is running
+        # as root, so discard them if that has changed.
+        cache = self._property_cache
+        if cache.peek('have_root_shell', bool) != self._have_root_shell:
+            if self._ls is None:
+                # The capabilities have not been detected yet.
+                cache.flush(keep=['build_fingerprint'])
+                cache.set('have_root_shell', self._have_root_shell)
+            else:
+                self.flush_property_cache(timeout=timeout)
+
     @staticmethod
     def _escape_command_line(cmd):
         """Utility function to return escaped and quoted version of command
@@ -777,6 +1762,12 @@ class ADBDevice(ADBCommand):
                      '/mnt/sdcard/tests',
                      '/data/local/tests']
 
+        # Try the previously successful test root first.
+        cached_test_root = self._property_cache.peek('test_root', str)
+        if cached_test_root in paths:
+            paths.remove(cached_test_root)
+            paths.insert(0, cached_test_root)
+
         max_attempts = 3
         for attempt in range(1, max_attempts + 1):
             for test_root in paths:
@@ -785,6 +1776,7 @@ class ADBDevice(ADBCommand):
 
                 if self._try_test_root(test_root):
                     self._test_root = test_root
+                    self._property_cache.set('test_root', test_root)
                     return self._test_root
 
                 self._logger.debug('_setup_test_root: '
@@ -965,6 +1957,106 @@ class ADBDevice(ADBCommand):
 
     # Device Shell methods
 
+    def _get_root_command(self, cmd):
+        """Returns cmd wrapped so that it is executed as root."""
+        if self._have_root_shell:
+            return cmd
+        # If root was requested and we do not already have a root
+        # shell, then use the appropriate version of su to invoke
+        # the shell cmd. Prefer Android's su version since it may
+        # falsely report support for su -c.
+        if self._have_android_su:
+            return "su 0 %s" % cmd
+        if self._have_su:
+            return "su -c \"%s\"" % cmd
+        raise ADBRootError('Can not run command %s as root!' % cmd)
+
+    @staticmethod
+    def _prepend_cwd_env(cmd, env, cwd):
+        """Returns cmd with cwd and env prepended if necessary."""
+        if cwd:
+            cmd = "cd %s && %s" % (cwd, cmd)
+        if env:
+            envstr = '&& '.join(map(lambda x: 'export %s=%s' %
+                                    (x[0], x[1]), env.iteritems()))
+            cmd = envstr + "&& " + cmd
+        return cmd
+
+    @contextmanager
+    def shell_session(self):
+        """Context manager which executes the shell commands issued
+        within its scope in a persistent adb shell session rather
+        than starting a new adb shell for each command.
+
+        ::
+
+           with adbdevice.shell_session():
+               while adbdevice.process_exist(app_name):
+                   time.sleep(1)
+
+        Separate sessions are used for root and non-root commands. A
+        session which is lost, for example when the device is
+        disconnected, is restarted for the next command. If a session
+        can not be started, the commands fall back to the one shot
+        adb shell. The sessions are closed when the outermost
+        shell_session exits.
+        """
+        self._shell_session_depth += 1
+        try:
+            yield self
+        finally:
+            self._shell_session_depth -= 1
+            if self._shell_session_depth == 0:
+                self.close_shell_sessions()
+
+    def close_shell_sessions(self):
+        """Close any persistent adb shell sessions."""
+        for session in self._shell_sessions.values():
+            if session:
+                session.close()
+        self._shell_sessions = {}
+
+    def _get_shell_session(self, root, timeout):
+        """Returns a running ADBShellSession or None if sessions are
+        not in use or a session could not be started."""
+        if not self._shell_session_depth:
+            return None
+        root = root and not self._have_root_shell
+        session = self._shell_sessions.get(root, False)
+        if session is None:
+            # A previous attempt to start the session failed.
+            return None
+        if session and session.alive:
+            return session
+        try:
+            if session:
+                session.start(timeout)
+            else:
+                su_cmd = None
+                if root:
+                    if self._have_android_su:
+                        su_cmd = 'su 0 sh'
+                    elif self._have_su:
+                        su_cmd = 'su -c sh'
+                    else:
+                        raise ADBRootError('Can not start root shell session')
+                args = [self._adb_path]
+                if self._adb_host:
+                    args.extend(['-H', self._adb_host])
+                if self._adb_port:
+                    args.extend(['-P', str(self._adb_port)])
+                if self._device_serial:
+                    args.extend(['-s', self._device_serial])
+                args.extend(['wait-for-device', 'shell'])
+                session = ADBShellSession(args, su_cmd=su_cmd,
+                                          timeout=timeout)
+            self._shell_sessions[root] = session
+        except (ADBError, ADBRootError, ADBTimeoutError) as e:
+            self._logger.warning('Falling back to adb shell: %s' % e)
+            self._shell_sessions[root] = None
+            session = None
+        return session
+
     def shell(self, cmd, env=None, cwd=None, timeout=None, root=False):
         """Executes a shell command on the device.
 
@@ -1016,31 +2108,51 @@ class ADBDevice(ADBCommand):
         is terminated. The return code is extracted from the stdout
         and is then removed from the file.
 
+        Within the scope of shell_session(), the command is instead
+        written to a persistent adb shell session which is started on
+        first use.
+
         It is the caller's responsibilty to clean up by closing
         the stdout temporary files.
 
         """
-        if root and not self._have_root_shell:
-            # If root was requested and we do not already have a root
-            # shell, then use the appropriate version of su to invoke
-            # the shell cmd. Prefer Android's su version since it may
-            # falsely report support for su -c.
-            if self._have_android_su:
-                cmd = "su 0 %s" % cmd
-            elif self._have_su:
-                cmd = "su -c \"%s\"" % cmd
-            else:
-                raise ADBRootError('Can not run command %s as root!' % cmd)
+        if timeout is None:
+            timeout = self._timeout
 
-        # prepend cwd and env to command if necessary
-        if cwd:
-            cmd = "cd %s && %s" % (cwd, cmd)
-        if env:
-            envstr = '&& '.join(map(lambda x: 'export %s=%s' %
-                                    (x[0], x[1]), env.iteritems()))
-            cmd = envstr + "&& " + cmd
+        session = self._get_shell_session(root, timeout)
+        if session:
+            session_cmd = self._prepend_cwd_env(cmd, env, cwd)
+            adb_process = ADBShellSessionProcess(['session:%s' % session_cmd],
+                                                 spool_size=self._spool_size)
+            try:
+                adb_process.exitcode, output = session.run(session_cmd,
+                                                           timeout)
+                adb_process.stdout_file.write(output)
+                if adb_process.exitcode is None:
+                    adb_process.timedout = True
+                adb_process.stdout_file.seek(0, os.SEEK_SET)
+                return adb_process
+            except ADBError as e:
+                # The session was lost. Use the one shot adb shell for
+                # this command and restart the session for the next.
+                self._logger.warning('shell session: %s' % e)
+                adb_process.stdout_file.close()
+
+        if root:
+            cmd = self._get_root_command(cmd)
+
+        cmd = self._prepend_cwd_env(cmd, env, cwd)
         cmd += "; echo rc=$?"
 
+        if self._adb_server:
+            adb_process = self._adb_server.shell(self._device_serial, cmd,
+                                                 timeout=timeout)
+            if adb_process.exitcode == 0:
+                adb_process.exitcode = self._get_exitcode(
+                    adb_process.stdout_file)
+                adb_process.stdout_file.seek(0, os.SEEK_SET)
+            return adb_process
+
         args = [self._adb_path]
         if self._adb_host:
             args.extend(['-H', self._adb_host])
@@ -1049,20 +2161,14 @@ class ADBDevice(ADBCommand):
         if self._device_serial:
             args.extend(['-s', self._device_serial])
         args.extend(["wait-for-device", "shell", cmd])
-        adb_process = ADBProcess(args)
-
-        if timeout is None:
-            timeout = self._timeout
+        adb_process = ADBProcess(args, spool_size=self._spool_size)
 
-        start_time = time.time()
-        exitcode = adb_process.proc.poll()
-        while ((time.time() - start_time) <= timeout) and exitcode is None:
-            time.sleep(self._polling_interval)
-            exitcode = adb_process.proc.poll()
+        exitcode = adb_process.wait(
+            timeout, polling_interval=self._polling_interval,
+            use_exit_pipe=self._wait_for_exit)
         if exitcode is None:
-            adb_process.proc.kill()
             adb_process.timedout = True
-            adb_process.exitcode = adb_process.proc.poll()
+            adb_process.exitcode = adb_process.kill()
         elif exitcode == 0:
             adb_process.exitcode = self._get_exitcode(adb_process.stdout_file)
         else:
@@ -1154,9 +2260,117 @@ class ADBDevice(ADBCommand):
 
             return output
         finally:
-            if adb_process and isinstance(adb_process.stdout_file, file):
+            if adb_process and isinstance(adb_process.stdout_file,
+                                          (file, tempfile.SpooledTemporaryFile)):
                 adb_process.stdout_file.close()
 
+    def shell_batch(self, cmds, timeout=None, root=False, stop_on_error=False):
+        """Executes a list of shell commands on the device in a single
+        adb shell invocation.
+
+        :param list cmds: The commands to be executed. Each item is
+            either a command string or a tuple (cmd, root) which
+            overrides the root argument for that command.
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.  This timeout applies to the
+            batch as a whole. If it is not specified, the value set
+            in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param bool root: Flag specifying if the commands
+            should be executed as root.
+        :param bool stop_on_error: Flag specifying if the remaining
+            commands are to be skipped once a command exits with a
+            non-zero exit code.
+        :returns: list of (exitcode, output) tuples, one for each
+            command executed. If stop_on_error is True, the list ends
+            with the first failing command.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+
+        Each command is bracketed by lines containing a unique
+        delimiter so that the output and exit code of each command
+        can be split back out of the combined output.
+        """
+        delimiter = 'autophone-batch-%s' % uuid.uuid4().hex
+        separator = ' && ' if stop_on_error else '; '
+        script = []
+        for i, cmd in enumerate(cmds):
+            cmd_root = root
+            if isinstance(cmd, tuple):
+                cmd, cmd_root = cmd
+            if cmd_root:
+                cmd = self._get_root_command(cmd)
+            script.append('{ echo %s:%d; %s; rc=$?; echo; echo %s:%d:$rc; '
+                          '[ $rc -eq 0 ]; }' % (delimiter, i, cmd,
+                                                 delimiter, i))
+
+        adb_process = None
+        try:
+            adb_process = self.shell(separator.join(script), timeout=timeout)
+            if adb_process.timedout:
+                raise ADBTimeoutError("%s" % adb_process)
+            results = []
+            output = None
+            for line in adb_process.stdout_file:
+                line = line.rstrip('\r\n')
+                begin = '%s:%d' % (delimiter, len(results))
+                if line == begin:
+                    output = []
+                elif output is not None and line.startswith(begin + ':'):
+                    results.append((int(line[len(begin) + 1:]),
+                                    '\n'.join(output).rstrip()))
+                    output = None
+                elif output is not None:
+                    output.append(line)
+            if len(results) < len(cmds) and \
+               not (stop_on_error and results and results[-1][0]):
+                raise ADBError('shell_batch: completed %d of %d commands: %s' %
+                               (len(results), len(cmds), adb_process))
+            if self._verbose:
+                self._logger.debug('shell_batch: %s, '
+                                   'timeout: %s, '
+                                   'root: %s, '
+                                   'results: %s' %
+                                   (cmds, timeout, root, results))
+            return results
+        finally:
+            if adb_process and isinstance(adb_process.stdout_file,
+                                          (file, tempfile.SpooledTemporaryFile)):
+                adb_process.stdout_file.close()
+
+    def shell_batch_output(self, cmds, timeout=None, root=False):
+        """Executes a list of shell commands on the device in a single
+        adb shell invocation returning the output of each command.
+
+        :param list cmds: The commands to be executed. Each item is
+            either a command string or a tuple (cmd, root) which
+            overrides the root argument for that command.
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.  This timeout applies to the
+            batch as a whole. If it is not specified, the value set
+            in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param bool root: Flag specifying if the commands
+            should be executed as root.
+        :returns: list of the output of each command.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+
+        Execution stops at the first command which exits with a
+        non-zero exit code, in which case ADBError is raised.
+        """
+        results = self.shell_batch(cmds, timeout=timeout, root=root,
+                                   stop_on_error=True)
+        exitcode, output = results[-1] if results else (0, '')
+        if exitcode:
+            raise ADBError('shell_batch: %s exitcode: %s output: %s' % (
+                cmds[len(results) - 1], exitcode, output))
+        return [result[1] for result in results]
+
     # Informational methods
 
     def _get_logcat_buffer_args(self, buffers):
@@ -1201,7 +2415,8 @@ class ADBDevice(ADBCommand):
                    format="time",
                    filter_out_regexps=[],
                    timeout=None,
-                   buffers=[]):
+                   buffers=[],
+                   compress=False):
         """Returns the contents of the logcat file as a list of strings.
 
         :param list filter_specs: Optional logcat messages to
@@ -1218,19 +2433,91 @@ class ADBDevice(ADBCommand):
         :type timeout: integer or None
         :param list buffers: Log buffers to retrieve. Valid buffers are
             "radio", "events", and "main". Defaults to "main".
+        :param bool compress: Flag specifying if the dump should be
+            compressed with gzip on the device before it is
+            transferred. It is transferred uncompressed if the device
+            does not have gzip. Compressing only pays off for large
+            dumps since it requires additional adb commands.
         :returns: list of lines logcat output.
         :raises: * ADBTimeoutError
                  * ADBError
         """
         buffers = self._get_logcat_buffer_args(buffers)
         cmds = ["logcat", "-v", format, "-d"] + buffers + filter_specs
-        lines = self.command_output(cmds, timeout=timeout).splitlines()
+        if compress and self._have_gzip:
+            lines = self._get_compressed_logcat(cmds, timeout=timeout)
+        else:
+            lines = self.command_output(cmds, timeout=timeout).splitlines()
 
         for regex in filter_out_regexps:
             lines = [line for line in lines if not re.search(regex, line)]
 
         return lines
 
+    def _get_compressed_logcat(self, cmds, timeout=None):
+        """Dump logcat to a gzip file on the device, pull it and
+        return its lines. Falls back to an uncompressed dump if the
+        file can not be created."""
+        remote_archive = posixpath.join('/data/local/tmp',
+                                        'autophone-logcat-%s.gz' %
+                                        uuid.uuid4())
+        try:
+            # Quote the arguments so that filter specs such as *:V are
+            # not expanded by the device's shell.
+            self.shell_output('%s | gzip -c > %s' % (
+                ' '.join(["'%s'" % arg for arg in cmds]), remote_archive),
+                              timeout=timeout)
+        except ADBError, e:
+            self._logger.warning('get_logcat: compressing failed, '
+                                 'falling back to uncompressed dump: %s' % e)
+            self.shell_output('rm -f %s' % remote_archive, timeout=timeout)
+            return self.command_output(cmds, timeout=timeout).splitlines()
+        archive_fd, archive = tempfile.mkstemp(suffix='.gz')
+        os.close(archive_fd)
+        try:
+            self.pull(remote_archive, archive, timeout=timeout)
+            try:
+                archive_file = gzip.open(archive, 'rb')
+                try:
+                    return archive_file.read().splitlines()
+                finally:
+                    archive_file.close()
+            except (IOError, zlib.error), e:
+                raise ADBError('get_logcat: %s' % e)
+        finally:
+            os.unlink(archive)
+            self.shell_output('rm -f %s' % remote_archive, timeout=timeout)
+
+    def get_logcat_follower(self,
+                            filter_specs=["*:V"],
+                            format="time",
+                            buffers=[],
+                            max_lines=100000):
+        """Returns an ADBLogcatFollower which runs a single long lived
+        adb logcat process for the device. The follower is not started.
+
+        :param list filter_specs: Optional logcat messages to
+            be included.
+        :param str format: Optional logcat format.
+        :param list buffers: Log buffers to retrieve. Valid buffers are
+            "radio", "events", and "main". Defaults to "main".
+        :param integer max_lines: the maximum number of lines kept by
+            the follower.
+        :returns: :class:`ADBLogcatFollower`
+        :raises: ADBError
+        """
+        args = [self._adb_path]
+        if self._adb_host:
+            args.extend(['-H', self._adb_host])
+        if self._adb_port:
+            args.extend(['-P', str(self._adb_port)])
+        args.extend(['-s', self._device_serial, 'wait-for-device',
+                     'logcat', '-v', format])
+        args.extend(self._get_logcat_buffer_args(buffers))
+        args.extend(filter_specs)
+        return ADBLogcatFollower(args, max_lines=max_lines,
+                                 logger=self._logger)
+
     def get_prop(self, prop, timeout=None):
         """Gets value of a property from the device via adb shell getprop.
 
@@ -1245,7 +2532,14 @@ class ADBDevice(ADBCommand):
         :returns: string value of property.
         :raises: * ADBTimeoutError
                  * ADBError
+
+        Read only properties, those beginning with ro., are cached.
         """
+        if prop.startswith('ro.'):
+            return self._property_cache.get(
+                'prop:%s' % prop, str,
+                lambda: self.shell_output('getprop %s' % prop,
+                                          timeout=timeout))
         output = self.shell_output('getprop %s' % prop, timeout=timeout)
         return output
 
@@ -1263,6 +2557,9 @@ class ADBDevice(ADBCommand):
         :raises: * ADBTimeoutError
                  * ADBError
         """
+        if self._adb_server:
+            return self._adb_server.get_state(self._device_serial,
+                                              timeout=timeout).strip()
         output = self.command_output(["get-state"], timeout=timeout).strip()
         return output
 
@@ -1627,9 +2924,7 @@ class ADBDevice(ADBCommand):
         else:
             recursive_flag = '-R'
             if path.startswith('/sdcard') and path.endswith('/'):
-                model = self.shell_output('getprop ro.product.model',
-                                          timeout=timeout,
-                                          root=root)
+                model = self.get_prop('ro.product.model', timeout=timeout)
                 if model == 'Nexus 4':
                     path += '*'
         lines = self.shell_output('%s %s %s' % (self._ls, recursive_flag, path),
@@ -1682,7 +2977,9 @@ class ADBDevice(ADBCommand):
                 # non-zero exitcode if -p is not supported.
                 if self.shell_bool('mkdir -p %s' % path, timeout=timeout,
                                    root=root):
-                    self._mkdir_p = True
+                    if not self._mkdir_p:
+                        self._mkdir_p = True
+                        self._property_cache.set('mkdir_p', True)
                     return
             # mkdir -p is not supported. create the parent
             # directories individually.
@@ -1727,6 +3024,26 @@ class ADBDevice(ADBCommand):
         # remove trailing /
         local = os.path.normpath(local)
         remote = os.path.normpath(remote)
+        if self._adb_server:
+            # A single sync connection is used for all of the files
+            # being pushed. adbd creates any missing parent
+            # directories, and the local directory is always copied
+            # onto the remote directory.
+            if os.path.isdir(local):
+                pairs = []
+                for dirpath, dirnames, filenames in os.walk(local):
+                    remote_dirpath = posixpath.join(
+                        remote,
+                        *os.path.relpath(dirpath, local).split(os.sep))
+                    for filename in filenames:
+                        pairs.append((os.path.join(dirpath, filename),
+                                      posixpath.normpath(posixpath.join(
+                                          remote_dirpath, filename))))
+            else:
+                pairs = [(local, remote)]
+            self._adb_server.push_files(self._device_serial, pairs,
+                                        timeout=timeout)
+            return
         copy_required = False
         if os.path.isdir(local):
             copy_required = True
@@ -1772,6 +3089,21 @@ class ADBDevice(ADBCommand):
         # remove trailing /
         local = os.path.normpath(local)
         remote = os.path.normpath(remote)
+        if self._adb_server:
+            mode = self._adb_server.stat(self._device_serial, remote,
+                                         timeout=timeout)[0]
+            if mode == 0:
+                raise ADBError('pull %s %s: remote object does not exist' %
+                               (remote, local))
+            if stat.S_ISREG(mode):
+                if os.path.isdir(local):
+                    local = os.path.join(local, posixpath.basename(remote))
+                self._adb_server.pull_files(self._device_serial,
+                                            [(remote, local)],
+                                            timeout=timeout)
+                return
+            # Directories are pulled with the adb executable which
+            # knows how to walk the remote tree.
         copy_required = False
         original_local = local
         if self._adb_version >= '1.0.36' and \
@@ -1806,6 +3138,292 @@ class ADBDevice(ADBCommand):
                 dir_util.copy_tree(local, original_local)
                 shutil.rmtree(temp_parent)
 
+    def _get_tree_archive_path(self):
+        return posixpath.join('/data/local/tmp',
+                              'autophone-tree-%s.tar' % uuid.uuid4())
+
+    def _push_archive(self, members, remote, timeout=None, root=False):
+        """Pack members, a list of (local path, archive name) tuples,
+        into a tar archive on the host, push it to the device and
+        unpack it onto the remote directory. Returns False if the
+        archive could not be unpacked on the device.
+        """
+        def set_owner(tarinfo):
+            # Match the ownership of files pushed by adb push.
+            tarinfo.uid = tarinfo.gid = 2000
+            tarinfo.uname = tarinfo.gname = 'shell'
+            return tarinfo
+
+        archive_fd, archive = tempfile.mkstemp(suffix='.tar')
+        os.close(archive_fd)
+        remote_archive = self._get_tree_archive_path()
+        try:
+            tar = tarfile.open(archive, 'w', dereference=True)
+            try:
+                for local, name in members:
+                    tar.add(local, arcname=name, filter=set_owner)
+            finally:
+                tar.close()
+            self.push(archive, remote_archive, timeout=timeout)
+            try:
+                self.shell_output('mkdir -p %s && tar xf %s -C %s; rc=$?; '
+                                  'rm -f %s; [ $rc -eq 0 ]' %
+                                  (remote, remote_archive, remote,
+                                   remote_archive),
+                                  timeout=timeout, root=root)
+                return True
+            except ADBError, e:
+                self._logger.warning('Unpacking %s onto %s failed: %s' %
+                                     (remote_archive, remote, e))
+                return False
+        finally:
+            os.unlink(archive)
+
+    def push_tree(self, local, remote, timeout=None, root=False):
+        """Pushes a local directory onto a remote directory.
+
+        The local directory is packed into a single tar archive on the
+        host which is pushed to the device and unpacked with one shell
+        command. This avoids the per file cost of adb push for
+        directories containing many small files. If tar is not
+        available on the device or unpacking the archive fails, the
+        directory is pushed using push().
+
+        :param str local: The name of the local directory.
+        :param str remote: The name of the remote directory. It is
+            created if it does not exist.
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param bool root: Flag specifying if the archive should be
+            unpacked as root.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+        """
+        local = os.path.normpath(local)
+        remote = posixpath.normpath(remote)
+        if not os.path.isdir(local):
+            raise ADBError('push_tree %s: not a directory' % local)
+        if self._have_tar:
+            members = [(os.path.join(local, name), name)
+                       for name in sorted(os.listdir(local))]
+            if self._push_archive(members, remote, timeout=timeout,
+                                  root=root):
+                return
+        self.push(local, remote, timeout=timeout)
+
+    @staticmethod
+    def _list_tree_files(local):
+        """Return a dict mapping the path of each file below the local
+        directory, relative to it and using / as the separator, to its
+        local path.
+        """
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(local, followlinks=True):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files['/'.join(os.path.relpath(path, local).split(os.sep))] = path
+        return files
+
+    @staticmethod
+    def _md5_file(path):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(64 * 1024)
+                if not data:
+                    break
+                md5.update(data)
+        return md5.hexdigest()
+
+    def _get_remote_md5s(self, remote, timeout=None, root=False):
+        """Return a dict mapping the path of each file below the remote
+        directory, relative to it, to the md5 of its content as
+        computed on the device.
+        """
+        re_md5sum = re.compile(r'^([0-9a-f]{32}) [ *]\./(.*)$')
+        output = self.shell_output('if [ -d %s ]; then cd %s && '
+                                   'find . -type f -exec md5sum {} +; fi' %
+                                   (remote, remote),
+                                   timeout=timeout, root=root)
+        md5s = {}
+        for line in output.splitlines():
+            match = re_md5sum.match(line.rstrip('\r'))
+            if match:
+                md5s[match.group(2)] = match.group(1)
+        return md5s
+
+    def _push_files(self, files, names, remote, timeout=None, root=False):
+        """Push the named files from the files dict onto the remote
+        directory using a single tar archive if possible.
+        """
+        names = sorted(names)
+        if self._have_tar and self._push_archive(
+                [(files[name], name) for name in names], remote,
+                timeout=timeout, root=root):
+            return
+        for name in names:
+            self.push(files[name], posixpath.join(remote, name),
+                      timeout=timeout)
+
+    def sync_files(self, files, remote, timeout=None, root=False):
+        """Make the remote directory contain exactly the given local
+        files, pushing only the files which are missing or whose
+        content differs on the device and deleting the remote files
+        which are not in files.
+
+        The remote files are compared using md5 hashes computed on the
+        device at the time of the call, so that files which were
+        modified on the device or a wiped sdcard are detected. If
+        md5sum is not available on the device, the remote directory
+        is removed and all of the files are pushed.
+
+        :param dict files: Maps the path of each file relative to the
+            remote directory, using / as the separator, to the path of
+            the local file.
+        :param str remote: The name of the remote directory.
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param bool root: Flag specifying if the remote directory
+            should be examined and modified as root.
+        :returns: tuple of the sorted lists of the relative paths of
+            the pushed and the deleted files.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+        """
+        remote = posixpath.normpath(remote)
+        remote_md5s = None
+        if self._have_md5sum:
+            try:
+                remote_md5s = self._get_remote_md5s(remote, timeout=timeout,
+                                                    root=root)
+            except ADBError, e:
+                self._logger.warning('sync_files %s: unable to hash remote '
+                                     'files: %s' % (remote, e))
+        if remote_md5s is None:
+            self.rm(remote, recursive=True, force=True, timeout=timeout,
+                    root=root)
+            remote_md5s = {}
+
+        pushed = sorted([name for name in files
+                         if remote_md5s.get(name) != self._md5_file(files[name])])
+        deleted = sorted([name for name in remote_md5s if name not in files])
+        # Delete the files in batches to keep the command lines short.
+        for i in range(0, len(deleted), 100):
+            self.shell_output(self._escape_command_line(
+                ['rm', '-f'] + [posixpath.join(remote, name)
+                                for name in deleted[i:i+100]]),
+                              timeout=timeout, root=root)
+        if pushed:
+            self._push_files(files, pushed, remote, timeout=timeout, root=root)
+        self._logger.info('sync_files %s: %d pushed, %d deleted, %d unchanged' %
+                          (remote, len(pushed), len(deleted),
+                           len(files) - len(pushed)))
+        return pushed, deleted
+
+    def sync_tree(self, local, remote, timeout=None, root=False):
+        """Make the remote directory a copy of the local directory,
+        pushing only the files which were added or changed and
+        deleting the files which were removed. See sync_files.
+
+        :param str local: The name of the local directory.
+        :param str remote: The name of the remote directory.
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param bool root: Flag specifying if the remote directory
+            should be examined and modified as root.
+        :returns: tuple of the sorted lists of the relative paths of
+            the pushed and the deleted files.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+        """
+        local = os.path.normpath(local)
+        if not os.path.isdir(local):
+            raise ADBError('sync_tree %s: not a directory' % local)
+        return self.sync_files(self._list_tree_files(local), remote,
+                               timeout=timeout, root=root)
+
+    def pull_tree(self, remote, local, timeout=None, root=False):
+        """Pulls a remote directory onto a local directory.
+
+        The remote directory is packed into a single tar archive on
+        the device which is pulled and unpacked on the host. This
+        avoids the per file cost of adb pull for directories
+        containing many small files. If tar is not available on the
+        device or creating the archive fails, the directory is pulled
+        using pull().
+
+        :param str remote: The name of the remote directory.
+        :param str local: The name of the local directory. It is
+            created if it does not exist.
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :param bool root: Flag specifying if the archive should be
+            created as root.
+        :raises: * ADBTimeoutError
+                 * ADBRootError
+                 * ADBError
+        """
+        remote = posixpath.normpath(remote)
+        local = os.path.normpath(local)
+        if not os.path.isdir(local):
+            os.makedirs(local)
+        if not self._have_tar:
+            self.pull(remote, local, timeout=timeout)
+            return
+
+        remote_archive = self._get_tree_archive_path()
+        try:
+            self.shell_output('tar cf %s -C %s . && chmod 644 %s' %
+                              (remote_archive, remote, remote_archive),
+                              timeout=timeout, root=root)
+        except ADBError, e:
+            self._logger.warning('pull_tree %s %s: packing failed, '
+                                 'falling back to pull: %s' %
+                                 (remote, local, e))
+            self.shell_output('rm -f %s' % remote_archive,
+                              timeout=timeout, root=root)
+            self.pull(remote, local, timeout=timeout)
+            return
+        archive_fd, archive = tempfile.mkstemp(suffix='.tar')
+        os.close(archive_fd)
+        try:
+            self.pull(remote_archive, archive, timeout=timeout)
+            try:
+                tar = tarfile.open(archive, 'r')
+                try:
+                    tar.extractall(local)
+                finally:
+                    tar.close()
+            except tarfile.TarError, e:
+                raise ADBError('pull_tree %s %s: %s' % (remote, local, e))
+        finally:
+            os.unlink(archive)
+            self.shell_output('rm -f %s' % remote_archive,
+                              timeout=timeout, root=root)
+
     def rm(self, path, recursive=False, force=False, timeout=None, root=False):
         """Delete files or directories on the device.
 
@@ -1862,7 +3480,7 @@ class ADBDevice(ADBCommand):
 
     # Process management methods
 
-    def get_process_list(self, timeout=None):
+    def get_process_list(self, timeout=None, fresh=False):
         """Returns list of tuples (pid, name, user) for running
         processes on device.
 
@@ -1873,50 +3491,62 @@ class ADBDevice(ADBCommand):
             may exceed this value. If it is not specified,
             the value set in the ADBDevice constructor is used.
         :type timeout: integer or None
+        :param bool fresh: If True, always query the device rather
+            than returning a snapshot younger than process_list_ttl
+            seconds.
         :returns: list of (pid, name, user) tuples for running processes
             on the device.
         :raises: * ADBTimeoutError
                  * ADBError
         """
-        adb_process = None
-        try:
-            adb_process = self.shell("ps", timeout=timeout)
-            if adb_process.timedout:
-                raise ADBTimeoutError("%s" % adb_process)
-            elif adb_process.exitcode:
-                raise ADBError("%s" % adb_process)
-            # first line is the headers
-            header = adb_process.stdout_file.readline()
-            pid_i = -1
-            user_i = -1
-            els = header.split()
-            for i in range(len(els)):
-                item = els[i].lower()
-                if item == 'user':
-                    user_i = i
-                elif item == 'pid':
-                    pid_i = i
-            if user_i == -1 or pid_i == -1:
-                self._logger.error('get_process_list: %s' % header)
-                raise ADBError('get_process_list: Unknown format: %s: %s' % (
-                    header, adb_process))
-            ret = []
-            line = adb_process.stdout_file.readline()
-            while line:
-                els = line.split()
-                try:
-                    ret.append([int(els[pid_i]), els[-1], els[user_i]])
-                except ValueError:
-                    self._logger.error('get_process_list: %s %s\n%s' % (
-                        header, line, traceback.format_exc()))
-                    raise ADBError('get_process_list: %s: %s: %s' % (
-                        header, line, adb_process))
-                line = adb_process.stdout_file.readline()
-            self._logger.debug('get_process_list: %s' % ret)
-            return ret
-        finally:
-            if adb_process and isinstance(adb_process.stdout_file, file):
-                adb_process.stdout_file.close()
+        if not fresh and self.process_list_ttl and self._process_snapshot:
+            snapshot_time, proc_list = self._process_snapshot
+            if time.time() - snapshot_time < self.process_list_ttl:
+                return proc_list
+        proc_list = self.parse_process_list(self.shell_output("ps",
+                                                              timeout=timeout))
+        self._process_snapshot = (time.time(), proc_list)
+        return proc_list
+
+    def parse_process_list(self, ps_output):
+        """Returns list of tuples (pid, name, user) parsed from the
+        output of ps on the device.
+
+        :param str ps_output: output of the ps command.
+        :returns: list of (pid, name, user) tuples for running processes
+            on the device.
+        :raises: * ADBError
+        """
+        lines = ps_output.splitlines()
+        # first line is the headers
+        header = lines[0] if lines else ''
+        pid_i = -1
+        user_i = -1
+        els = header.split()
+        for i in range(len(els)):
+            item = els[i].lower()
+            if item == 'user':
+                user_i = i
+            elif item == 'pid':
+                pid_i = i
+        if user_i == -1 or pid_i == -1:
+            self._logger.error('get_process_list: %s' % header)
+            raise ADBError('get_process_list: Unknown format: %s: %s' % (
+                header, ps_output))
+        ret = []
+        for line in lines[1:]:
+            els = line.split()
+            if not els:
+                continue
+            try:
+                ret.append([int(els[pid_i]), els[-1], els[user_i]])
+            except ValueError:
+                self._logger.error('get_process_list: %s %s\n%s' % (
+                    header, line, traceback.format_exc()))
+                raise ADBError('get_process_list: %s: %s: %s' % (
+                    header, line, ps_output))
+        self._logger.debug('get_process_list: %s' % ret)
+        return ret
 
     def kill(self, pids, sig=None, attempts=3, wait=5,
              timeout=None, root=False):
@@ -1954,7 +3584,8 @@ class ADBDevice(ADBCommand):
                     raise
             pid_set = set(pid_list)
             current_pid_set = set([str(proc[0]) for proc in
-                                   self.get_process_list(timeout=timeout)])
+                                   self.get_process_list(timeout=timeout,
+                                                         fresh=True)])
             pid_list = list(pid_set.intersection(current_pid_set))
             if not pid_list:
                 break
@@ -1991,7 +3622,7 @@ class ADBDevice(ADBCommand):
                  * ADBRootError
                  * ADBError
         """
-        procs = self.get_process_list(timeout=timeout)
+        procs = self.get_process_list(timeout=timeout, fresh=True)
         # limit the comparion to the first 75 characters due to a
         # limitation in processname length in android.
         pids = [proc[0] for proc in procs if proc[1] == appname[:75]]
@@ -2005,7 +3636,7 @@ class ADBDevice(ADBCommand):
             if self.process_exist(appname, timeout=timeout):
                 raise e
 
-    def process_exist(self, process_name, timeout=None):
+    def process_exist(self, process_name, timeout=None, proc_list=None):
         """Returns True if process with name process_name is running on
         device.
 
@@ -2019,11 +3650,65 @@ class ADBDevice(ADBCommand):
             may exceed this value. If it is not specified, the value
             set in the ADBDevice constructor is used.
         :type timeout: integer or None
+        :param proc_list: list of (pid, name, user) tuples as returned
+            by get_process_list. If None, the process list is
+            retrieved from the device.
+        :type proc_list: list or None
         :returns: boolean - True if process exists.
 
         :raises: * ADBTimeoutError
                  * ADBError
         """
+        app = self._get_app_name(process_name)
+
+        if proc_list is None:
+            if not self.process_list_ttl and self._have_pidof(timeout=timeout):
+                return self.shell_bool('pidof %s' % app, timeout=timeout)
+            proc_list = self.get_process_list(timeout=timeout)
+        return self._app_in_process_list(app, proc_list)
+
+    def processes_exist(self, process_names, timeout=None):
+        """Returns a dict mapping each of process_names to True if a
+        process with that name is running on device.
+
+        :param list process_names: The names of the processes
+            to check. Note that only the first 75 characters of the
+            process names are significant.
+        :param timeout: The maximum time in
+            seconds for any spawned adb process to complete before
+            throwing an ADBTimeoutError.
+            This timeout is per adb call. The total time spent
+            may exceed this value. If it is not specified, the value
+            set in the ADBDevice constructor is used.
+        :type timeout: integer or None
+        :returns: dict of process name: boolean.
+
+        :raises: * ADBTimeoutError
+                 * ADBError
+
+        All of the processes are checked with a single adb shell.
+        """
+        apps = [self._get_app_name(process_name)
+                for process_name in process_names]
+        if not self.process_list_ttl and self._have_pidof(timeout=timeout):
+            results = self.shell_batch(['pidof %s' % app for app in apps],
+                                       timeout=timeout)
+            return dict([(process_name, exitcode == 0)
+                         for process_name, (exitcode, output) in
+                         zip(process_names, results)])
+        proc_list = self.get_process_list(timeout=timeout)
+        return dict([(process_name, self._app_in_process_list(app, proc_list))
+                     for process_name, app in zip(process_names, apps)])
+
+    def _have_pidof(self, timeout=None):
+        """Returns True if the device has pidof."""
+        return self._property_cache.get(
+            'have_pidof', bool,
+            lambda: self.shell_bool('type pidof', timeout=timeout))
+
+    @staticmethod
+    def _get_app_name(process_name):
+        """Returns the app name portion of process_name."""
         if not isinstance(process_name, basestring):
             raise ADBError("Process name %s is not a string" % process_name)
 
@@ -2039,9 +3724,10 @@ class ADBDevice(ADBCommand):
 
         pieces = process_name.split(' ')
         parts = pieces[0].split('/')
-        app = parts[-1]
+        return parts[-1]
 
-        proc_list = self.get_process_list(timeout=timeout)
+    @staticmethod
+    def _app_in_process_list(app, proc_list):
         if not proc_list:
             return False
 
@@ -2172,6 +3858,7 @@ class ADBDevice(ADBCommand):
         # versions of adb.
         self.command_output([], timeout=timeout)
         self._check_adb_root(timeout=timeout)
+        self.flush_property_cache(timeout=timeout)
         return self.is_device_ready(timeout=timeout)
 
     @abstractmethod
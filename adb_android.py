@@ -38,7 +38,10 @@ class ADBAndroid(ADBDevice):
                  timeout=300,
                  verbose=False,
                  device_ready_retry_wait=20,
-                 device_ready_retry_attempts=3):
+                 device_ready_retry_attempts=3,
+                 use_adb_server_socket=False,
+                 spool_size=None,
+                 property_cache_dir=None):
         """Initializes the ADBAndroid object.
 
         :param device: When a string is passed, it is interpreted as the
@@ -68,6 +71,19 @@ class ADBAndroid(ADBDevice):
             reboot.
         :param integer device_ready_retry_attempts: number of attempts when
             checking if a device is ready.
+        :param bool use_adb_server_socket: if True, shell, get_state,
+            push and pull talk to the adb server directly over its
+            socket rather than spawning an adb process for each call.
+        :param spool_size: number of bytes of adb output to hold in
+            memory before spilling to a temporary file. If None, adb
+            output is always written to a temporary file.
+        :type spool_size: integer or None
+        :param property_cache_dir: directory in which the device's
+            read only properties and capabilities are saved so that
+            they are not probed again when a new ADBAndroid is created
+            for the device. If None, the values are only cached for
+            the life of the ADBAndroid.
+        :type property_cache_dir: str or None
 
         :raises: * ADBError
                  * ADBTimeoutError
@@ -79,23 +95,35 @@ class ADBAndroid(ADBDevice):
                            logger_name=logger_name, timeout=timeout,
                            verbose=verbose,
                            device_ready_retry_wait=device_ready_retry_wait,
-                           device_ready_retry_attempts=device_ready_retry_attempts)
+                           device_ready_retry_attempts=device_ready_retry_attempts,
+                           use_adb_server_socket=use_adb_server_socket,
+                           spool_size=spool_size,
+                           property_cache_dir=property_cache_dir)
+
+    def _detect_capabilities(self, timeout=None):
+        """Detect the ADBDevice capabilities as well as SELinux support
+        and the SDK version of the device.
+        """
+        ADBDevice._detect_capabilities(self, timeout=timeout)
         # https://source.android.com/devices/tech/security/selinux/index.html
         # setenforce
         # usage:  setenforce [ Enforcing | Permissive | 1 | 0 ]
         # getenforce returns either Enforcing or Permissive
 
-        try:
-            self.selinux = True
-            if self.shell_output('getenforce', timeout=timeout) != 'Permissive':
-                self._logger.info('Setting SELinux Permissive Mode')
-                self.shell_output("setenforce Permissive", timeout=timeout, root=True)
-        except (ADBError, ADBRootError), e:
-            self._logger.warning('Unable to set SELinux Permissive due to %s.' % e)
-            self.selinux = False
-
-        self.version = int(self.shell_output("getprop ro.build.version.sdk",
-                                             timeout=timeout))
+        self.selinux = self._property_cache.peek('selinux', bool)
+        if self.selinux is not False:
+            try:
+                self.selinux = True
+                if self.shell_output('getenforce', timeout=timeout) != 'Permissive':
+                    self._logger.info('Setting SELinux Permissive Mode')
+                    self.shell_output("setenforce Permissive", timeout=timeout, root=True)
+            except (ADBError, ADBRootError), e:
+                self._logger.warning('Unable to set SELinux Permissive due to %s.' % e)
+                self.selinux = False
+            self._property_cache.set('selinux', self.selinux)
+
+        self.version = int(self.get_prop('ro.build.version.sdk',
+                                         timeout=timeout))
 
     def reboot(self, timeout=None):
         """Reboots the device.
@@ -199,19 +227,22 @@ class ADBAndroid(ADBDevice):
                     failure = "Device state: %s" % state
                     success = False
                 else:
+                    # SELinux must be made permissive before the test
+                    # root can be written.
                     if (self.selinux and self.shell_output('getenforce',
                                                            timeout=timeout) != 'Permissive'):
                         self._logger.info('Setting SELinux Permissive Mode')
                         self.shell_output("setenforce Permissive", timeout=timeout, root=True)
-                    if self.is_dir(ready_path, timeout=timeout):
-                        self.rmdir(ready_path, timeout=timeout)
-                    self.mkdir(ready_path, timeout=timeout)
-                    self.rmdir(ready_path, timeout=timeout)
-                    # Invoke the pm list commands to see if it is up and
-                    # running.
-                    for pm_list_cmd in pm_list_commands:
-                        data = self.shell_output("pm list %s" % pm_list_cmd,
-                                                 timeout=timeout)
+                    # Check that the test root is writable and invoke
+                    # the pm list commands to see if it is up and
+                    # running in a single adb shell.
+                    cmds = ['rmdir %s || true' % ready_path,
+                            'mkdir %s' % ready_path,
+                            'rmdir %s' % ready_path]
+                    cmds.extend(['pm list %s' % pm_list_cmd
+                                 for pm_list_cmd in pm_list_commands])
+                    outputs = self.shell_batch_output(cmds, timeout=timeout)
+                    for data in outputs[-len(pm_list_commands):]:
                         if pm_error_string in data:
                             failure = data
                             success = False
@@ -436,18 +467,19 @@ class ADBAndroid(ADBDevice):
         else:
             num_tries = 0
             max_tries = 5
-            while self.process_exist(app_name, timeout=timeout):
-                if num_tries > max_tries:
-                    raise ADBError("Couldn't successfully kill %s after %s "
-                                   "tries" % (app_name, max_tries))
-                self.pkill(app_name, timeout=timeout, root=root)
-                num_tries += 1
-
-                # sleep for a short duration to make sure there are no
-                # additional processes in the process of being launched
-                # (this is not 100% guaranteed to work since it is inherently
-                # racey, but it's the best we can do)
-                time.sleep(1)
+            with self.shell_session():
+                while self.process_exist(app_name, timeout=timeout):
+                    if num_tries > max_tries:
+                        raise ADBError("Couldn't successfully kill %s after %s "
+                                       "tries" % (app_name, max_tries))
+                    self.pkill(app_name, timeout=timeout, root=root)
+                    num_tries += 1
+
+                    # sleep for a short duration to make sure there are no
+                    # additional processes in the process of being launched
+                    # (this is not 100% guaranteed to work since it is inherently
+                    # racey, but it's the best we can do)
+                    time.sleep(1)
 
     def uninstall_app(self, app_name, reboot=False, timeout=None):
         """Uninstalls an app on the device.
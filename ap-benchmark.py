@@ -0,0 +1,1007 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+logging.basicConfig()
+
+
+def report(label, count, elapsed):
+    print '%-40s %8d calls %10.3f s %10.3f ms/call' % (
+        label, count, elapsed, 1000.0 * elapsed / count)
+
+
+def benchmark_adb_server(args):
+    """Compare forking a process per shell command with executing the
+    same command over the adb server socket. Unless --adb-port is
+    given, a fake adb server is started locally so that no device is
+    required."""
+    import fakeadbserver
+    from adb import ADBServerClient
+
+    server = None
+    port = args.adb_port
+    serial = args.serial
+    if not port:
+        server = fakeadbserver.start_server()
+        port = server.server_address[1]
+        serial = fakeadbserver.DEFAULT_SERIAL
+    client = ADBServerClient(port=port)
+    cmd = 'echo autophone; echo rc=$?'
+
+    try:
+        if args.adb:
+            fork_args = [args.adb, '-P', str(port)]
+            if serial:
+                fork_args.extend(['-s', serial])
+            fork_args.extend(['shell', cmd])
+            label = 'adb shell (fork)'
+        else:
+            fork_args = ['/bin/sh', '-c', cmd]
+            label = '/bin/sh -c (fork)'
+        start = time.time()
+        for i in xrange(args.iterations):
+            stdout_file = tempfile.TemporaryFile()
+            subprocess.Popen(fork_args, stdout=stdout_file,
+                             stderr=subprocess.STDOUT).wait()
+            stdout_file.close()
+        report(label, args.iterations, time.time() - start)
+
+        start = time.time()
+        for i in xrange(args.iterations):
+            client.shell(serial, cmd).stdout_file.close()
+        report('shell: over adb server socket', args.iterations,
+               time.time() - start)
+
+        local_dir = tempfile.mkdtemp()
+        try:
+            pairs = []
+            for i in xrange(args.files):
+                local = os.path.join(local_dir, 'file%d' % i)
+                with open(local, 'wb') as local_file:
+                    local_file.write(os.urandom(args.file_size))
+                pairs.append((local, '/data/local/tmp/benchmark/file%d' % i))
+            start = time.time()
+            for pair in pairs:
+                client.push_files(serial, [pair])
+            report('sync: one connection per file', args.files,
+                   time.time() - start)
+            start = time.time()
+            client.push_files(serial, pairs)
+            report('sync: one connection for all files', args.files,
+                   time.time() - start)
+        finally:
+            shutil.rmtree(local_dir)
+    finally:
+        if server:
+            fakeadbserver.stop_server(server, remove_root=True)
+
+
+def benchmark_wait(args):
+    """Compare the latency of waiting for short lived processes by
+    sleeping between polls with waiting on the exit pipe."""
+    from adb import ADBProcess
+
+    cmd = ['/bin/sh', '-c', args.command]
+    for label, use_exit_pipe in (('wait: polling loop', False),
+                                 ('wait: exit pipe', True)):
+        start = time.time()
+        for i in xrange(args.iterations):
+            adb_process = ADBProcess(cmd)
+            adb_process.wait(60, polling_interval=args.polling_interval,
+                             use_exit_pipe=use_exit_pipe)
+            adb_process.stdout_file.close()
+        report(label, args.iterations, time.time() - start)
+
+
+def benchmark_push_tree(args):
+    """Compare pushing a page set of many small files one file at a
+    time, as a directory with adb push and as a single tar archive
+    with push_tree. Requires an attached device."""
+    from adb_android import ADBAndroid
+
+    dm = ADBAndroid(device=args.serial)
+    remote = '/data/local/tmp/benchmark-pages'
+    local_dir = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in xrange(args.files):
+            subdir = os.path.join(local_dir, 'dir%d' % (i % args.dirs))
+            if not os.path.isdir(subdir):
+                os.makedirs(subdir)
+            local = os.path.join(subdir, 'file%d.html' % i)
+            with open(local, 'wb') as local_file:
+                local_file.write(os.urandom(args.file_size))
+            files.append(os.path.relpath(local, local_dir))
+
+        def push_files():
+            for name in files:
+                dm.push(os.path.join(local_dir, name),
+                        '/'.join([remote] + name.split(os.sep)))
+
+        for label, push in (
+                ('push: one adb push per file', push_files),
+                ('push: adb push of the directory',
+                 lambda: dm.push(local_dir, remote)),
+                ('push_tree: one tar archive',
+                 lambda: dm.push_tree(local_dir, remote))):
+            dm.rm(remote, recursive=True, force=True)
+            start = time.time()
+            push()
+            report(label, args.files, time.time() - start)
+    finally:
+        dm.rm(remote, recursive=True, force=True)
+        shutil.rmtree(local_dir)
+
+
+def legacy_logcat_get(accumulated_logcat, raw_logcat):
+    """The date based de-duplication previously used by Logcat.get()
+    for dumps of the device's logcat buffer. Returns the new lines
+    after appending them to accumulated_logcat."""
+    if accumulated_logcat:
+        logcat_datestr = accumulated_logcat[-1][:18]
+    else:
+        logcat_datestr = '00-00 00:00:00.000'
+    raw_logcat = [unicode(x, 'UTF-8', errors='replace').strip()
+                  for x in raw_logcat]
+    current_logcat = []
+    prev_line_date = None
+    curr_line_date = None
+    curr_year = datetime.datetime.utcnow().year
+    hour = datetime.timedelta(hours=1)
+    for line in raw_logcat:
+        try:
+            curr_line_date = datetime.datetime.strptime('%4d-%s' % (
+                curr_year, line[:18]), '%Y-%m-%d %H:%M:%S.%f')
+        except ValueError:
+            curr_line_date = None
+        if curr_line_date and prev_line_date:
+            delta = curr_line_date - prev_line_date
+            prev_line_datestr = prev_line_date.strftime('%m-%d %H:%M:%S.%f')
+            if delta <= -hour:
+                current_logcat = [x for x in current_logcat
+                                  if not x < prev_line_datestr]
+            elif delta >= hour:
+                current_logcat = [x for x in current_logcat
+                                  if not x > prev_line_datestr]
+        if line >= logcat_datestr:
+            current_logcat.append(line)
+        prev_line_date = curr_line_date
+    accumulated_logcat_now = []
+    for x in accumulated_logcat:
+        if x[:18] == logcat_datestr:
+            accumulated_logcat_now.append(x)
+    current_logcat_now = []
+    current_logcat_after = []
+    for x in current_logcat:
+        if x[:18] == logcat_datestr:
+            current_logcat_now.append(x)
+        elif x > logcat_datestr:
+            current_logcat_after.append(x)
+    current_logcat_now = sorted(set(current_logcat_now).difference(
+        set(accumulated_logcat_now)))
+    current_logcat = current_logcat_now + current_logcat_after
+    accumulated_logcat += current_logcat
+    return current_logcat
+
+
+def benchmark_logcat(args):
+    """Compare the previous date based accumulation of logcat dumps
+    with LogcatBuffer on a synthetic logcat of args.lines lines. The
+    device's logcat buffer is modelled as a ring of args.buffer_lines
+    lines which is dumped after every args.poll_lines new lines."""
+    from logcatbuffer import LogcatBuffer
+
+    start_time = datetime.datetime(2017, 9, 17, 16, 45, 4)
+    logcat = []
+    for i in xrange(args.lines):
+        line_time = start_time + datetime.timedelta(milliseconds=7 * i)
+        if args.bogus_interval and i % args.bogus_interval == 0:
+            # Vold on some devices logs with a fixed bogus date.
+            datestr = '11-30 00:00:00.000'
+        else:
+            datestr = line_time.strftime('%m-%d %H:%M:%S.%f')[:18]
+        logcat.append('%s I/Autophone( %4d): synthetic message %d\r\n' %
+                      (datestr, i % 9999, i))
+    dumps = [logcat[max(0, end - args.buffer_lines):end]
+             for end in xrange(args.poll_lines, args.lines + args.poll_lines,
+                               args.poll_lines)]
+
+    accumulated_logcat = []
+    start = time.time()
+    for dump in dumps:
+        legacy_logcat_get(accumulated_logcat, dump)
+    report('logcat: date based get()', len(dumps), time.time() - start)
+    start = time.time()
+    full = list(accumulated_logcat)
+    report('logcat: date based get(full=True)', 1, time.time() - start)
+    print '%-40s %8d lines %10d bytes' % (
+        'logcat: date based accumulated', len(accumulated_logcat),
+        sys.getsizeof(accumulated_logcat) +
+        sum([sys.getsizeof(line) for line in accumulated_logcat]))
+
+    logcat_buffer = LogcatBuffer()
+    start = time.time()
+    for dump in dumps:
+        logcat_buffer.lines(logcat_buffer.accumulate(dump))
+    report('logcat: LogcatBuffer get()', len(dumps), time.time() - start)
+    start = time.time()
+    full = logcat_buffer.lines()
+    report('logcat: LogcatBuffer get(full=True)', 1, time.time() - start)
+    print '%-40s %8d lines %10d bytes' % (
+        'logcat: LogcatBuffer accumulated', len(full), logcat_buffer.size)
+
+
+class BenchmarkMailer(object):
+    def send(self, subject, body):
+        pass
+
+
+class BenchmarkTest(object):
+    """The attributes of a PhoneTest used by Jobs."""
+    def __init__(self, name):
+        self.name = name
+        self.config_file = 'configs/%s.ini' % name
+        self.chunk = 1
+        self.repos = ['mozilla-central']
+        self.enable_unittests = False
+        self.job_guid = None
+
+    @property
+    def jobs_key(self):
+        return (self.name, self.config_file, self.chunk, tuple(self.repos))
+
+
+class BenchmarkWorker(object):
+    """The attributes of a PhoneWorkerSubProcess used by Jobs."""
+    def __init__(self, tests):
+        self.tests = tests
+        self.tests_by_key = dict([(t.jobs_key, t) for t in tests])
+
+
+def jobs_worker(make_storage, device, args, start_event, results):
+    """Simulate a worker which queues args.jobs jobs for its device
+    and then runs them. The latency of each Jobs operation is put on
+    the results queue."""
+    import jobs
+
+    worker = BenchmarkWorker([BenchmarkTest('test%d' % i)
+                              for i in xrange(args.tests)])
+    jobs_db = jobs.Jobs(BenchmarkMailer(), default_device=device,
+                        storage=make_storage())
+    latencies = []
+
+    def timed(func, *args, **kwargs):
+        start = time.time()
+        result = func(*args, **kwargs)
+        latencies.append(time.time() - start)
+        return result
+
+    start_event.wait()
+    for i in xrange(args.jobs):
+        timed(jobs_db.new_job,
+              'https://example.com/%s/build%d/target.apk' % (device, i),
+              build_id='20170917164504', tree='mozilla-central',
+              tests=worker.tests, device=device)
+    while True:
+        job = timed(jobs_db.get_next_job, worker=worker)
+        if not job:
+            break
+        for test in job['tests']:
+            timed(jobs_db.test_completed, test.job_guid)
+        timed(jobs_db.job_completed, job['id'])
+    results.put(latencies)
+
+
+def benchmark_jobs(args):
+    """Compare the job storages when args.workers processes share
+    them: an sqlite database opened with a new connection with a
+    rollback journal for every Jobs operation, the pooled WAL
+    connections of SQLiteJobsStorage, a database per device with
+    ShardedSQLiteJobsStorage and the journaled MemoryJobsStorage
+    served by a separate process. Each simulated
+    worker queues args.jobs jobs of args.tests tests for its own
+    device and then runs them."""
+    import sqlite3
+    import jobs
+    import memoryjobs
+
+    class LegacySQLiteJobsStorage(jobs.SQLiteJobsStorage):
+        """SQLiteJobsStorage as it was before its connections were
+        pooled."""
+        def _conn(self):
+            return sqlite3.connect(self.filename)
+
+        def _release_connection(self, conn):
+            conn.close()
+
+    mailer = BenchmarkMailer()
+    cwd = os.getcwd()
+    for label, storage_class in (
+            ('jobs: sqlite connection per operation', LegacySQLiteJobsStorage),
+            ('jobs: sqlite pooled WAL connections', jobs.SQLiteJobsStorage),
+            ('jobs: sqlite sharded by device', jobs.ShardedSQLiteJobsStorage),
+            ('jobs: memory journaled', None)):
+        db_dir = tempfile.mkdtemp()
+        os.chdir(db_dir)
+        try:
+            # Create the databases or start the storage process before
+            # the workers start. The workers inherit the memory
+            # storage's proxy.
+            if storage_class:
+                storage = storage_class(mailer)
+                make_storage = lambda: storage_class(mailer)
+            else:
+                storage = memoryjobs.start_storage()
+                make_storage = lambda: storage
+            for i in xrange(args.workers):
+                storage.jobs_pending('device%02d' % i)
+            start_event = multiprocessing.Event()
+            results = multiprocessing.Queue()
+            processes = [
+                multiprocessing.Process(
+                    target=jobs_worker,
+                    args=(make_storage, 'device%02d' % i, args, start_event,
+                          results))
+                for i in xrange(args.workers)]
+            for process in processes:
+                process.start()
+            start = time.time()
+            start_event.set()
+            latencies = []
+            for process in processes:
+                latencies.extend(results.get())
+            elapsed = time.time() - start
+            for process in processes:
+                process.join()
+            latencies.sort()
+            report(label, len(latencies), elapsed)
+            print '%-40s %8.1f ms median %8.1f ms p99 %8.1f ms max' % (
+                '', 1000 * latencies[len(latencies) / 2],
+                1000 * latencies[int(len(latencies) * 0.99)],
+                1000 * latencies[-1])
+            # Stop the memory storage's process.
+            make_storage = storage = None
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(db_dir)
+
+
+class BenchmarkJobCollection(object):
+    """The attributes of a TreeherderJobCollection used by Jobs."""
+    def __init__(self, data):
+        self.data = data
+
+    def to_json(self):
+        return json.dumps(self.data)
+
+
+def check_storage(storage, reopen):
+    """Check that the storage implements the semantics of the
+    JobsStorage interface. reopen(storage) returns the storage which
+    is used after the point where a process may have been restarted.
+    Returns the number of checks."""
+    import jobs
+    import jobscheduler
+
+    class ConformanceJobs(jobs.Jobs):
+        clock = 0
+
+        def _now(self):
+            return (datetime.datetime(2017, 9, 17) +
+                    datetime.timedelta(seconds=self.clock)).isoformat()
+
+    checks = [0]
+
+    def check(condition, description):
+        checks[0] += 1
+        if not condition:
+            raise Exception('check %d failed: %s' % (checks[0], description))
+
+    worker = BenchmarkWorker([BenchmarkTest('test0'), BenchmarkTest('test1')])
+    tests = worker.tests
+    worker2 = BenchmarkWorker([BenchmarkTest('test0'), BenchmarkTest('test1')])
+
+    def new_jobs(storage, **kwargs):
+        return ConformanceJobs(BenchmarkMailer(), default_device='device1',
+                               storage=storage, **kwargs)
+
+    def build(name, tree='mozilla-central'):
+        return {'build_url': 'https://example.com/%s/%s/target.apk' % (
+            tree, name), 'tree': tree, 'changeset_dirs': ['dom']}
+
+    # Queueing.
+    jobs_db = new_jobs(storage)
+    jobs_db.clear_all()
+    # Each device is given its own tests since queueing sets the
+    # tests' guids.
+    queued = jobs_db.enqueue_many(build('a'), [('device1', tests),
+                                               ('device2', worker2.tests)])
+    check(sorted(queued) == ['device1', 'device2'] and
+          [len(queued[d]) for d in sorted(queued)] == [2, 2],
+          'enqueue_many queues the tests of each device')
+    guids = dict([(t.name, t.job_guid) for t in tests])
+    check(jobs_db.jobs_pending('device1') == 1, 'one job per device and build')
+    queued = jobs_db.enqueue_many(build('a'), [('device1', tests)])
+    check(queued == {'device1': []}, 'duplicate tests are not queued')
+    check(jobs_db.jobs_pending('device1') == 1, 'the job is reused')
+    for t in tests:
+        t.job_guid = guids[t.name]
+    jobs_db.clock = 10
+    queued = jobs_db.new_job(build('b', tree='try')['build_url'], tree='try',
+                             tests=tests[:1], device='device1')
+    check(len(queued) == 1, 'new_job queues the tests')
+    check(jobs_db.jobs_pending('device1') == 2, 'new_job queues a job')
+
+    # Claiming, cancelling and completing.
+    storage = reopen(storage)
+    jobs_db = new_jobs(storage)
+    job = jobs_db.get_next_job(device='device1', worker=worker)
+    check(job['tree'] == 'try' and job['istry'] and job['attempts'] == 1,
+          'try jobs are claimed first')
+    check([t.name for t in job['tests']] == ['test0'],
+          'the claimed job has its tests')
+    jobs_db.cancel_test(job['tests'][0].job_guid, device='device1')
+    check(jobs_db.jobs_pending('device1') == 1,
+          'cancelling the last test deletes the job')
+    jobs_db.clock = 100
+    job = jobs_db.get_next_job(device='device1', worker=worker)
+    check(job['build_url'] == build('a')['build_url'] and
+          job['changeset_dirs'] == ['dom'] and
+          job['last_attempt'] == jobs_db._now(),
+          'the oldest job is claimed next')
+    check(sorted([(t.name, t.job_guid) for t in job['tests']]) ==
+          sorted(guids.items()), 'the tests keep their guids')
+    jobs_db.test_completed(guids['test0'])
+    storage = reopen(storage)
+    jobs_db = new_jobs(storage)
+    jobs_db.clock = 160
+    jobs_db.job_completed(job['id'])
+    check(jobs_db.get_next_job(device='device1', worker=worker) is None,
+          'completed jobs are deleted')
+
+    # The runtime of the completed job is used by the cost scheduler
+    # to prefer a newer job for the same tree over an older job for a
+    # tree without a runtime.
+    jobs_db = new_jobs(storage,
+                       scheduler=jobscheduler.CostAwareScheduler({}))
+    jobs_db.enqueue_many(build('c', tree='mozilla-inbound'),
+                         [('device1', tests)])
+    jobs_db.clock = 200
+    jobs_db.enqueue_many(build('d'), [('device1', tests)])
+    job = jobs_db.get_next_job(device='device1', worker=worker)
+    check(job['tree'] == 'mozilla-central', 'runtimes are recorded')
+    jobs_db.job_completed(job['id'])
+    job = jobs_db.get_next_job(device='device1', worker=worker)
+    check(job['tree'] == 'mozilla-inbound', 'the remaining job is claimed')
+    jobs_db.job_completed(job['id'])
+
+    # Expiring.
+    job = jobs_db.get_next_job(device='device2', worker=worker2)
+    jobs_db.set_job_attempts(job['id'], jobs_db.MAX_ATTEMPTS,
+                             device='device2')
+    check(jobs_db.get_next_job(device='device2', worker=worker2) is None,
+          'jobs with MAX_ATTEMPTS attempts are not claimed')
+    check(jobs_db.jobs_pending('device2') == 1, 'expired jobs are kept')
+    jobs_db.delete_expired_jobs('device2')
+    check(jobs_db.jobs_pending('device2') == 0, 'expired jobs are deleted')
+
+    # Coalescing and backfilling.
+    jobs_db = new_jobs(storage, coalesce_backlog=1)
+    coalesced = []
+    for i, name in enumerate(['e', 'f', 'g']):
+        jobs_db.clock = 300 + i
+        jobs_db.enqueue_many(build(name), [('device3', tests)])
+        coalesced.extend(jobs_db.coalesce(build(name)['build_url'],
+                                          ['device3']))
+    check([j['build_url'] for j in coalesced] ==
+          [build('e')['build_url'], build('f')['build_url']],
+          'the previous builds are coalesced')
+    check(sorted([t[0] for t in coalesced[0]['tests']]) == ['test0', 'test1'] and
+          coalesced[0]['device'] == 'device3' and
+          coalesced[0]['changeset_dirs'] == ['dom'],
+          'coalesced jobs have their tests')
+    check(jobs_db.jobs_pending('device3') == 1, 'coalesced jobs are not pending')
+    storage = reopen(storage)
+    jobs_db = new_jobs(storage, coalesce_backlog=1)
+    job = jobs_db.get_next_job(device='device3', worker=worker)
+    check(job['build_url'] == build('g')['build_url'],
+          'coalesced jobs are not claimed')
+    jobs_db.job_completed(job['id'], device='device3')
+    worker3 = BenchmarkWorker([BenchmarkTest('test0')])
+    queued = jobs_db.new_job(build('e')['build_url'], tree='mozilla-central',
+                             tests=worker3.tests, device='device3')
+    check(len(queued) == 1 and jobs_db.jobs_pending('device3') == 1,
+          'a coalesced build can be queued again')
+    job = jobs_db.get_next_job(device='device3', worker=worker3)
+    check(job['build_url'] == build('e')['build_url'],
+          'the queued again build is claimed')
+    jobs_db.job_completed(job['id'], device='device3')
+    backfilled = jobs_db.backfill('device3', 'mozilla-central')
+    check([j['build_url'] for j in backfilled] ==
+          [j['build_url'] for j in coalesced] and
+          backfilled[0]['tests'] == coalesced[0]['tests'],
+          'backfill returns the coalesced jobs')
+    check(jobs_db.backfill() == [], 'backfill deletes the coalesced jobs')
+
+    # Expiring coalesced jobs.
+    jobs_db = new_jobs(storage, coalesce_backlog=1, coalesce_expires=1)
+    for i, name in enumerate(['i', 'j', 'k']):
+        jobs_db.clock = 400 + i
+        jobs_db.enqueue_many(build(name), [('device4', tests)])
+        jobs_db.coalesce(build(name)['build_url'], ['device4'])
+    jobs_db.clock = 400 + 86400
+    jobs_db.delete_expired_jobs('device4')
+    check(len(jobs_db.backfill('device4')) == 2,
+          'coalesced jobs are kept for coalesce_expires days')
+    jobs_db.clock = 500
+    jobs_db.enqueue_many(build('l'), [('device4', tests)])
+    jobs_db.coalesce(build('l')['build_url'], ['device4'])
+    jobs_db.clock = 402 + 86401
+    jobs_db.delete_expired_jobs('device4')
+    check(jobs_db.backfill('device4') == [] and
+          jobs_db.jobs_pending('device4') == 1,
+          'coalesced jobs older than coalesce_expires days are deleted')
+
+    # The Treeherder outbox.
+    for i in xrange(3):
+        jobs_db.new_treeherder_job('device1', 'project',
+                                   BenchmarkJobCollection([{'job': i}]))
+    requests = jobs_db.get_treeherder_jobs(2)
+    check([(r['job_collection'], r['attempts'], r['machine'], r['project'])
+           for r in requests] ==
+          [([{'job': 0}], 1, 'device1', 'project'),
+           ([{'job': 1}], 1, 'device1', 'project')],
+          'the oldest requests are returned')
+    storage = reopen(storage)
+    jobs_db = new_jobs(storage)
+    check([r['attempts'] for r in jobs_db.get_treeherder_jobs(5)] == [2, 2, 1],
+          'the attempts of the requests are counted')
+    jobs_db.treeherder_jobs_completed([r['id'] for r in requests])
+    requests = jobs_db.get_treeherder_jobs(5)
+    check([r['job_collection'] for r in requests] == [[{'job': 2}]],
+          'completed requests are deleted')
+
+    jobs_db.enqueue_many(build('h'), [('device1', tests)])
+    jobs_db.clear_all()
+    check(jobs_db.jobs_pending('device1') == 0 and
+          jobs_db.get_treeherder_jobs(5) == [],
+          'clear_all deletes the jobs and requests')
+    return checks[0]
+
+
+def benchmark_storage(args):
+    """Check that each job storage implements the JobsStorage
+    interface in the same way. The sqlite databases are reopened and
+    the in-process memory storage is recovered from its journal and
+    snapshot, with an incomplete change at the end of the journal, at
+    the points where a process may be restarted."""
+    import jobs
+    import memoryjobs
+
+    class SnapshotMemoryJobsStorage(memoryjobs.MemoryJobsStorage):
+        SNAPSHOT_INTERVAL = 3
+
+    def reopen_memory(storage):
+        with open(storage.journal_path, 'a') as journal:
+            journal.write('[["clear"')
+        return storage.__class__()
+
+    mailer = BenchmarkMailer()
+    cwd = os.getcwd()
+    for label, make_storage, reopen in (
+            ('storage: sqlite', lambda: jobs.SQLiteJobsStorage(mailer),
+             lambda storage: jobs.SQLiteJobsStorage(mailer)),
+            ('storage: sqlite sharded',
+             lambda: jobs.ShardedSQLiteJobsStorage(mailer),
+             lambda storage: jobs.ShardedSQLiteJobsStorage(mailer)),
+            ('storage: memory', memoryjobs.MemoryJobsStorage, reopen_memory),
+            ('storage: memory with snapshots', SnapshotMemoryJobsStorage,
+             reopen_memory),
+            ('storage: memory process', memoryjobs.start_storage,
+             lambda storage: storage)):
+        db_dir = tempfile.mkdtemp()
+        os.chdir(db_dir)
+        try:
+            start = time.time()
+            checks = check_storage(make_storage(), reopen)
+            print '%-40s %8d checks passed %10.3f s' % (
+                label, checks, time.time() - start)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(db_dir)
+
+
+class BenchmarkTreeherderOptions(object):
+    treeherder_url = 'https://treeherder.example.com'
+    treeherder_client_id = None
+    treeherder_secret = None
+    treeherder_retry_wait = 0
+
+
+class BenchmarkTreeherderClient(object):
+    """Posts collections to nowhere after args.latency seconds."""
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = multiprocessing.Lock()
+        self.posts = 0
+        self.jobs = 0
+
+    def post_collection(self, project, job_collection):
+        time.sleep(self.latency)
+        with self.lock:
+            self.posts += 1
+            self.jobs += len(job_collection.data)
+
+
+def benchmark_treeherder(args):
+    """Compare posting the queued Treeherder requests one at a time
+    with the batched posts of AutophoneTreeherder.post_queued_requests
+    after an outage during which the pending, running and completed
+    submissions of args.jobs jobs over args.projects projects were
+    queued. Each job starts running after the following args.backlog
+    jobs have been queued. Each post takes args.latency seconds."""
+    from multiprocessing.pool import ThreadPool
+    from thclient import TreeherderJob, TreeherderJobCollection
+    import jobs
+    from autophonetreeherder import AutophoneTreeherder
+
+    def drain_one_at_a_time(treeherder):
+        while True:
+            requests = treeherder.jobs.get_treeherder_jobs(1)
+            if not requests:
+                break
+            request = requests[0]
+            tjc = TreeherderJobCollection()
+            for data in request['job_collection']:
+                tjc.add(TreeherderJob(data))
+            if treeherder.post_request(request['machine'], request['project'],
+                                       tjc, request['attempts'],
+                                       request['last_attempt']):
+                treeherder.jobs.treeherder_jobs_completed([request['id']])
+
+    def drain_batched(treeherder):
+        pool = ThreadPool(treeherder.POST_THREADS)
+        try:
+            while treeherder.post_queued_requests(pool) is not None:
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+    submissions = []
+    for i in xrange(args.jobs):
+        guid = str(uuid.uuid4())
+        project = 'project%d' % (i % args.projects)
+        submissions.append((i, guid, project, 'pending'))
+        submissions.append((i + args.backlog, guid, project, 'running'))
+        submissions.append((i + args.backlog, guid, project, 'completed'))
+    submissions.sort(key=lambda submission: submission[0])
+    cwd = os.getcwd()
+    for label, drain in (('treeherder: one request at a time',
+                          drain_one_at_a_time),
+                         ('treeherder: batched', drain_batched)):
+        db_dir = tempfile.mkdtemp()
+        os.chdir(db_dir)
+        try:
+            jobs_db = jobs.Jobs(BenchmarkMailer())
+            treeherder = AutophoneTreeherder(None, BenchmarkTreeherderOptions(),
+                                             jobs_db)
+            treeherder.client = BenchmarkTreeherderClient(args.latency)
+            for i, guid, project, state in submissions:
+                tjc = TreeherderJobCollection()
+                tjc.add(TreeherderJob({'project': project,
+                                       'job': {'job_guid': guid,
+                                               'state': state}}))
+                treeherder.queue_request('device', project, tjc)
+            start = time.time()
+            drain(treeherder)
+            elapsed = time.time() - start
+            report(label, treeherder.client.posts, elapsed)
+            print '%-40s %8d jobs posted %8d requests left' % (
+                '', treeherder.client.jobs,
+                len(jobs_db.get_treeherder_jobs(len(submissions))))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(db_dir)
+
+
+def benchmark_schedule(args):
+    """Simulate a device's job queue for args.days days and report the
+    latency from queueing to starting the jobs of each repository for
+    each of the job schedulers. Builds arrive at the daily rates given
+    by args.rates as Poisson processes and each job runs for a random
+    time between half and one and a half times args.runtime minutes.
+    The jobs database is used as in production except that time is
+    simulated. Jobs are coalesced as by the job_coalesce_backlog and
+    job_coalesce_sample options if args.coalesce_backlog is set."""
+    import collections
+    import random
+    import jobs
+    import jobscheduler
+
+    class SimulatedJobs(jobs.Jobs):
+        clock = 0
+
+        def _now(self):
+            return (start_time +
+                    datetime.timedelta(seconds=self.clock)).isoformat()
+
+    start_time = datetime.datetime(2017, 9, 17)
+    duration = args.days * 86400
+    random.seed(args.seed)
+    arrivals = []
+    for item in args.rates:
+        repo, rate = item.rsplit(':', 1)
+        arrival = random.expovariate(float(rate) / 86400)
+        while arrival < duration:
+            arrivals.append((arrival, repo,
+                             random.uniform(0.5, 1.5) * args.runtime * 60))
+            arrival += random.expovariate(float(rate) / 86400)
+    arrivals.sort()
+    repos = sorted(set([entry[1] for entry in arrivals]))
+    print '%d builds in %d days, device capacity %d jobs per day' % (
+        len(arrivals), args.days, 86400 / (args.runtime * 60))
+
+    cwd = os.getcwd()
+    for label, scheduler in (('fifo', jobscheduler.FifoScheduler()),
+                             ('cost', jobscheduler.CostAwareScheduler())):
+        db_dir = tempfile.mkdtemp()
+        os.chdir(db_dir)
+        try:
+            jobs_db = SimulatedJobs(BenchmarkMailer(), default_device='device',
+                                    scheduler=scheduler,
+                                    coalesce_backlog=args.coalesce_backlog,
+                                    coalesce_sample=args.coalesce_sample)
+            worker = BenchmarkWorker([BenchmarkTest('test')])
+            runtimes = {}
+            latencies = collections.defaultdict(list)
+            coalesced = 0
+            now = 0
+            next_arrival = 0
+            job = None
+            job_end = 0
+            while True:
+                while (next_arrival < len(arrivals) and
+                       arrivals[next_arrival][0] <= now):
+                    arrival, repo, runtime = arrivals[next_arrival]
+                    build_url = 'https://example.com/%s/%d/target.apk' % (
+                        repo, next_arrival)
+                    runtimes[build_url] = runtime
+                    jobs_db.clock = arrival
+                    jobs_db.enqueue_many({'build_url': build_url, 'tree': repo},
+                                         [('device', worker.tests)])
+                    coalesced += len(jobs_db.coalesce(build_url, ['device']))
+                    next_arrival += 1
+                jobs_db.clock = now
+                if job and job_end <= now:
+                    jobs_db.job_completed(job['id'])
+                    job = None
+                if not job:
+                    job = jobs_db.get_next_job(worker=worker)
+                    if job:
+                        created = datetime.datetime.strptime(
+                            job['created'], '%Y-%m-%dT%H:%M:%S.%f')
+                        latencies[job['tree']].append(
+                            now - (created - start_time).total_seconds())
+                        job_end = now + runtimes[job['build_url']]
+                events = []
+                if next_arrival < len(arrivals):
+                    events.append(arrivals[next_arrival][0])
+                if job:
+                    events.append(job_end)
+                if not events or min(events) >= duration:
+                    break
+                now = min(events)
+            print '%s: %d jobs run, %d jobs coalesced, %d jobs queued at the end' % (
+                label, sum([len(x) for x in latencies.values()]), coalesced,
+                jobs_db.jobs_pending())
+            for repo in repos:
+                repo_latencies = sorted(latencies[repo])
+                if not repo_latencies:
+                    print '  %-20s no jobs run' % repo
+                    continue
+                print '  %-20s %5d jobs %8.2f h median %8.2f h p90 latency' % (
+                    repo, len(repo_latencies),
+                    repo_latencies[len(repo_latencies) / 2] / 3600,
+                    repo_latencies[int(len(repo_latencies) * 0.9)] / 3600)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(db_dir)
+
+
+parser = argparse.ArgumentParser(description="Autophone micro benchmarks.")
+subparsers = parser.add_subparsers(title='benchmarks')
+
+adb_server_parser = subparsers.add_parser(
+    'adb-server',
+    help='Compare forked adb shell commands with the adb server socket.')
+adb_server_parser.add_argument("--iterations",
+                               type=int,
+                               default=500,
+                               help="number of shell commands. (default: 500)")
+adb_server_parser.add_argument("--files",
+                               type=int,
+                               default=200,
+                               help="number of files to push. (default: 200)")
+adb_server_parser.add_argument("--file-size",
+                               type=int,
+                               default=4096,
+                               help="size of each pushed file. (default: 4096)")
+adb_server_parser.add_argument("--adb",
+                               default=None,
+                               help="path to adb to time forked adb shell "
+                               "commands. (default: time /bin/sh -c)")
+adb_server_parser.add_argument("--adb-port",
+                               type=int,
+                               default=None,
+                               help="port of a real adb server. (default: "
+                               "start a fake adb server)")
+adb_server_parser.add_argument("--serial",
+                               default=None,
+                               help="device serial number when using a real "
+                               "adb server.")
+adb_server_parser.set_defaults(func=benchmark_adb_server)
+
+wait_parser = subparsers.add_parser(
+    'wait',
+    help='Compare polling and exit pipe waits for short commands.')
+wait_parser.add_argument("--iterations",
+                         type=int,
+                         default=2000,
+                         help="number of commands. (default: 2000)")
+wait_parser.add_argument("--command",
+                         default="true",
+                         help="shell command to execute. (default: true)")
+wait_parser.add_argument("--polling-interval",
+                         type=float,
+                         default=0.1,
+                         help="polling interval in seconds. (default: 0.1)")
+wait_parser.set_defaults(func=benchmark_wait)
+
+push_tree_parser = subparsers.add_parser(
+    'push-tree',
+    help='Compare adb push with push_tree on a device.')
+push_tree_parser.add_argument("--files",
+                              type=int,
+                              default=1000,
+                              help="number of files to push. (default: 1000)")
+push_tree_parser.add_argument("--dirs",
+                              type=int,
+                              default=20,
+                              help="number of directories containing the "
+                              "files. (default: 20)")
+push_tree_parser.add_argument("--file-size",
+                              type=int,
+                              default=2048,
+                              help="size of each pushed file. (default: 2048)")
+push_tree_parser.add_argument("--serial",
+                              default=None,
+                              help="device serial number. (default: the only "
+                              "attached device)")
+push_tree_parser.set_defaults(func=benchmark_push_tree)
+
+logcat_parser = subparsers.add_parser(
+    'logcat',
+    help='Compare logcat accumulation on a synthetic logcat.')
+logcat_parser.add_argument("--lines",
+                           type=int,
+                           default=500000,
+                           help="number of logcat lines. (default: 500000)")
+logcat_parser.add_argument("--buffer-lines",
+                           type=int,
+                           default=20000,
+                           help="number of lines held by the device's logcat "
+                           "buffer. (default: 20000)")
+logcat_parser.add_argument("--poll-lines",
+                           type=int,
+                           default=5000,
+                           help="number of new lines between dumps. "
+                           "(default: 5000)")
+logcat_parser.add_argument("--bogus-interval",
+                           type=int,
+                           default=1000,
+                           help="interval between lines with a bogus MM-DD "
+                           "date. 0 disables them. (default: 1000)")
+logcat_parser.set_defaults(func=benchmark_logcat)
+
+jobs_parser = subparsers.add_parser(
+    'jobs',
+    help='Compare the job storages shared by worker processes.')
+jobs_parser.add_argument("--workers",
+                         type=int,
+                         default=20,
+                         help="number of simulated workers. (default: 20)")
+jobs_parser.add_argument("--jobs",
+                         type=int,
+                         default=50,
+                         help="number of jobs per worker. (default: 50)")
+jobs_parser.add_argument("--tests",
+                         type=int,
+                         default=3,
+                         help="number of tests per job. (default: 3)")
+jobs_parser.set_defaults(func=benchmark_jobs)
+
+treeherder_parser = subparsers.add_parser(
+    'treeherder',
+    help='Compare draining the queued Treeherder requests one at a time '
+    'with batched posts.')
+treeherder_parser.add_argument("--jobs",
+                               type=int,
+                               default=1000,
+                               help="number of jobs queued during the outage. "
+                               "(default: 1000)")
+treeherder_parser.add_argument("--projects",
+                               type=int,
+                               default=3,
+                               help="number of projects. (default: 3)")
+treeherder_parser.add_argument("--backlog",
+                               type=int,
+                               default=50,
+                               help="number of jobs queued before each job "
+                               "runs. (default: 50)")
+treeherder_parser.add_argument("--latency",
+                               type=float,
+                               default=0.05,
+                               help="seconds taken by each post. "
+                               "(default: 0.05)")
+treeherder_parser.set_defaults(func=benchmark_treeherder)
+
+storage_parser = subparsers.add_parser(
+    'storage',
+    help='Check that the job storages behave in the same way.')
+storage_parser.set_defaults(func=benchmark_storage)
+
+schedule_parser = subparsers.add_parser(
+    'schedule',
+    help='Simulate the job latency per repository of the job schedulers.')
+schedule_parser.add_argument("--rates",
+                             nargs='+',
+                             default=['autoland:100', 'mozilla-inbound:30',
+                                      'mozilla-central:4', 'mozilla-beta:2',
+                                      'try:10'],
+                             help="repo:builds per day. (default: "
+                             "autoland:100 mozilla-inbound:30 "
+                             "mozilla-central:4 mozilla-beta:2 try:10)")
+schedule_parser.add_argument("--runtime",
+                             type=float,
+                             default=12,
+                             help="average job runtime in minutes. "
+                             "(default: 12)")
+schedule_parser.add_argument("--days",
+                             type=int,
+                             default=3,
+                             help="number of days to simulate. (default: 3)")
+schedule_parser.add_argument("--seed",
+                             type=int,
+                             default=1,
+                             help="random seed. (default: 1)")
+schedule_parser.add_argument("--coalesce-backlog",
+                             dest="coalesce_backlog",
+                             type=int,
+                             default=0,
+                             help="coalesce jobs when more than this number "
+                             "of jobs are pending. (default: 0, disabled)")
+schedule_parser.add_argument("--coalesce-sample",
+                             dest="coalesce_sample",
+                             type=int,
+                             default=0,
+                             help="run one in every coalesce-sample "
+                             "superseded builds. (default: 0)")
+schedule_parser.set_defaults(func=benchmark_schedule)
+
+args = parser.parse_args()
+args.func(args)
@@ -5,6 +5,7 @@
 import ConfigParser
 import Queue
 import SocketServer
+import copy
 import datetime
 import errno
 import inspect
@@ -32,6 +33,7 @@ from manifestparser import TestManifest
 import builds
 import buildserver
 import jobs
+import jobscheduler
 import utils
 
 from adb import ADBHost
@@ -107,8 +109,19 @@ class AutoPhone(object):
         self.loglevel = loglevel
         self.mailer = Mailer(options.emailcfg, '[autophone] ')
 
+        # The workers' job scheduler is created here as well so that
+        # invalid scheduler options are reported at startup. The job
+        # storage is created before the workers so that they share it.
         self.jobs = jobs.Jobs(self.mailer,
-                              allow_duplicates=options.allow_duplicate_jobs)
+                              allow_duplicates=options.allow_duplicate_jobs,
+                              scheduler=jobscheduler.get_scheduler(
+                                  options.job_scheduler,
+                                  options.job_repo_weights),
+                              coalesce_backlog=options.job_coalesce_backlog,
+                              coalesce_sample=options.job_coalesce_sample,
+                              coalesce_expires=options.job_coalesce_expires,
+                              storage=jobs.get_storage(options.job_storage,
+                                                       self.mailer))
         self.phone_workers = {}  # indexed by phone id
         self.lock = threading.RLock()
         self._tests = []
@@ -402,6 +415,9 @@ class AutoPhone(object):
             for p in self.phone_workers.values():
                 p.stop()
                 self.purge_worker(p.phone.id)
+            # Stop the job storage's process, if any, before exiting
+            # or restarting.
+            jobs.stop_storage(self.jobs.storage)
             self.lock_release()
 
         if self.unrecoverable_error and self.options.reboot_on_error:
@@ -443,18 +459,17 @@ class AutoPhone(object):
             os.execvp(sys.executable, newargv)
 
     # Start the phones for testing
-    def new_job(self, job_data):
+    def new_job(self, job_data, coalesce=False):
         LOGGER.info('new_job: %s', job_data)
         app_name = job_data['app_name']
         build_url = job_data['build']
         tests = job_data['tests']
 
         phoneids = set([test.phone.id for test in tests])
+        device_tests = []
         for phoneid in phoneids:
-            p = self.phone_workers[phoneid]
             LOGGER.info('new_job for worker phoneid %s', phoneid)
-            # Determine if we will test this build, which tests to run and if we
-            # need to enable unittests.
+            # Determine if we will test this build and which tests to run.
             runnable_tests = PhoneTest.match(app_name=app_name,
                                              tests=tests,
                                              phoneid=phoneid,
@@ -466,40 +481,97 @@ class AutoPhone(object):
             if not runnable_tests:
                 LOGGER.info('new_job: Ignoring build %s for phone %s', build_url, phoneid)
                 continue
-            enable_unittests = False
-            for t in runnable_tests:
-                enable_unittests = enable_unittests or t.enable_unittests
-
-            new_tests = self.jobs.new_job(build_url,
-                                          build_id=job_data['build_id'],
-                                          build_type=job_data['build_type'],
-                                          build_platform=job_data['platform'],
-                                          build_abi=job_data['abi'],
-                                          build_sdk=job_data['sdk'],
-                                          tree=job_data['repo'],
-                                          changeset=job_data['changeset'],
-                                          changeset_dirs=job_data['changeset_dirs'],
-                                          revision=job_data['revision'],
-                                          builder_type=job_data['builder_type'],
-                                          tests=runnable_tests,
-                                          enable_unittests=enable_unittests,
-                                          device=phoneid)
-            if new_tests:
+            device_tests.append((phoneid, runnable_tests))
+
+        self.queue_jobs({'build_url': build_url,
+                         'build_id': job_data['build_id'],
+                         'build_type': job_data['build_type'],
+                         'build_platform': job_data['platform'],
+                         'build_abi': job_data['abi'],
+                         'build_sdk': job_data['sdk'],
+                         'tree': job_data['repo'],
+                         'changeset': job_data['changeset'],
+                         'changeset_dirs': job_data['changeset_dirs'],
+                         'revision': job_data['revision'],
+                         'builder_type': job_data['builder_type']},
+                        device_tests)
+        if coalesce:
+            self.coalesce_jobs(build_url,
+                               [device for device, _ in device_tests])
+
+    def queue_jobs(self, build, device_tests):
+        """Queue the build's tests for each of the (device, tests) in
+        device_tests, report them as pending to Treeherder and notify
+        the devices' workers."""
+        build_url = build['build_url']
+        # Queue the jobs for all of the devices in one transaction.
+        new_tests = self.jobs.enqueue_many(build, device_tests)
+
+        for phoneid, runnable_tests in device_tests:
+            if new_tests[phoneid]:
                 self.treeherder.submit_pending(phoneid,
                                                build_url,
-                                               job_data['repo'],
-                                               job_data['revision'],
-                                               job_data['build_type'],
-                                               job_data['platform'],
-                                               job_data['abi'],
-                                               job_data['sdk'],
-                                               job_data['builder_type'],
-                                               tests=new_tests)
+                                               build['tree'],
+                                               build['revision'],
+                                               build['build_type'],
+                                               build['build_abi'],
+                                               build['build_platform'],
+                                               build['build_sdk'],
+                                               build['builder_type'],
+                                               tests=new_tests[phoneid])
                 LOGGER.info('new_job: Notifying device %s of new job '
-                            '%s for tests %s, enable_unittests=%s.',
-                            phoneid, build_url, runnable_tests,
-                            enable_unittests)
-                p.new_job()
+                            '%s for tests %s.',
+                            phoneid, build_url, runnable_tests)
+                self.phone_workers[phoneid].new_job()
+
+    def coalesce_jobs(self, build_url, phoneids):
+        """Skip the jobs superseded by build_url's jobs on backlogged
+        devices and report their tests to Treeherder as cancelled. See
+        Jobs.coalesce()."""
+        for job in self.jobs.coalesce(build_url, phoneids):
+            tests = []
+            for name, config_file, chunk, guid in job['tests']:
+                test = PhoneTest.lookup(job['device'], config_file, chunk)
+                if not test:
+                    continue
+                test = copy.copy(test)
+                test.job_guid = guid
+                tests.append(test)
+            LOGGER.info('coalesce_jobs: device %s skipped build %s '
+                        'superseded by %s', job['device'], job['build_url'],
+                        build_url)
+            self.treeherder.submit_coalesced(job['device'],
+                                             job['build_url'],
+                                             job['tree'],
+                                             job['revision'],
+                                             job['build_type'],
+                                             job['build_abi'],
+                                             job['build_platform'],
+                                             job['build_sdk'],
+                                             job['builder_type'],
+                                             tests=tests)
+
+    def backfill(self, params):
+        """Queue the jobs skipped by coalescing again.
+
+        :param params: '<devicename>|all [<repo>]'.
+        """
+        phoneid, space, repo = params.partition(' ')
+        if phoneid.lower() == 'all':
+            phoneid = None
+        elif phoneid not in self.phone_workers:
+            return 'error: phone not found'
+        count = 0
+        for job in self.jobs.backfill(device=phoneid, tree=repo.strip()):
+            tests = []
+            for name, config_file, chunk, guid in job.pop('tests'):
+                test = PhoneTest.lookup(job['device'], config_file, chunk)
+                if test:
+                    tests.append(test)
+            if tests and job['device'] in self.phone_workers:
+                self.queue_jobs(job, [(job.pop('device'), tests)])
+                count += 1
+        return 'backfilled %d jobs\nok' % count
 
     def route_cmd(self, data):
         response = ''
@@ -571,6 +643,8 @@ class AutoPhone(object):
             LOGGER.info(params)
         elif cmd == 'autophone-triggerjobs':
             response = self.trigger_jobs(params)
+        elif cmd == 'autophone-backfill':
+            response = self.backfill(params)
         elif cmd == 'autophone-status':
             response = 'state: %s\n' % self.state
             phoneids = self.phone_workers.keys()
@@ -590,6 +664,10 @@ autophone-add-device <devicename> <serialno>
     the name given to the device in the devices.ini file while
     <serialno> is its adb serial number.
 
+autophone-backfill <devicename>|all [<repo>]
+    Queue the jobs which were skipped by coalescing again for the
+    device or all devices, optionally only those for the repository.
+
 autophone-restart
     Shutdown each worker after its current test, then restart
     autophone.
@@ -703,7 +781,9 @@ ok
                              self.options,
                              self.queue,
                              self.loglevel,
-                             self.mailer)
+                             self.mailer,
+                             treeherder_requests_queued=self.treeherder.requests_queued,
+                             jobs_storage=self.jobs.storage)
         self.phone_workers[phone.id] = worker
         return worker
 
@@ -788,10 +868,14 @@ ok
                     device=serialno,
                     device_ready_retry_wait=self.options.device_ready_retry_wait,
                     device_ready_retry_attempts=self.options.device_ready_retry_attempts,
+                    use_adb_server_socket=self.options.adb_server_socket,
+                    spool_size=self.options.adb_spool_size or None,
+                    property_cache_dir=self.options.device_property_cache_dir or None,
                     logger_name=device_name,
                     verbose=self.options.verbose,
                     test_root=test_root)
                 dm._logger = utils.getLogger(name=device_name)
+                dm.process_list_ttl = self.options.device_process_list_ttl
                 device = {"device_name": device_name,
                           "serialno": serialno,
                           "dm" : dm}
@@ -1047,7 +1131,7 @@ ok
                 'sdk': sdk,
                 'tests': tests,
             }
-            self.new_job(job_data)
+            self.new_job(job_data, coalesce=True)
         finally:
             pass
 
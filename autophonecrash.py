@@ -300,13 +300,14 @@ class AutophoneCrashProcessor(object):
         # only process them once.
         temp_upload_dir = tempfile.mkdtemp()
         self.adb.chmod(self.remote_dump_dir, recursive=True, root=root)
-        self.adb.pull(self.remote_dump_dir, temp_upload_dir)
+        self.adb.pull_tree(self.remote_dump_dir, temp_upload_dir, root=root)
         if clean:
             self.adb.rm(self.remote_dump_dir + "/*", force=True, root=True)
         if self.adb.is_dir(self.remote_pending_crashreports_dir, root=root):
             self.adb.chmod(self.remote_pending_crashreports_dir, recursive=True,
                            root=root)
-            self.adb.pull(self.remote_pending_crashreports_dir, temp_upload_dir)
+            self.adb.pull_tree(self.remote_pending_crashreports_dir,
+                               temp_upload_dir, root=root)
             if clean:
                 self.adb.rm(self.remote_pending_crashreports_dir + "/*", force=True, root=True)
         dump_files = [(path, os.path.splitext(path)[0] + '.extra') for path in
@@ -5,16 +5,20 @@
 import calendar
 import datetime
 import json
+import multiprocessing
 import os
 import re
 import time
 import urlparse
 
+from multiprocessing.pool import ThreadPool
+
 import pytz
 from thclient import (TreeherderClient, TreeherderJobCollection, TreeherderJob)
 
 import utils
 
+from phonestatus import TreeherderStatus
 from s3 import S3Error
 
 LEAK_RE = re.compile(r'\d+ bytes leaked \((.+)\)$')
@@ -48,8 +52,21 @@ class TestState(object):
 
 class AutophoneTreeherder(object):
 
+    # Maximum number of queued requests read by each pass of
+    # serve_forever.
+    MAX_QUEUED_REQUESTS = 500
+    # Maximum number of jobs posted in a single collection. The jobs
+    # of a request are never split so that a request with more jobs
+    # is posted on its own.
+    MAX_COLLECTION_JOBS = 50
+    # Number of threads used to post collections.
+    POST_THREADS = 4
+    # Seconds serve_forever waits for a request to be queued before
+    # checking the queue anyway.
+    IDLE_WAIT = 60
+
     def __init__(self, worker_subprocess, options, jobs, s3_bucket=None,
-                 mailer=None):
+                 mailer=None, requests_queued=None):
         assert options, "options is required."
 
         logger = utils.getLogger()
@@ -60,6 +77,11 @@ class AutophoneTreeherder(object):
         self.mailer = mailer
         self.worker = worker_subprocess
         self.shutdown_requested = False
+        # requests_queued is set by queue_request in the main process
+        # and the worker processes to wake serve_forever.
+        if requests_queued is None:
+            requests_queued = multiprocessing.Event()
+        self.requests_queued = requests_queued
         logger.debug('AutophoneTreeherder')
 
         self.url = self.options.treeherder_url
@@ -123,6 +145,7 @@ class AutophoneTreeherder(object):
         logger = utils.getLogger()
         logger.debug('AutophoneTreeherder.queue_request: %s', job_collection.__dict__)
         self.jobs.new_treeherder_job(machine, project, job_collection)
+        self.requests_queued.set()
 
     def _create_job(self, tjc, machine, build_url, project, revision, build_type, build_abi,
                     build_platform, build_sdk, builder_type, t):
@@ -279,6 +302,45 @@ class AutophoneTreeherder(object):
 
         self.queue_request(machine, project, tjc)
 
+    def submit_coalesced(self, machine, build_url, project, revision, build_type,
+                         build_abi, build_platform, build_sdk, builder_type, tests=[]):
+        """Submit completed notifications with a usercancel result to
+        Treeherder for tests whose jobs were skipped by coalescing.
+
+        :param machine: machine id
+        :param build_url: url to build being tested.
+        :param project: repository of build.
+        :param revision: Either a URL to the changeset or the revision id.
+        :param tests: Lists of tests to be reported.
+        """
+        logger = utils.getLogger()
+        logger.debug('AutophoneTreeherder.submit_coalesced: %s', tests)
+        if not self.url or not revision:
+            logger.debug('AutophoneTreeherder.submit_coalesced: no url/revision')
+            return
+
+        tjc = TreeherderJobCollection()
+
+        for t in tests:
+            logger.debug('AutophoneTreeherder.submit_coalesced: for %s %s', t.name, project)
+
+            end_timestamp = timestamp_now()
+
+            tj = self._create_job(tjc, machine, build_url, project, revision,
+                                  build_type, build_abi, build_platform,
+                                  build_sdk, builder_type, t)
+            tj.add_state(TestState.COMPLETED)
+            tj.add_result(TreeherderStatus.USERCANCEL)
+            tj.add_submit_timestamp(end_timestamp)
+            tj.add_start_timestamp(end_timestamp)
+            tj.add_end_timestamp(end_timestamp)
+            tjc.add(tj)
+
+        logger.debug('AutophoneTreeherder.submit_coalesced: tjc: %s',
+                     tjc.to_json())
+
+        self.queue_request(machine, project, tjc)
+
     def submit_complete(self, machine, build_url, project, revision, build_type,
                         build_abi, build_platform, build_sdk, builder_type, tests=None):
         """Submit test results for the worker's current job to Treeherder.
@@ -392,12 +454,15 @@ class AutophoneTreeherder(object):
                                                  lname.decode('utf-8',
                                                               errors='replace'))
                                 continue
-                            url = self.s3_bucket.upload(f, "%s/%s" % (
-                                key_prefix, fname))
+                            url = self.s3_bucket.upload(
+                                f, "%s/%s" % (key_prefix, fname),
+                                precompressed=f in t.precompressed_artifacts)
                             t.job_details.append({
                                 'url': url,
                                 'value': lname,
                                 'title': 'artifact uploaded'})
+                            t.loggerdeco.info('Artifact %s uploaded to %s',
+                                              lname, url)
                         except (S3Error, IOError), e:
                             logger.exception('Error uploading artifact %s', fname)
                             t.job_details.append({
@@ -458,30 +523,114 @@ class AutophoneTreeherder(object):
         self.queue_request(machine, project, tjc)
 
     def serve_forever(self):
+        """Post the requests queued in the jobs database to Treeherder
+        until shutdown() is called. See post_queued_requests()."""
         logger = utils.getLogger()
-        while not self.shutdown_requested:
-            wait_seconds = 1    # avoid busy loop
-            job = self.jobs.get_next_treeherder_job()
-            if job:
-                tjc = TreeherderJobCollection()
-                for data in job['job_collection']:
-                    tj = TreeherderJob(data)
-                    tjc.add(tj)
-                if self.post_request(job['machine'], job['project'], tjc,
-                                     job['attempts'], job['last_attempt']):
-                    self.jobs.treeherder_job_completed(job['id'])
-                    wait_seconds = 0
+        pool = ThreadPool(self.POST_THREADS)
+        try:
+            while not self.shutdown_requested:
+                # Requests queued while posting wake the next wait.
+                self.requests_queued.clear()
+                wait_seconds = self.post_queued_requests(pool)
+                if wait_seconds is None:
+                    self.requests_queued.wait(self.IDLE_WAIT)
+                elif wait_seconds > 0:
+                    logger.debug('AutophoneTreeherder waiting for %d seconds '
+                                 'after failed attempt', wait_seconds)
+                    for i in range(wait_seconds):
+                        if self.shutdown_requested:
+                            break
+                        time.sleep(1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def post_queued_requests(self, pool):
+        """Post up to MAX_QUEUED_REQUESTS of the oldest queued requests.
+
+        The pending and running submissions of a job are dropped if a
+        later request also submits the job. The remaining submissions
+        are grouped per project into collections of at most
+        MAX_COLLECTION_JOBS jobs which are posted concurrently using
+        pool. A request is deleted once its submissions and those of
+        the requests which superseded them have been posted.
+
+        Returns the number of seconds to wait before the next call:
+        None if the queue is empty, 0 if more requests may be queued
+        or the retry wait if a collection could not be posted.
+        """
+        requests = self.jobs.get_treeherder_jobs(self.MAX_QUEUED_REQUESTS)
+        if not requests:
+            return None
+
+        # latest maps each job_guid to the id of the last request
+        # which submits the job.
+        latest = {}
+        for request in requests:
+            for data in request['job_collection']:
+                latest[data['job']['job_guid']] = request['id']
+
+        # A request can be deleted when all of the requests in
+        # depends[request id] have been posted.
+        depends = {}
+        collections = []
+        project_collections = {}
+        for request in requests:
+            request_id = request['id']
+            depends[request_id] = set()
+            tjs = []
+            for data in request['job_collection']:
+                superseded_by = latest[data['job']['job_guid']]
+                if (superseded_by != request_id and
+                    data['job'].get('state') != TestState.COMPLETED):
+                    depends[request_id].add(superseded_by)
                 else:
-                    attempts = int(job['attempts'])
-                    wait_seconds = min(self.retry_wait * attempts, 3600)
-                    logger.debug('AutophoneTreeherder waiting for %d seconds after '
-                                 'failed attempt %d',
-                                 wait_seconds, attempts)
-            if wait_seconds > 0:
-                for i in range(wait_seconds):
-                    if self.shutdown_requested:
-                        break
-                    time.sleep(1)
+                    tjs.append(TreeherderJob(data))
+            if not tjs:
+                continue
+            depends[request_id].add(request_id)
+            project = request['project']
+            collection = project_collections.get(project)
+            if (not collection or len(collection['tjc'].data) + len(tjs) >
+                self.MAX_COLLECTION_JOBS):
+                collection = {'machine': request['machine'],
+                              'project': project,
+                              'tjc': TreeherderJobCollection(),
+                              'attempts': 0,
+                              'last_attempt': request['last_attempt'],
+                              'request_ids': []}
+                collections.append(collection)
+                project_collections[project] = collection
+            for tj in tjs:
+                collection['tjc'].add(tj)
+            collection['attempts'] = max(collection['attempts'],
+                                         request['attempts'])
+            collection['request_ids'].append(request_id)
+
+        results = pool.map(self._post_collection, collections)
+        posted = set()
+        failed_attempts = 0
+        for collection, result in zip(collections, results):
+            if result:
+                posted.update(collection['request_ids'])
+            else:
+                failed_attempts = max(failed_attempts, collection['attempts'])
+        self.jobs.treeherder_jobs_completed(
+            [th_id for th_id, request_ids in depends.iteritems()
+             if request_ids <= posted])
+        if failed_attempts:
+            return min(self.retry_wait * failed_attempts, 3600)
+        if len(requests) == self.MAX_QUEUED_REQUESTS:
+            return 0
+        return None
+
+    def _post_collection(self, collection):
+        return self.post_request(collection['machine'],
+                                 collection['project'],
+                                 collection['tjc'],
+                                 collection['attempts'],
+                                 collection['last_attempt'])
 
     def shutdown(self):
         self.shutdown_requested = True
+        self.requests_queued.set()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""A stand-in for the adb server which speaks enough of the adb server
+wire protocol to exercise ADBServerClient and ADBDevice without any
+attached devices.
+
+Shell commands are executed on the host using /bin/sh with the
+current directory set to the server's root directory. sync: requests
+map remote paths onto the root directory, so /data/local/tmp/foo is
+stored as <root>/data/local/tmp/foo.
+"""
+
+import SocketServer
+import argparse
+import errno
+import os
+import shutil
+import socket
+import stat
+import struct
+import subprocess
+import tempfile
+import threading
+
+DEFAULT_PORT = 15037
+DEFAULT_SERIAL = 'fake-0001'
+ADB_SERVER_VERSION = 0x29
+SYNC_DATA_MAX = 64 * 1024
+
+
+class FakeADBServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, root, serials=None):
+        SocketServer.TCPServer.__init__(self, server_address,
+                                        FakeADBHandler)
+        self.root = root
+        self.serials = serials or [DEFAULT_SERIAL]
+
+    def local_path(self, remote):
+        return os.path.join(self.root, os.path.normpath(remote).lstrip('/'))
+
+
+class FakeADBHandler(SocketServer.BaseRequestHandler):
+
+    def recv_exactly(self, length):
+        data = ''
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def okay(self, payload=None):
+        if payload is None:
+            self.request.sendall('OKAY')
+        else:
+            self.request.sendall('OKAY%04x%s' % (len(payload), payload))
+
+    def fail(self, message):
+        self.request.sendall('FAIL%04x%s' % (len(message), message))
+
+    def handle(self):
+        try:
+            transport = None
+            while True:
+                request = self.recv_exactly(int(self.recv_exactly(4), 16))
+                if request == 'host:version':
+                    self.okay('%04x' % ADB_SERVER_VERSION)
+                    return
+                elif request == 'host:devices':
+                    self.okay(''.join(['%s\tdevice\n' % serial
+                                       for serial in self.server.serials]))
+                    return
+                elif request in ('host:get-state', 'host:transport-any'):
+                    if len(self.server.serials) != 1:
+                        self.fail('more than one device/emulator')
+                        return
+                    if request == 'host:get-state':
+                        self.okay('device')
+                        return
+                    transport = self.server.serials[0]
+                    self.okay()
+                elif request.startswith('host-serial:'):
+                    serial, _, service = request[len('host-serial:'):].rpartition(':')
+                    if serial not in self.server.serials:
+                        self.fail("device '%s' not found" % serial)
+                    elif service == 'get-state':
+                        self.okay('device')
+                    else:
+                        self.fail('unknown host service')
+                    return
+                elif request.startswith('host:transport:'):
+                    transport = request[len('host:transport:'):]
+                    if transport not in self.server.serials:
+                        self.fail("device '%s' not found" % transport)
+                        return
+                    self.okay()
+                elif not transport:
+                    self.fail('unknown host service')
+                    return
+                elif request.startswith('shell:'):
+                    self.okay()
+                    self.shell(request[len('shell:'):])
+                    return
+                elif request == 'sync:':
+                    self.okay()
+                    self.sync()
+                    return
+                else:
+                    self.fail('closed')
+                    return
+        except EOFError:
+            return
+        except socket.error, e:
+            if e.errno in (errno.ECONNRESET, errno.EPIPE):
+                return
+            raise
+
+    def shell(self, cmd):
+        proc = subprocess.Popen(['/bin/sh', '-c', cmd],
+                                cwd=self.server.root,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        while True:
+            data = proc.stdout.read(SYNC_DATA_MAX)
+            if not data:
+                break
+            self.request.sendall(data)
+        proc.wait()
+
+    def sync_reply(self, sync_id, data=''):
+        self.request.sendall(sync_id + struct.pack('<I', len(data)) + data)
+
+    def sync(self):
+        while True:
+            header = self.recv_exactly(8)
+            sync_id = header[:4]
+            length = struct.unpack('<I', header[4:])[0]
+            if sync_id == 'QUIT':
+                return
+            path = self.recv_exactly(length)
+            if sync_id == 'SEND':
+                self.sync_send(path)
+            elif sync_id == 'RECV':
+                self.sync_recv(path)
+            elif sync_id == 'STAT':
+                self.sync_stat(path)
+            else:
+                self.sync_reply('FAIL', 'unknown sync request %r' % sync_id)
+                return
+
+    def sync_send(self, path):
+        remote, _, mode = path.rpartition(',')
+        local = self.server.local_path(remote)
+        parent = os.path.dirname(local)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        with open(local, 'wb') as local_file:
+            while True:
+                header = self.recv_exactly(8)
+                sync_id = header[:4]
+                length = struct.unpack('<I', header[4:])[0]
+                if sync_id == 'DATA':
+                    local_file.write(self.recv_exactly(length))
+                elif sync_id == 'DONE':
+                    break
+                else:
+                    self.sync_reply('FAIL', 'unexpected %r in SEND' % sync_id)
+                    return
+        os.chmod(local, stat.S_IMODE(int(mode)))
+        os.utime(local, (length, length))
+        self.sync_reply('OKAY')
+
+    def sync_recv(self, path):
+        local = self.server.local_path(path)
+        if not os.path.isfile(local):
+            self.sync_reply('FAIL', 'remote object %r does not exist' % path)
+            return
+        with open(local, 'rb') as local_file:
+            while True:
+                data = local_file.read(SYNC_DATA_MAX)
+                if not data:
+                    break
+                self.sync_reply('DATA', data)
+        self.sync_reply('DONE')
+
+    def sync_stat(self, path):
+        try:
+            st = os.stat(self.server.local_path(path))
+            values = (st.st_mode, st.st_size, int(st.st_mtime))
+        except OSError:
+            values = (0, 0, 0)
+        self.request.sendall('STAT' + struct.pack('<III', *values))
+
+
+def start_server(port=0, root=None, serials=None):
+    """Start a FakeADBServer on localhost in a daemon thread.
+
+    :param port: port to listen on. 0 picks a free port.
+    :param root: directory used as the root of the fake device's
+        file system. A temporary directory is created if None.
+    :param serials: list of device serial numbers to report.
+    :returns: the FakeADBServer. server.server_address[1] is the
+        port and server.root is the root directory.
+    """
+    if root is None:
+        root = tempfile.mkdtemp(prefix='fakeadbserver-')
+    server = FakeADBServer(('127.0.0.1', port), root, serials=serials)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    return server
+
+
+def stop_server(server, remove_root=False):
+    server.shutdown()
+    server.server_close()
+    if remove_root:
+        shutil.rmtree(server.root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run a fake adb server for testing the adb socket '
+        'transport without attached devices.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='port to listen on. (default: %(default)s)')
+    parser.add_argument('--root', default=None,
+                        help='directory to use as the device root. '
+                        '(default: a new temporary directory)')
+    parser.add_argument('--serial', dest='serials', action='append',
+                        default=None,
+                        help='device serial number to report. May be '
+                        'repeated. (default: %s)' % DEFAULT_SERIAL)
+    args = parser.parse_args()
+
+    server = start_server(port=args.port, root=args.root, serials=args.serials)
+    print 'fake adb server listening on %s:%s root %s' % (
+        server.server_address[0], server.server_address[1], server.root)
+    try:
+        while True:
+            threading.Event().wait(3600)
+    except KeyboardInterrupt:
+        stop_server(server)
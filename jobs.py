@@ -3,63 +3,514 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import datetime
+import glob
 import json
 import os
 import sqlite3
+import threading
 import time
 import traceback
 
 import utils
+from jobscheduler import FifoScheduler
 
 class Jobs(object):
+    """Jobs is the queue of the devices' jobs and of the requests to
+    Treeherder which is shared by the autophone process and the
+    workers.
+
+    Jobs converts between the workers' tests and the rows kept by its
+    JobsStorage, which may be shared between processes.
+    """
 
     MAX_ATTEMPTS = 3
-    SQL_RETRY_DELAY = 6
-    SQL_MAX_RETRIES = 10
 
-    def __init__(self, mailer, default_device=None, allow_duplicates=False):
+    # The days a job skipped by coalesce() is kept for backfill.
+    COALESCE_EXPIRE_AFTER_DAYS = 7
+
+    # The weight of the latest runtime in the average runtime of a
+    # device's jobs for a tree used by the job schedulers.
+    RUNTIME_AVERAGE_WEIGHT = 0.3
+
+    def __init__(self, mailer, default_device=None, allow_duplicates=False,
+                 scheduler=None, coalesce_backlog=0, coalesce_sample=0,
+                 coalesce_expires=COALESCE_EXPIRE_AFTER_DAYS, storage=None):
         self.mailer = mailer
         self.default_device = default_device
-        self.filename = 'jobs.sqlite'
         self.allow_duplicates = allow_duplicates
+        # scheduler is the JobScheduler used by get_next_job.
+        self.scheduler = scheduler or FifoScheduler()
+        # See coalesce().
+        self.coalesce_backlog = coalesce_backlog
+        self.coalesce_sample = coalesce_sample
+        # See delete_expired_jobs().
+        self.coalesce_expires = coalesce_expires
+        # storage is the JobsStorage which keeps the jobs. The
+        # SQLiteJobsStorage of jobs.sqlite is used by default.
+        if storage is None:
+            storage = SQLiteJobsStorage(mailer)
+        self.storage = storage
+
+    def _now(self):
+        """Return the current time as an isoformat string."""
+        return datetime.datetime.utcnow().isoformat()
+
+    def clear_all(self):
+        self.storage.clear_all()
+
+    def new_job(self, build_url, build_id=None, build_type=None, build_abi=None,
+                build_platform=None, build_sdk=None, changeset=None, changeset_dirs=[],
+                tree=None, revision=None, builder_type=None, tests=None,
+                enable_unittests=False, device=None,
+                attempts=0):
+        logger = utils.getLogger()
+        logger.debug('jobs.new_job: %s %s %s %s %s %s %s %s %s %s %s %s %s %s %s',
+                     build_url, build_id, build_type, build_abi, build_platform, build_sdk,
+                     changeset, changeset_dirs, tree, revision, builder_type,
+                     tests, enable_unittests, device, attempts)
+        if not device:
+            device = self.default_device
+        build = {'build_url': build_url,
+                 'build_id': build_id,
+                 'build_type': build_type,
+                 'build_abi': build_abi,
+                 'build_platform': build_platform,
+                 'build_sdk': build_sdk,
+                 'changeset': changeset,
+                 'changeset_dirs': changeset_dirs,
+                 'tree': tree,
+                 'revision': revision,
+                 'builder_type': builder_type}
+        return self._enqueue(build,
+                             [(device, enable_unittests, attempts, tests)])[device]
+
+    def enqueue_many(self, build, device_tests):
+        """Queue a build's tests for several devices in a single
+        transaction.
+
+        :param build: dict containing the build_url and the optional
+            build_id, build_type, build_abi, build_platform, build_sdk,
+            changeset, changeset_dirs, tree, revision and builder_type
+            arguments of new_job.
+        :param device_tests: list of (device, tests) tuples. A
+            device's job enables unittests if any of its tests do.
+        :returns: dict mapping each device to the list of its tests
+            which were queued, i.e. which were not already queued
+            for the build.
+        """
+        logger = utils.getLogger()
+        logger.debug('jobs.enqueue_many: %s %s', build, device_tests)
+        return self._enqueue(
+            build,
+            [(device, any([t.enable_unittests for t in tests]), 0, tests)
+             for device, tests in device_tests])
+
+    def _enqueue(self, build, device_jobs):
+        """Queue the jobs of device_jobs, a list of (device,
+        enable_unittests, attempts, tests) tuples, for build. Each
+        queued test is given a new job_guid. Returns a dict mapping
+        each device to the list of its queued tests."""
+        storage_jobs = []
+        guid_tests = {}
+        for device, enable_unittests, attempts, tests in device_jobs:
+            test_rows = []
+            for test in tests:
+                guid = utils.generate_guid()
+                guid_tests[guid] = test
+                test_rows.append((test.name, test.config_file, test.chunk,
+                                  json.dumps(test.repos), guid))
+            storage_jobs.append((device, enable_unittests, attempts, test_rows))
+        new_guids = self.storage.enqueue(build, storage_jobs,
+                                         self.allow_duplicates, self._now())
+        new_tests = {}
+        for device, guids in new_guids.iteritems():
+            new_tests[device] = []
+            for guid in guids:
+                test = guid_tests[guid]
+                test.job_guid = guid
+                new_tests[device].append(test)
+        return new_tests
+
+    def jobs_pending(self, device=None):
+        if not device:
+            device = self.default_device
+        return self.storage.jobs_pending(device)
+
+    def set_job_attempts(self, jobid, attempts, device=None):
+        if not device:
+            device = self.default_device
+        self.storage.set_job_attempts(jobid, attempts, device)
+
+    def delete_expired_jobs(self, device=None):
+        """Delete the jobs which have reached MAX_ATTEMPTS, the jobs
+        skipped by coalesce() which were created more than
+        coalesce_expires days ago and their tests. get_next_job()
+        skips these jobs so they only need to be deleted from time to
+        time. A coalesce_expires of 0 keeps the coalesced jobs until
+        they are backfilled."""
+        if not device:
+            device = self.default_device
+        self.storage.delete_expired_jobs(device, self.MAX_ATTEMPTS,
+                                         self._now(), self.coalesce_expires)
+
+    def get_next_job(self, lifo=False, device=None, worker=None):
+        """Claim the device's next job and return it as a dict whose
+        tests item is the list of the worker's tests to be run, or
+        None if the device has no jobs.
+
+        The job is chosen by the scheduler and claimed atomically by
+        the storage. Jobs which have reached MAX_ATTEMPTS and
+        coalesced jobs are skipped. See delete_expired_jobs() and
+        coalesce().
+        """
+        logger = utils.getLogger()
+        if not device:
+            device = self.default_device
+        claim = self.storage.claim_next_job(device, self.scheduler, lifo,
+                                            self._now(), self.MAX_ATTEMPTS)
+        if not claim:
+            return None
+        job, test_rows = claim
+
+        # Generate the list of tests to be executed for this job.
+        job['tests'] = []
+        for name, config_file, chunk, repos, guid in test_rows:
+            key = (name, config_file, chunk, tuple(sorted(json.loads(repos))))
+            test = worker.tests_by_key.get(key)
+            if not test:
+                continue
+            if not guid:
+                logger.error('jobs.get_next_job: invalid job_guid: %s', job)
+                raise Exception('Found test with invalid job_guid')
+            test.job_guid = guid
+            job['tests'].append(test)
+        logger.debug('jobs.get_next_job: %s', job)
+        return job
+
+    def coalesce(self, build_url, devices):
+        """Coalesce the jobs of build_url for devices with the jobs
+        queued for the previous build.
+
+        When a device has more than coalesce_backlog jobs pending, the
+        newest pending job before build_url's for the same tree, build
+        type, abi, platform, sdk, app and tests is skipped unless it is
+        kept as a sample: with a coalesce_sample of n, one in every n
+        builds is run. A coalesce_sample of 0 runs only the newest
+        build. Skipped jobs remain in the storage with coalesced set
+        so that they can be queued again with backfill(). Try jobs and
+        jobs which have been claimed are never coalesced.
+
+        :param build_url: url of the build which was just queued.
+        :param devices: list of the devices whose jobs are coalesced.
+        :returns: list of the skipped jobs as dicts containing the
+            device, build_url, build_id, build_type, build_abi,
+            build_platform, build_sdk, changeset, changeset_dirs, tree,
+            revision and builder_type of the job and a tests item which
+            is the list of (name, config_file, chunk, guid) tuples of
+            its tests.
+        """
+        if not self.coalesce_backlog or not devices:
+            return []
+        return self.storage.coalesce(build_url, devices, self.coalesce_backlog,
+                                     self.coalesce_sample, self.MAX_ATTEMPTS)
+
+    def backfill(self, device=None, tree=None):
+        """Delete the jobs skipped by coalesce() and return them so
+        that they can be queued again with enqueue_many().
+
+        :param device: optional device whose jobs are returned. The
+            jobs of all devices are returned by default.
+        :param tree: optional tree whose jobs are returned.
+        :returns: list of the jobs as returned by coalesce().
+        """
+        return self.storage.backfill(device, tree)
+
+    def cancel_test(self, test_guid, device=None):
+        logger = utils.getLogger()
+        logger.debug('jobs.cancel_test: test %s device %s',
+                     test_guid, device)
+        if not device:
+            device = self.default_device
+        self.storage.cancel_test(test_guid, device)
+
+    def new_treeherder_job(self, machine, project, job_collection):
+        logger = utils.getLogger()
+        logger.debug('jobs.new_treeherder_job: %s %s %s',
+                     machine, project, job_collection.__dict__)
+        self.storage.new_treeherder_job(machine, project,
+                                        job_collection.to_json(), self._now())
+
+    def get_treeherder_jobs(self, limit):
+        """Return up to limit of the oldest queued Treeherder requests
+        as a list of dicts and increment their attempts in a single
+        transaction."""
+        return self.storage.get_treeherder_jobs(limit, self._now())
+
+    def treeherder_jobs_completed(self, th_ids):
+        logger = utils.getLogger()
+        logger.debug('jobs.treeherder_jobs_completed: %s', th_ids)
+        if not th_ids:
+            return
+        self.storage.treeherder_jobs_completed(th_ids)
+
+    def test_completed(self, test_guid, device=None):
+        logger = utils.getLogger()
+        logger.debug('jobs.test_completed: %s', test_guid)
+        if not device:
+            device = self.default_device
+        self.storage.test_completed(test_guid, device)
+
+    def job_completed(self, job_id, device=None):
+        """Delete the job and its tests and record its runtime, the
+        time since it was last claimed, in the average runtime of the
+        device's jobs for the job's tree."""
+        logger = utils.getLogger()
+        logger.debug('jobs.job_completed: %s', job_id)
+        if not device:
+            device = self.default_device
+        self.storage.job_completed(job_id, device, self._now(),
+                                   self.RUNTIME_AVERAGE_WEIGHT)
+
+
+class JobsStorage(object):
+    """JobsStorage is the interface of the storages which keep the
+    jobs, their tests, the average runtimes of the jobs and the queued
+    Treeherder requests for Jobs.
+
+    A storage deals only in plain data so that it may be used through
+    a proxy by several processes. Each method is atomic. A test is
+    passed as a (name, config_file, chunk, repos, guid) tuple where
+    repos is the json encoded list of the test's repositories. Times
+    are isoformat strings given by the caller. A job is returned as a
+    dict of the columns id, created, last_attempt, build_url,
+    build_id, build_type, build_abi, build_platform, build_sdk,
+    changeset, changeset_dirs, tree, revision, builder_type,
+    enable_unittests, attempts and istry. The device of a job or
+    test is passed with its id so that the jobs of each device may be
+    kept apart. See ShardedSQLiteJobsStorage.
+    """
+
+    def clear_all(self):
+        """Delete all of the jobs, tests and Treeherder requests."""
+        raise NotImplementedError
+
+    def enqueue(self, build, device_jobs, allow_duplicates, now):
+        """Queue a build's tests for several devices.
+
+        :param build: dict of the build's columns. See
+            Jobs.enqueue_many.
+        :param device_jobs: list of (device, enable_unittests,
+            attempts, tests) tuples. A device's existing job for the
+            build is reused.
+        :param allow_duplicates: if False, tests which are already
+            queued for the device and build are not queued again.
+        :param now: the time the jobs are created.
+        :returns: dict mapping each device to the list of the guids of
+            its queued tests.
+        """
+        raise NotImplementedError
+
+    def jobs_pending(self, device):
+        """Return the number of the device's jobs which have not been
+        coalesced."""
+        raise NotImplementedError
+
+    def set_job_attempts(self, job_id, attempts, device):
+        raise NotImplementedError
+
+    def delete_expired_jobs(self, device, max_attempts, now, coalesce_expires):
+        """Delete the device's jobs which have reached max_attempts,
+        its coalesced jobs which were created more than
+        coalesce_expires days before now unless coalesce_expires is 0
+        and their tests."""
+        raise NotImplementedError
+
+    def claim_next_job(self, device, scheduler, lifo, now, max_attempts):
+        """Claim the device's next job: the first of the jobs which
+        have fewer than max_attempts attempts and have not been
+        coalesced, in the order of the JobScheduler scheduler.
+        Increment its attempts and set its last_attempt to now.
+
+        :returns: None if there is no job, otherwise a (job, tests)
+            tuple where tests is the list of the job's tests.
+        """
+        raise NotImplementedError
+
+    def coalesce(self, build_url, devices, backlog, sample, max_attempts):
+        """See Jobs.coalesce."""
+        raise NotImplementedError
+
+    def backfill(self, device, tree):
+        """See Jobs.backfill."""
+        raise NotImplementedError
 
-        if not os.path.exists(self.filename):
-            conn = self._conn()
-            conn.execute('create table jobs ('
-                         'id integer primary key, '
-                         'created text, '
-                         'last_attempt text, '
-                         'build_url text, '
-                         'build_id text, '
-                         'build_type text, '
-                         'build_abi text, '
-                         'build_platform text, '
-                         'build_sdk text, '
-                         'changeset text, '
-                         'changeset_dirs text, '
-                         'tree text, '
-                         'revision text, '
-                         'builder_type text, '
-                         'enable_unittests int, '
-                         'attempts int, '
-                         'device text)')
-            conn.execute('create table tests ('
-                         'id integer primary key, '
-                         'name text, '
-                         'config_file text, '
-                         'chunk int, '
-                         'guid text, '
-                         'repos text, '
-                         'jobid integer)')
-            conn.execute('create table treeherder ('
-                         'id integer primary key, '
-                         'attempts int, '
-                         'last_attempt text, '
-                         'machine text,'
-                         'project text,'
-                         'job_collection text)')
-            conn.commit()
+    def cancel_test(self, test_guid, device):
+        """Delete the test and its job if the job has no other
+        tests."""
+        raise NotImplementedError
+
+    def test_completed(self, test_guid, device):
+        """Delete the test."""
+        raise NotImplementedError
+
+    def job_completed(self, job_id, device, now, runtime_weight):
+        """Delete the job and its tests and update the average runtime
+        of the device's jobs for the job's tree with the time from the
+        job's last_attempt to now. The latest runtime has a weight of
+        runtime_weight in the average."""
+        raise NotImplementedError
+
+    def new_treeherder_job(self, machine, project, job_collection, now):
+        """Queue a Treeherder request. job_collection is the json
+        encoded TreeherderJobCollection."""
+        raise NotImplementedError
+
+    def get_treeherder_jobs(self, limit, now):
+        """Return up to limit of the oldest queued Treeherder requests
+        as dicts of their id, attempts, last_attempt, machine, project
+        and decoded job_collection after incrementing their attempts
+        and setting their last_attempt to now."""
+        raise NotImplementedError
+
+    def treeherder_jobs_completed(self, th_ids):
+        """Delete the Treeherder requests."""
+        raise NotImplementedError
+
+
+class SQLiteJobsStorage(JobsStorage):
+    """SQLiteJobsStorage keeps the jobs in an sqlite database which is
+    shared by the processes which open it."""
+
+    SQL_RETRY_DELAY = 6
+    SQL_MAX_RETRIES = 10
+    # Seconds sqlite waits for a lock held by another connection
+    # before a statement fails with "database is locked". Lock
+    # contention is handled by sqlite's busy handler. Only statements
+    # which still fail are retried by the SQL_RETRY_DELAY loop.
+    SQL_BUSY_TIMEOUT = 60
+
+    # MIGRATIONS[n] is the list of statements which upgrade the schema
+    # of the database from version n to version n + 1. The version is
+    # recorded in the schema_version table. Databases created before
+    # the schema was versioned have the tables of version 1 and are
+    # upgraded in place. Add new migrations to the end of the list;
+    # never change existing ones.
+    MIGRATIONS = [
+        # Version 1: the original tables.
+        [
+            'create table if not exists jobs ('
+            'id integer primary key, '
+            'created text, '
+            'last_attempt text, '
+            'build_url text, '
+            'build_id text, '
+            'build_type text, '
+            'build_abi text, '
+            'build_platform text, '
+            'build_sdk text, '
+            'changeset text, '
+            'changeset_dirs text, '
+            'tree text, '
+            'revision text, '
+            'builder_type text, '
+            'enable_unittests int, '
+            'attempts int, '
+            'device text)',
+            'create table if not exists tests ('
+            'id integer primary key, '
+            'name text, '
+            'config_file text, '
+            'chunk int, '
+            'guid text, '
+            'repos text, '
+            'jobid integer)',
+            'create table if not exists treeherder ('
+            'id integer primary key, '
+            'attempts int, '
+            'last_attempt text, '
+            'machine text,'
+            'project text,'
+            'job_collection text)',
+        ],
+        # Version 2: is_try replaces instr(build_url, "try") when
+        # ordering a device's jobs, and indexes for the queue order,
+        # the duplicate checks of new_job and the test lookups.
+        [
+            'alter table jobs add column is_try int not null default 0',
+            'update jobs set is_try=instr(build_url, "try")>0',
+            'create index jobs_device_queue on jobs '
+            '(device, is_try desc, created)',
+            'create index jobs_device_build_url on jobs (device, build_url)',
+            'create index tests_jobid on tests '
+            '(jobid, name, config_file, chunk, repos)',
+            'create index tests_guid on tests (guid)',
+        ],
+        # Version 3: the average runtime in seconds of the completed
+        # jobs of each device and tree used by the job schedulers.
+        [
+            'create table job_runtimes ('
+            'device text, '
+            'tree text, '
+            'runtime real, '
+            'primary key (device, tree))',
+        ],
+        # Version 4: coalesced is set for jobs skipped by coalesce()
+        # which wait to be backfilled and coalesce_count is the number
+        # of consecutive builds skipped before the job's build.
+        [
+            'alter table jobs add column coalesced int not null default 0',
+            'alter table jobs add column coalesce_count int not null default 0',
+        ],
+    ]
+
+    def __init__(self, mailer, filename='jobs.sqlite'):
+        self.mailer = mailer
+        self.filename = filename
+        # Each thread keeps its own connection open for reuse. See
+        # _conn().
+        self._local = threading.local()
+        # Connections inherited from the parent process are kept but
+        # never used or closed in the child.
+        self._inherited_connections = []
+
+        self._migrate()
+
+    def _migrate(self):
+        """Create the database or upgrade its schema to the latest
+        version. The upgrade is made in a single transaction so that
+        concurrent processes see either the old or the new schema."""
+        logger = utils.getLogger()
+        # Set the journal mode outside of the migration's transaction.
+        self._release_connection(self._conn())
+        # In autocommit mode the sqlite3 module does not commit the
+        # transaction implicitly before each create or alter statement.
+        conn = sqlite3.connect(self.filename, timeout=self.SQL_BUSY_TIMEOUT,
+                               isolation_level=None)
+        try:
+            conn.execute('begin immediate')
+            try:
+                conn.execute('create table if not exists schema_version '
+                             '(version int)')
+                row = conn.execute('select version from schema_version').fetchone()
+                version = row[0] if row else 0
+                for sql_list in self.MIGRATIONS[version:]:
+                    for sql in sql_list:
+                        conn.execute(sql)
+                if not row:
+                    conn.execute('insert into schema_version values (?)',
+                                 (len(self.MIGRATIONS),))
+                elif version < len(self.MIGRATIONS):
+                    conn.execute('update schema_version set version=?',
+                                 (len(self.MIGRATIONS),))
+                conn.execute('commit')
+            except:
+                conn.execute('rollback')
+                raise
+        finally:
             conn.close()
+        if version < len(self.MIGRATIONS):
+            logger.info('jobs: upgraded %s from schema version %d to %d',
+                        self.filename, version, len(self.MIGRATIONS))
 
     def report_sql_error(self, attempt, email_sent, sql, values):
         logger = utils.getLogger()
@@ -78,18 +529,40 @@ class Jobs(object):
         return email_sent
 
     def _conn(self):
+        """Return the calling thread's connection to the database.
+
+        The connection is opened on first use and kept open so that
+        its cache of prepared statements is reused. The database uses
+        write-ahead logging so that readers do not block the writer
+        and the writer does not block readers. Any transaction left
+        uncommitted by an exception is rolled back before the
+        connection is reused.
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn:
+            if local.pid == os.getpid():
+                conn.rollback()
+                return conn
+            # sqlite connections must not be used across fork.
+            self._inherited_connections.append(conn)
         attempt = 0
         email_sent = False
         while True:
             attempt += 1
             try:
-                conn = sqlite3.connect(self.filename)
+                conn = sqlite3.connect(self.filename,
+                                       timeout=self.SQL_BUSY_TIMEOUT)
+                conn.execute('pragma journal_mode=wal')
+                conn.execute('pragma synchronous=normal')
                 break
             except sqlite3.OperationalError:
                 email_sent = self.report_sql_error(
                     attempt, email_sent,
                     'connect(%s)' % self.filename,
                     None)
+        local.conn = conn
+        local.pid = os.getpid()
         return conn
 
     def _commit_connection(self, conn):
@@ -106,24 +579,32 @@ class Jobs(object):
                     '_commit_connection(%s)' % self.filename,
                     None)
 
-    def _close_connection(self, conn):
+    def _release_connection(self, conn):
+        """Release a connection returned by _conn(). The connection is
+        kept open for reuse by the calling thread. Anything which has
+        not been committed is rolled back."""
+        conn.rollback()
+
+    def _execute_sql(self, conn, sql, values=()):
+        """Execute sql statement.
+
+        Returns the cursor which executed the statement if no error
+        occured, otherwise it keeps trying until it succeeds.
+        """
         attempt = 0
         email_sent = False
         while True:
             attempt += 1
             try:
-                conn.close()
-                break
+                return conn.execute(sql, values)
             except sqlite3.OperationalError:
-                email_sent = self.report_sql_error(
-                    attempt, email_sent,
-                    '_close_connection(%s)' % self.filename,
-                    None)
+                email_sent = self.report_sql_error(attempt, email_sent,
+                                                   sql, values)
 
-    def _execute_sql(self, conn, sql, values=()):
-        """Execute sql statement.
+    def _executemany_sql(self, conn, sql, values_list):
+        """Execute sql statement for each of the values in values_list.
 
-        Returns the cursor which executed the statement if no error
+        Returns the cursor which executed the statements if no error
         occured, otherwise it keeps trying until it succeeds.
         """
         attempt = 0
@@ -131,10 +612,10 @@ class Jobs(object):
         while True:
             attempt += 1
             try:
-                return conn.execute(sql, values)
+                return conn.executemany(sql, values_list)
             except sqlite3.OperationalError:
                 email_sent = self.report_sql_error(attempt, email_sent,
-                                                   sql, values)
+                                                   sql, values_list)
 
     def clear_all(self):
         conn = self._conn()
@@ -142,146 +623,163 @@ class Jobs(object):
         self._execute_sql(conn, 'delete from jobs')
         self._execute_sql(conn, 'delete from treeherder')
         self._commit_connection(conn)
-        self._close_connection(conn)
+        self._release_connection(conn)
 
-    def new_job(self, build_url, build_id=None, build_type=None, build_abi=None,
-                build_platform=None, build_sdk=None, changeset=None, changeset_dirs=[],
-                tree=None, revision=None, builder_type=None, tests=None,
-                enable_unittests=False, device=None,
-                attempts=0):
+    def enqueue(self, build, device_jobs, allow_duplicates, now):
         logger = utils.getLogger()
-        logger.debug('jobs.new_job: %s %s %s %s %s %s %s %s %s %s %s %s %s %s %s',
-                     build_url, build_id, build_type, build_abi, build_platform, build_sdk,
-                     changeset, changeset_dirs, tree, revision, builder_type,
-                     tests, enable_unittests, device, attempts)
-        if not device:
-            device = self.default_device
-        now = datetime.datetime.utcnow().isoformat()
+        build_url = build['build_url']
+        devices = [device_job[0] for device_job in device_jobs]
+        new_guids = dict([(device, []) for device in devices])
+        if not devices:
+            return new_guids
+        device_params = ','.join('?' * len(devices))
 
         conn = self._conn()
-        job_id = None
-        if not self.allow_duplicates:
-            job_cursor = self._execute_sql(
-                conn,
-                'select id from jobs where device=? and build_url=?',
-                values=(device, build_url))
-
-            job = job_cursor.fetchone()
-            job_cursor.close()
-            if job:
-                job_id = job[0]
-        if not job_id:
-            changeset_dirs = json.dumps(changeset_dirs)
+        self._execute_sql(conn, 'begin immediate')
+        job_ids = {}
+        existing_tests = set()
+        if not allow_duplicates:
+            # Jobs skipped by coalesce() are left for backfill so that
+            # a retriggered build is queued again.
             job_cursor = self._execute_sql(
                 conn,
-                'insert into jobs values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                values=(None, now, None, build_url, build_id, build_type, build_abi,
-                        build_platform, build_sdk, changeset, changeset_dirs, tree,
-                        revision, builder_type, enable_unittests, attempts, device))
-            job_id = job_cursor.lastrowid
+                'select device, id from jobs where build_url=? and '
+                'coalesced=0 and device in (%s)' % device_params,
+                values=[build_url] + devices)
+            job_ids = dict(job_cursor.fetchall())
             job_cursor.close()
-
-        new_tests = []
-        for test in tests:
-            repos = json.dumps(test.repos)
-            if not self.allow_duplicates:
+            if job_ids:
                 test_cursor = self._execute_sql(
                     conn,
-                    'select * from tests where '
-                    'name=? and config_file=? and chunk=? and repos=? and jobid=?',
-                    values=(test.name, test.config_file, test.chunk, repos, job_id))
-                test_row = test_cursor.fetchone()
+                    'select jobid, name, config_file, chunk, repos from tests '
+                    'where jobid in (%s)' % ','.join('?' * len(job_ids)),
+                    values=job_ids.values())
+                existing_tests = set(test_cursor.fetchall())
                 test_cursor.close()
-                if test_row:
+
+        # Rows inserted in this transaction have ids greater than
+        # max_id.
+        job_cursor = self._execute_sql(conn, 'select max(id) from jobs')
+        max_id = job_cursor.fetchone()[0] or 0
+        job_cursor.close()
+        changeset_dirs = json.dumps(build.get('changeset_dirs', []))
+        job_rows = [
+            (now, build_url, build.get('build_id'), build.get('build_type'),
+             build.get('build_abi'), build.get('build_platform'),
+             build.get('build_sdk'), build.get('changeset'), changeset_dirs,
+             build.get('tree'), build.get('revision'),
+             build.get('builder_type'), enable_unittests, attempts, device,
+             'try' in build_url)
+            for device, enable_unittests, attempts, tests in device_jobs
+            if device not in job_ids]
+        self._executemany_sql(
+            conn,
+            'insert into jobs (created, build_url, build_id, build_type, '
+            'build_abi, build_platform, build_sdk, changeset, changeset_dirs, '
+            'tree, revision, builder_type, enable_unittests, attempts, '
+            'device, is_try) '
+            'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            job_rows)
+        job_cursor = self._execute_sql(
+            conn, 'select device, id from jobs where id>?', values=(max_id,))
+        job_ids.update(job_cursor.fetchall())
+        job_cursor.close()
+
+        test_rows = []
+        for device, enable_unittests, attempts, tests in device_jobs:
+            job_id = job_ids[device]
+            for name, config_file, chunk, repos, guid in tests:
+                if (job_id, name, config_file, chunk, repos) in existing_tests:
                     logger.warning(
-                        'jobs.new_job: duplicate test: %s, device: %s, '
+                        'jobs.enqueue: duplicate test: %s, device: %s, '
                         'name: %s, config_file: %s, chunk: %s, repos: %s',
-                        build_url, device, test.name, test.config_file,
-                        test.chunk, repos)
+                        build_url, device, name, config_file, chunk, repos)
                     continue
-            new_tests.append(test)
-            test.generate_guid()
-            if not test.job_guid:
-                logger.error(
-                    'jobs.new_job: invalid job_guid: %s, device: %s, '
-                    'name: %s, config_file: %s, chunk: %s, repos: %s',
-                    build_url, device, test.name, test.config_file,
-                    test.chunk, repos)
-                raise Exception('Can not insert test with invalid job_guid')
-            self._execute_sql(
-                conn,
-                'insert into tests values (?, ?, ?, ?, ?, ?, ?)',
-                values=(None, test.name, test.config_file, test.chunk,
-                        test.job_guid, repos, job_id))
+                new_guids[device].append(guid)
+                test_rows.append((name, config_file, chunk, guid, repos,
+                                  job_id))
+        self._executemany_sql(
+            conn,
+            'insert into tests (name, config_file, chunk, guid, repos, jobid) '
+            'values (?, ?, ?, ?, ?, ?)',
+            test_rows)
         self._commit_connection(conn)
-        self._close_connection(conn)
+        self._release_connection(conn)
 
-        return new_tests
+        return new_guids
 
-    def jobs_pending(self, device=None):
+    def jobs_pending(self, device):
         conn = self._conn()
-        if not device:
-            device = self.default_device
         cursor = self._execute_sql(
             conn,
-            'select count(id) from jobs where device=?',
+            'select count(id) from jobs where device=? and coalesced=0',
             values=(device,))
         count = cursor.fetchone()[0]
         cursor.close()
-        self._close_connection(conn)
+        self._release_connection(conn)
         return count
 
-    def set_job_attempts(self, jobid, attempts):
+    def set_job_attempts(self, job_id, attempts, device):
         conn = self._conn()
 
         self._execute_sql(
             conn,
             'update jobs set attempts=? where id=?',
-            values=(attempts, jobid))
+            values=(attempts, job_id))
         self._commit_connection(conn)
+        self._release_connection(conn)
 
-    def get_next_job(self, lifo=False, device=None, worker=None):
+    def delete_expired_jobs(self, device, max_attempts, now, coalesce_expires):
         logger = utils.getLogger()
-        if not device:
-            device = self.default_device
-        order = 'desc' if lifo else 'asc'
-
+        # A coalesce_expires of 0 never expires the coalesced jobs.
+        where = ('device=? and (attempts>=? or (coalesced=1 and ?>0 and '
+                 'julianday(?)-julianday(created)>?))')
+        values = (device, max_attempts, coalesce_expires, now,
+                  coalesce_expires)
         conn = self._conn()
-
-        # Find the ids of the jobs whose attempts exceed the maximum.
-        # First delete the associated tests, then the jobs.
+        self._execute_sql(
+            conn,
+            'delete from tests where jobid in '
+            '(select id from jobs where %s)' % where,
+            values=values)
         job_cursor = self._execute_sql(
             conn,
-            'select id from jobs where device=? and attempts>=?',
-            values=(device, self.MAX_ATTEMPTS))
-        job_ids = [job[0] for job in job_cursor]
-        for job_id in job_ids:
-            self._execute_sql(conn, 'delete from tests where jobid=?',
-                              values=(job_id,))
+            'delete from jobs where %s' % where,
+            values=values)
+        if job_cursor.rowcount > 0:
+            logger.debug('jobs.delete_expired_jobs: deleted %d jobs device %s',
+                         job_cursor.rowcount, device)
         job_cursor.close()
-        self._execute_sql(
-            conn,
-            'delete from jobs where device=? and attempts>=?',
-            values=(device, self.MAX_ATTEMPTS))
-
         self._commit_connection(conn)
+        self._release_connection(conn)
 
+    def claim_next_job(self, device, scheduler, lifo, now, max_attempts):
+        # The job and its tests are selected with a single query and
+        # the job's attempts are incremented in the same immediate
+        # transaction, so concurrent claims can not interleave.
+        order_by, order_values = scheduler.order_by(lifo, now)
+
+        conn = self._conn()
+        self._execute_sql(conn, 'begin immediate')
         job_cursor = self._execute_sql(
             conn,
-            'select id,created,last_attempt,build_url,'
+            'select jobs.id,created,last_attempt,build_url,'
             'build_id,build_type,build_abi,build_platform,build_sdk,'
             'changeset,changeset_dirs,tree,revision,builder_type,'
-            'enable_unittests,attempts,instr(build_url,"try") as istry '
-            'from jobs where device=? order by istry desc, '
-            'created %s' % order,
-            values=(device,))
+            'enable_unittests,attempts,is_try,'
+            'tests.name,tests.config_file,tests.chunk,tests.repos,tests.guid '
+            'from jobs left join tests on tests.jobid=jobs.id '
+            'where jobs.id=(select id from jobs where device=? and attempts<? '
+            'and coalesced=0 order by %s limit 1)' % order_by,
+            values=(device, max_attempts) + order_values)
 
-        job_row = job_cursor.fetchone()
+        rows = job_cursor.fetchall()
         job_cursor.close()
-        if not job_row:
-            self._close_connection(conn)
+        if not rows:
+            self._release_connection(conn)
             return None
 
+        job_row = rows[0]
         job = {'id': job_row[0],
                'created': job_row[1],
                'last_attempt': job_row[2],
@@ -300,57 +798,168 @@ class Jobs(object):
                'attempts': job_row[15],
                'istry': job_row[16]}
         job['attempts'] += 1
-        job['last_attempt'] = datetime.datetime.utcnow().isoformat()
+        job['last_attempt'] = now
 
         self._execute_sql(
             conn,
             'update jobs set attempts=?, last_attempt=? where id=?',
             values=(job['attempts'], job['last_attempt'],
                     job['id']))
+        self._commit_connection(conn)
+        self._release_connection(conn)
 
-        job['tests'] = []
-        test_cursor = self._execute_sql(
-            conn,
-            'select name, config_file, chunk, repos, guid '
-            'from tests where jobid=?', values=(job['id'],))
-
-        test_rows = [
-            {
-                'name': test_row[0],
-                'config_file': test_row[1],
-                'chunk': test_row[2],
-                'repos' : json.loads(test_row[3]),
-                'guid': test_row[4]
-            }
-            for test_row in test_cursor
-        ]
-        test_cursor.close()
+        # A job without tests has a single row without a test.
+        tests = [(row[17], row[18], row[19], row[20], row[21])
+                 for row in rows if row[17] is not None]
+        return job, tests
 
-        for test_row in test_rows:
-            # Generate the list of tests to be executed for this job
-            test_row['repos'].sort()
-            for test in worker.tests:
-                if test.name == test_row['name'] and \
-                   test.config_file == test_row['config_file'] and \
-                   test.chunk == test_row['chunk'] and \
-                   test.repos == test_row['repos']:
-                    if not test_row['guid']:
-                        logger.error('jobs.get_next_job: invalid job_guid: %s', job)
-                        raise Exception('Found test with invalid job_guid')
-                    test.job_guid = test_row['guid']
-                    job['tests'].append(test)
-        logger.debug('jobs.get_next_job: %s', job)
+    def coalesce(self, build_url, devices, backlog, sample, max_attempts):
+        logger = utils.getLogger()
+        coalesced_jobs = []
+        app_name = utils.get_app_name_from_build_url(build_url)
+
+        conn = self._conn()
+        self._execute_sql(conn, 'begin immediate')
+        for device in devices:
+            job_cursor = self._execute_sql(
+                conn,
+                'select id, created, tree, build_type, build_abi, '
+                'build_platform, build_sdk from jobs where device=? and '
+                'build_url=? and attempts=0 and coalesced=0 and is_try=0',
+                values=(device, build_url))
+            job_row = job_cursor.fetchone()
+            job_cursor.close()
+            if not job_row:
+                continue
+            job_cursor = self._execute_sql(
+                conn,
+                'select count(id) from jobs where device=? and attempts<? '
+                'and coalesced=0',
+                values=(device, max_attempts))
+            pending = job_cursor.fetchone()[0]
+            job_cursor.close()
+            if pending <= backlog:
+                continue
+            job_cursor = self._execute_sql(
+                conn,
+                'select id, build_url, build_id, build_type, build_abi, '
+                'build_platform, build_sdk, changeset, changeset_dirs, tree, '
+                'revision, builder_type, coalesce_count from jobs '
+                'where device=? and id!=? and created<=? and tree is ? and '
+                'build_type is ? and build_abi is ? and build_platform is ? '
+                'and build_sdk is ? and attempts=0 and coalesced=0 and '
+                'is_try=0 order by created desc',
+                values=(device,) + job_row)
+            previous_row = None
+            for row in job_cursor:
+                if utils.get_app_name_from_build_url(row[1]) == app_name:
+                    previous_row = row
+                    break
+            job_cursor.close()
+            if not previous_row:
+                continue
+            job_tests = self._execute_sql(
+                conn,
+                'select name, config_file, chunk, repos from tests '
+                'where jobid=?', values=(job_row[0],)).fetchall()
+            previous_tests = self._execute_sql(
+                conn,
+                'select name, config_file, chunk, repos, guid from tests '
+                'where jobid=?', values=(previous_row[0],)).fetchall()
+            if (not job_tests or
+                set(job_tests) != set([row[:4] for row in previous_tests])):
+                continue
+            coalesce_count = previous_row[12] + 1
+            if sample and coalesce_count >= sample:
+                continue
+            self._execute_sql(
+                conn,
+                'update jobs set coalesced=1 where id=?',
+                values=(previous_row[0],))
+            self._execute_sql(
+                conn,
+                'update jobs set coalesce_count=? where id=?',
+                values=(coalesce_count, job_row[0]))
+            job = {'device': device,
+                   'build_url': previous_row[1],
+                   'build_id': previous_row[2],
+                   'build_type': previous_row[3],
+                   'build_abi': previous_row[4],
+                   'build_platform': previous_row[5],
+                   'build_sdk': previous_row[6],
+                   'changeset': previous_row[7],
+                   'changeset_dirs': json.loads(previous_row[8]),
+                   'tree': previous_row[9],
+                   'revision': previous_row[10],
+                   'builder_type': previous_row[11],
+                   'tests': [(row[0], row[1], row[2], row[4])
+                             for row in previous_tests]}
+            logger.debug('jobs.coalesce: %s superseded by %s device %s',
+                         job['build_url'], build_url, device)
+            coalesced_jobs.append(job)
         self._commit_connection(conn)
-        self._close_connection(conn)
-        return job
+        self._release_connection(conn)
+        return coalesced_jobs
 
-    def cancel_test(self, test_guid, device=None):
+    def backfill(self, device, tree):
         logger = utils.getLogger()
-        logger.debug('jobs.cancel_test: test %s device %s',
-                     test_guid, device)
-        if not device:
-            device = self.default_device
+        where = 'coalesced=1'
+        values = ()
+        if device:
+            where += ' and device=?'
+            values += (device,)
+        if tree:
+            where += ' and tree=?'
+            values += (tree,)
+
+        conn = self._conn()
+        self._execute_sql(conn, 'begin immediate')
+        job_cursor = self._execute_sql(
+            conn,
+            'select jobs.id, device, build_url, build_id, build_type, '
+            'build_abi, build_platform, build_sdk, changeset, changeset_dirs, '
+            'tree, revision, builder_type, '
+            'tests.name, tests.config_file, tests.chunk, tests.guid '
+            'from jobs join tests on tests.jobid=jobs.id where %s '
+            'order by created, jobs.id' % where,
+            values=values)
+        jobs = []
+        job = None
+        for row in job_cursor:
+            if not job or job['id'] != row[0]:
+                job = {'id': row[0],
+                       'device': row[1],
+                       'build_url': row[2],
+                       'build_id': row[3],
+                       'build_type': row[4],
+                       'build_abi': row[5],
+                       'build_platform': row[6],
+                       'build_sdk': row[7],
+                       'changeset': row[8],
+                       'changeset_dirs': json.loads(row[9]),
+                       'tree': row[10],
+                       'revision': row[11],
+                       'builder_type': row[12],
+                       'tests': []}
+                jobs.append(job)
+            job['tests'].append(row[13:17])
+        job_cursor.close()
+        self._execute_sql(
+            conn,
+            'delete from tests where jobid in (select id from jobs where %s)' %
+            where, values=values)
+        self._execute_sql(conn, 'delete from jobs where %s' % where,
+                          values=values)
+        self._commit_connection(conn)
+        self._release_connection(conn)
+        for job in jobs:
+            del job['id']
+        logger.debug('jobs.backfill: device %s tree %s: %d jobs',
+                     device, tree, len(jobs))
+        return jobs
 
+    def cancel_test(self, test_guid, device):
+        logger = utils.getLogger()
         conn = self._conn()
 
         # Get the jobid for this test.
@@ -364,7 +973,7 @@ class Jobs(object):
         if not job_ids:
             logger.debug('jobs.cancel_test: test %s for device %s '
                          'already deleted', test_guid, device)
-            self._close_connection(conn)
+            self._release_connection(conn)
             return
 
         job_id = job_ids[0]
@@ -391,77 +1000,291 @@ class Jobs(object):
                 'delete from jobs where id=?',
                 values=(job_id,))
         self._commit_connection(conn)
-        self._close_connection(conn)
+        self._release_connection(conn)
 
-    def new_treeherder_job(self, machine, project, job_collection):
-        logger = utils.getLogger()
-        logger.debug('jobs.new_treeherder_job: %s %s %s',
-                     machine, project, job_collection.__dict__)
+    def new_treeherder_job(self, machine, project, job_collection, now):
         attempts = 0
-        now = datetime.datetime.utcnow().isoformat()
         conn = self._conn()
         job_cursor = self._execute_sql(
             conn,
             'insert into treeherder values (?, ?, ?, ?, ?, ?)',
-            values=(None, attempts, now, machine, project, job_collection.to_json()))
+            values=(None, attempts, now, machine, project, job_collection))
         job_cursor.close()
         self._commit_connection(conn)
-        self._close_connection(conn)
+        self._release_connection(conn)
 
-    def get_next_treeherder_job(self):
+    def get_treeherder_jobs(self, limit, now):
         logger = utils.getLogger()
         conn = self._conn()
-
+        self._execute_sql(conn, 'begin immediate')
         job_cursor = self._execute_sql(
             conn,
-            'select id,attempts,last_attempt,machine,project,job_collection from treeherder')
-
-        job_row = job_cursor.fetchone()
+            'select id,attempts,last_attempt,machine,project,job_collection '
+            'from treeherder order by id limit ?', values=(limit,))
+        job_rows = job_cursor.fetchall()
         job_cursor.close()
-        if not job_row:
-            self._close_connection(conn)
-            return None
+        if not job_rows:
+            self._release_connection(conn)
+            return []
 
-        job = {'id': job_row[0],
-               'attempts': job_row[1],
-               'last_attempt': job_row[2],
-               'machine': job_row[3],
-               'project': job_row[4],
-               'job_collection': json.loads(job_row[5])}
-        job['attempts'] += 1
-        job['last_attempt'] = datetime.datetime.utcnow().isoformat()
-        self._execute_sql(
+        jobs = []
+        for job_row in job_rows:
+            jobs.append({'id': job_row[0],
+                         'attempts': job_row[1] + 1,
+                         'last_attempt': now,
+                         'machine': job_row[3],
+                         'project': job_row[4],
+                         'job_collection': json.loads(job_row[5])})
+        self._executemany_sql(
             conn,
             'update treeherder set attempts=?, last_attempt=? where id=?',
-            values=(job['attempts'], job['last_attempt'],
-                    job['id']))
+            [(job['attempts'], job['last_attempt'], job['id']) for job in jobs])
 
-        logger.debug('jobs.get_next_treeherder_job: %s', job)
+        logger.debug('jobs.get_treeherder_jobs: %s', [job['id'] for job in jobs])
         self._commit_connection(conn)
-        self._close_connection(conn)
-        return job
+        self._release_connection(conn)
+        return jobs
 
-    def treeherder_job_completed(self, th_id):
-        logger = utils.getLogger()
-        logger.debug('jobs.treeherder_job_completed: %s', th_id)
+    def treeherder_jobs_completed(self, th_ids):
         conn = self._conn()
-        self._execute_sql(conn, 'delete from treeherder where id=?', values=(th_id,))
+        self._executemany_sql(conn, 'delete from treeherder where id=?',
+                              [(th_id,) for th_id in th_ids])
         self._commit_connection(conn)
-        self._close_connection(conn)
+        self._release_connection(conn)
 
-    def test_completed(self, test_guid):
-        logger = utils.getLogger()
-        logger.debug('jobs.test_completed: %s', test_guid)
+    def test_completed(self, test_guid, device):
         conn = self._conn()
         self._execute_sql(conn, 'delete from tests where guid=?', values=(test_guid,))
         self._commit_connection(conn)
-        self._close_connection(conn)
+        self._release_connection(conn)
 
-    def job_completed(self, job_id):
-        logger = utils.getLogger()
-        logger.debug('jobs.job_completed: %s', job_id)
+    def job_completed(self, job_id, device, now, runtime_weight):
         conn = self._conn()
+        job_cursor = self._execute_sql(
+            conn,
+            'select jobs.device, jobs.tree, '
+            '(julianday(?) - julianday(last_attempt)) * 86400, runtime '
+            'from jobs left join job_runtimes on '
+            'job_runtimes.device=jobs.device and job_runtimes.tree=jobs.tree '
+            'where id=?', values=(now, job_id))
+        job_row = job_cursor.fetchone()
+        job_cursor.close()
+        if job_row and job_row[2] is not None:
+            device, tree, runtime, average = job_row
+            if average is not None:
+                runtime = (runtime_weight * runtime +
+                           (1 - runtime_weight) * average)
+            self._execute_sql(
+                conn,
+                'insert or replace into job_runtimes values (?, ?, ?)',
+                values=(device, tree, runtime))
         self._execute_sql(conn, 'delete from tests where jobid=?', values=(job_id,))
         self._execute_sql(conn, 'delete from jobs where id=?', values=(job_id,))
         self._commit_connection(conn)
-        self._close_connection(conn)
+        self._release_connection(conn)
+
+
+class ShardedSQLiteJobsStorage(JobsStorage):
+    """ShardedSQLiteJobsStorage keeps the jobs of each device in its
+    own sqlite database so that the transactions of a device's worker
+    never wait for those of the other workers. The Treeherder requests
+    and the jobs queued without a device are kept in a shared
+    database. Each database is an SQLiteJobsStorage.
+
+    Operations on several devices, such as queueing a build for all of
+    the devices, are made in a separate transaction for each device.
+    """
+
+    def __init__(self, mailer, filename='jobs.sqlite',
+                 shard_filename='jobs-%s.sqlite'):
+        """Initializes the ShardedSQLiteJobsStorage object.
+
+        :param mailer: Mailer used to report database errors.
+        :param filename: the shared database.
+        :param shard_filename: the database of a device where %s is
+            replaced by the device.
+        """
+        self.mailer = mailer
+        self.shard_filename = shard_filename
+        self.shared = SQLiteJobsStorage(mailer, filename)
+        # The SQLiteJobsStorages of the devices indexed by device
+        # which are created on first use. dict.setdefault is atomic so
+        # that the storage may be used by several threads without a
+        # lock which could be held across fork.
+        self._shards = {}
+
+    def _shard(self, device):
+        if not device:
+            return self.shared
+        shard = self._shards.get(device)
+        if not shard:
+            new_shard = SQLiteJobsStorage(self.mailer,
+                                          self.shard_filename % device)
+            shard = self._shards.setdefault(device, new_shard)
+            if shard is new_shard:
+                self._move_shared_jobs(device, shard)
+        return shard
+
+    def _move_shared_jobs(self, device, shard):
+        """Move the jobs and job runtimes of device which are still
+        in the shared database, such as those queued before the
+        storage was sharded, to the device's database. The move is
+        made in a single transaction with the shared database attached
+        to the device's connection. The device's tables are qualified
+        with main so that they are never resolved to the shared
+        database's tables."""
+        logger = utils.getLogger()
+        conn = shard._conn()
+        shard._execute_sql(conn, 'attach database ? as shared',
+                           values=(self.shared.filename,))
+        try:
+            shard._execute_sql(conn, 'begin immediate')
+            job_cursor = shard._execute_sql(
+                conn, 'select * from shared.jobs where device=? order by id',
+                values=(device,))
+            columns = [column[0] for column in job_cursor.description]
+            job_rows = job_cursor.fetchall()
+            job_cursor.close()
+            if not job_rows:
+                return
+            id_index = columns.index('id')
+            del columns[id_index]
+            insert_sql = 'insert into main.jobs (%s) values (%s)' % (
+                ', '.join(columns), ','.join('?' * len(columns)))
+            for job_row in job_rows:
+                job_row = list(job_row)
+                job_id = job_row.pop(id_index)
+                job_cursor = shard._execute_sql(conn, insert_sql,
+                                                values=job_row)
+                shard._execute_sql(
+                    conn,
+                    'insert into main.tests (name, config_file, chunk, guid, '
+                    'repos, jobid) select name, config_file, chunk, guid, '
+                    'repos, ? from shared.tests where jobid=?',
+                    values=(job_cursor.lastrowid, job_id))
+                job_cursor.close()
+            shard._execute_sql(
+                conn,
+                'delete from shared.tests where jobid in '
+                '(select id from shared.jobs where device=?)',
+                values=(device,))
+            shard._execute_sql(conn, 'delete from shared.jobs where device=?',
+                               values=(device,))
+            shard._execute_sql(
+                conn,
+                'insert or ignore into main.job_runtimes '
+                'select * from shared.job_runtimes where device=?',
+                values=(device,))
+            shard._execute_sql(
+                conn, 'delete from shared.job_runtimes where device=?',
+                values=(device,))
+            shard._commit_connection(conn)
+            logger.info('jobs: moved %d jobs of %s from %s to %s',
+                        len(job_rows), device, self.shared.filename,
+                        shard.filename)
+        finally:
+            shard._release_connection(conn)
+            shard._execute_sql(conn, 'detach database shared')
+
+    def _all_shards(self):
+        """Return the shared storage and the storages of all of the
+        devices which have a database, including those created by
+        other processes."""
+        prefix, suffix = self.shard_filename.split('%s')
+        for path in glob.glob(self.shard_filename % '*'):
+            self._shard(path[len(prefix):len(path) - len(suffix)])
+        return [self.shared] + [self._shards[device]
+                                for device in sorted(self._shards)]
+
+    def clear_all(self):
+        for shard in self._all_shards():
+            shard.clear_all()
+
+    def enqueue(self, build, device_jobs, allow_duplicates, now):
+        new_guids = {}
+        for device_job in device_jobs:
+            new_guids.update(self._shard(device_job[0]).enqueue(
+                build, [device_job], allow_duplicates, now))
+        return new_guids
+
+    def jobs_pending(self, device):
+        return self._shard(device).jobs_pending(device)
+
+    def set_job_attempts(self, job_id, attempts, device):
+        self._shard(device).set_job_attempts(job_id, attempts, device)
+
+    def delete_expired_jobs(self, device, max_attempts, now, coalesce_expires):
+        self._shard(device).delete_expired_jobs(device, max_attempts, now,
+                                                coalesce_expires)
+
+    def claim_next_job(self, device, scheduler, lifo, now, max_attempts):
+        return self._shard(device).claim_next_job(device, scheduler, lifo,
+                                                  now, max_attempts)
+
+    def coalesce(self, build_url, devices, backlog, sample, max_attempts):
+        coalesced_jobs = []
+        for device in devices:
+            coalesced_jobs.extend(self._shard(device).coalesce(
+                build_url, [device], backlog, sample, max_attempts))
+        return coalesced_jobs
+
+    def backfill(self, device, tree):
+        if device:
+            return self._shard(device).backfill(device, tree)
+        backfill_jobs = []
+        for shard in self._all_shards():
+            backfill_jobs.extend(shard.backfill(device, tree))
+        return backfill_jobs
+
+    def cancel_test(self, test_guid, device):
+        self._shard(device).cancel_test(test_guid, device)
+
+    def test_completed(self, test_guid, device):
+        self._shard(device).test_completed(test_guid, device)
+
+    def job_completed(self, job_id, device, now, runtime_weight):
+        self._shard(device).job_completed(job_id, device, now, runtime_weight)
+
+    def new_treeherder_job(self, machine, project, job_collection, now):
+        self.shared.new_treeherder_job(machine, project, job_collection, now)
+
+    def get_treeherder_jobs(self, limit, now):
+        return self.shared.get_treeherder_jobs(limit, now)
+
+    def treeherder_jobs_completed(self, th_ids):
+        self.shared.treeherder_jobs_completed(th_ids)
+
+
+def get_storage(name, mailer):
+    """Returns the JobsStorage for the job_storage option.
+
+    :param name: 'sqlite' or '' for the SQLiteJobsStorage of
+        jobs.sqlite, 'sharded' for a ShardedSQLiteJobsStorage which
+        keeps the jobs of each device in jobs-<device>.sqlite and the
+        Treeherder requests in jobs.sqlite, 'memory' for a
+        MemoryJobsStorage journaled to jobs.journal and jobs.snapshot
+        which is kept by a separate process. See memoryjobs.py.
+    :param mailer: Mailer used to report database errors.
+    :raises: ValueError if name is invalid.
+    """
+    if name in ('', 'sqlite'):
+        return SQLiteJobsStorage(mailer)
+    if name == 'sharded':
+        return ShardedSQLiteJobsStorage(mailer)
+    if name == 'memory':
+        # memoryjobs imports this module.
+        import memoryjobs
+        return memoryjobs.start_storage()
+    raise ValueError('Unknown job storage %s' % name)
+
+
+def stop_storage(storage):
+    """Stops the process of a storage returned by get_storage() which
+    keeps its jobs in a separate process. It must be called by the
+    process which created the storage before it exits or execs since
+    the storage's process ignores SIGINT.
+
+    :param storage: the JobsStorage returned by get_storage().
+    """
+    import memoryjobs
+    memoryjobs.stop_storage(storage)
@@ -0,0 +1,155 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import utils
+
+
+class JobScheduler(object):
+    """JobScheduler is the base class of the policies used by
+    Jobs.get_next_job to choose the next of a device's jobs.
+
+    A policy orders the device's jobs with an SQL ORDER BY clause so
+    that the jobs are ranked by the database when they are claimed.
+    The clause may refer to the columns of the jobs table and to
+    the runtime column of the job_runtimes table which records the
+    average runtime in seconds of the jobs for each device and tree.
+    Storages which do not use SQL rank the jobs with sort_key which
+    must order them in the same way.
+    """
+
+    def order_by(self, lifo, now):
+        """Returns a tuple (sql, values) where sql is the ORDER BY
+        clause, without the ORDER BY keywords, and values are the
+        values of its parameters.
+
+        :param lifo: True if the newest jobs should be preferred.
+        :param now: the current time as an isoformat string.
+        """
+        raise NotImplementedError
+
+    def sort_key(self, job, runtime, lifo, now):
+        """Returns the key of the job. The job with the lowest key is
+        run first.
+
+        :param job: dict of the job's created, tree, is_try and
+            attempts columns.
+        :param runtime: the average runtime in seconds of the jobs for
+            the job's device and tree or None if it is not known.
+        :param lifo: True if the newest jobs should be preferred.
+        :param now: the current time as an isoformat string.
+        """
+        raise NotImplementedError
+
+
+class FifoScheduler(JobScheduler):
+    """Runs try jobs first, then the remaining jobs in the order they
+    were created or in reverse order if lifo is set. This is the
+    default policy."""
+
+    def order_by(self, lifo, now):
+        return 'is_try desc, created %s' % ('desc' if lifo else 'asc'), ()
+
+    def sort_key(self, job, runtime, lifo, now):
+        age = utils.seconds_between(job['created'], now)
+        return (-job['is_try'], age if lifo else -age)
+
+
+class CostAwareScheduler(JobScheduler):
+    """Ranks jobs by a score in points and runs the job with the
+    highest score first. The score is the sum of
+
+    * the weight of the job's repository,
+    * TRY_WEIGHT if the job is for a try build,
+    * AGE_WEIGHT for each hour the job has been queued,
+    * -ATTEMPTS_WEIGHT for each previous attempt, and
+    * -RUNTIME_WEIGHT for each minute of the job's estimated runtime,
+      the average runtime of the previous jobs for the same device and
+      tree or DEFAULT_RUNTIME seconds if there are none.
+
+    Repositories with a higher weight are preferred while the age term
+    eventually runs the jobs of every repository. Preferring short jobs
+    reduces the average latency when the device can not keep up with
+    the builds. If lifo is set, the age term prefers newer jobs.
+    """
+
+    DEFAULT_REPO_WEIGHTS = {
+        'mozilla-central': 20,
+        'mozilla-beta': 30,
+        'mozilla-release': 30,
+    }
+    TRY_WEIGHT = 10
+    AGE_WEIGHT = 1.0
+    ATTEMPTS_WEIGHT = 5
+    RUNTIME_WEIGHT = 0.5
+    DEFAULT_RUNTIME = 1800
+
+    def __init__(self, repo_weights=None):
+        """Initializes the CostAwareScheduler object.
+
+        :param repo_weights: optional dict mapping repositories to
+            their weights which replace DEFAULT_REPO_WEIGHTS.
+            Repositories without a weight have a weight of 0.
+        """
+        if repo_weights is None:
+            repo_weights = self.DEFAULT_REPO_WEIGHTS
+        self.repo_weights = dict(repo_weights)
+
+    def order_by(self, lifo, now):
+        values = []
+        if self.repo_weights:
+            repo_weight = 'case tree'
+            for repo, weight in sorted(self.repo_weights.items()):
+                repo_weight += ' when ? then ?'
+                values.extend([repo, weight])
+            repo_weight += ' else 0 end'
+        else:
+            repo_weight = '0'
+        age_weight = -self.AGE_WEIGHT if lifo else self.AGE_WEIGHT
+        sql = ('(%s + ? * is_try + '
+               '? * (julianday(?) - julianday(created)) * 24 - '
+               '? * attempts - '
+               '? * coalesce((select runtime from job_runtimes where '
+               'job_runtimes.device=jobs.device and '
+               'job_runtimes.tree=jobs.tree), ?) / 60) desc, '
+               'created asc' % repo_weight)
+        values.extend([self.TRY_WEIGHT, age_weight, now,
+                       self.ATTEMPTS_WEIGHT, self.RUNTIME_WEIGHT,
+                       self.DEFAULT_RUNTIME])
+        return sql, tuple(values)
+
+    def sort_key(self, job, runtime, lifo, now):
+        age = utils.seconds_between(job['created'], now) / 3600
+        age_weight = -self.AGE_WEIGHT if lifo else self.AGE_WEIGHT
+        if runtime is None:
+            runtime = self.DEFAULT_RUNTIME
+        score = (self.repo_weights.get(job['tree'], 0) +
+                 self.TRY_WEIGHT * job['is_try'] +
+                 age_weight * age -
+                 self.ATTEMPTS_WEIGHT * job['attempts'] -
+                 self.RUNTIME_WEIGHT * runtime / 60)
+        return (-score, -age)
+
+
+def get_scheduler(name, repo_weights=None):
+    """Returns the JobScheduler for the job_scheduler option.
+
+    :param name: 'fifo' or '' for FifoScheduler, 'cost' for
+        CostAwareScheduler.
+    :param repo_weights: optional list of repo:weight strings for
+        CostAwareScheduler.
+    :raises: ValueError if name or a weight is invalid.
+    """
+    if name in ('', 'fifo'):
+        return FifoScheduler()
+    if name == 'cost':
+        weights = None
+        if repo_weights:
+            weights = {}
+            for item in repo_weights:
+                repo, _, weight = item.rpartition(':')
+                if not repo:
+                    raise ValueError('Invalid repo weight %s' % item)
+                weights[repo] = float(weight)
+        return CostAwareScheduler(repo_weights=weights)
+    raise ValueError('Unknown job scheduler %s' % name)
@@ -0,0 +1,136 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import array
+
+
+class LogcatBuffer(object):
+    """LogcatBuffer accumulates the lines of successive dumps of a
+    device's logcat buffer without duplicates.
+
+    The lines are stored UTF-8 encoded and newline terminated in a
+    single bytearray with an array of end offsets rather than as a
+    list of strings, and are only decoded when they are returned.
+
+    Since the device's logcat buffer is only appended to until it is
+    cleared or wraps, the new lines of a dump are those which follow
+    the last accumulated lines. accumulate() locates them with a single
+    backward scan of the dump instead of comparing the dates of the
+    lines, so lines with bogus MM-DD dates do not require any special
+    handling. If the last accumulated lines are not found, the
+    device's buffer was cleared or has wrapped since the previous dump
+    and all of the dump's lines are new.
+
+    ::
+
+       logcat = LogcatBuffer()
+       start = logcat.accumulate(adbdevice.get_logcat())
+       new_lines = logcat.lines(start)
+       all_lines = logcat.lines()
+    """
+
+    def __init__(self, anchor_lines=3):
+        """Initializes the LogcatBuffer object.
+
+        :param integer anchor_lines: the number of most recently
+            accumulated lines which must match in a dump to locate
+            the new lines.
+        """
+        self._anchor_lines = anchor_lines
+        self._data = bytearray()
+        self._offsets = array.array('L')
+        # Index of the first line which may be used as an anchor. It
+        # is moved past the end of the buffer when the device's
+        # buffer is cleared.
+        self._anchor_start = 0
+
+    def __len__(self):
+        return len(self._offsets)
+
+    @property
+    def size(self):
+        """The number of bytes used to store the lines."""
+        return len(self._data) + self._offsets.itemsize * len(self._offsets)
+
+    def _get(self, index):
+        start = self._offsets[index - 1] if index else 0
+        return str(self._data[start:self._offsets[index] - 1])
+
+    def append(self, line):
+        """Appends a line.
+
+        :param line: the line as a UTF-8 encoded str or as unicode.
+        """
+        if isinstance(line, unicode):
+            line = line.encode('UTF-8')
+        self._data.extend(line)
+        self._data.append('\n')
+        self._offsets.append(len(self._data))
+
+    def line(self, index):
+        """Returns the line at index as unicode."""
+        if index < 0:
+            index += len(self._offsets)
+        return unicode(self._get(index), 'UTF-8', errors='replace')
+
+    def lines(self, start=0):
+        """Returns a list of the lines from start to the end as
+        unicode."""
+        if start >= len(self._offsets):
+            return []
+        begin = self._offsets[start - 1] if start else 0
+        return unicode(str(self._data[begin:]), 'UTF-8',
+                       errors='replace').split(u'\n')[:-1]
+
+    def write(self, fileobj, start=0, chunk_size=1024*1024):
+        """Writes the lines from start to the end to fileobj as UTF-8
+        encoded newline terminated lines without decoding them.
+
+        :returns: the number of lines written.
+        """
+        if start >= len(self._offsets):
+            return 0
+        begin = self._offsets[start - 1] if start else 0
+        for offset in xrange(begin, len(self._data), chunk_size):
+            fileobj.write(str(self._data[offset:offset + chunk_size]))
+        return len(self._offsets) - start
+
+    def cleared(self):
+        """Notes that the device's logcat buffer was cleared so that
+        all of the lines of the next dump are accumulated."""
+        self._anchor_start = len(self._offsets)
+
+    def _find_new_lines(self, dump):
+        """Returns the index of the first line in dump following the
+        last accumulated lines, or 0 if they are not in dump."""
+        count = min(self._anchor_lines, len(self._offsets) - self._anchor_start)
+        if count <= 0:
+            return 0
+        anchor = [self._get(index) for index in
+                  xrange(len(self._offsets) - count, len(self._offsets))]
+        last = anchor[-1]
+        for index in xrange(len(dump) - 1, -1, -1):
+            if dump[index] != last:
+                continue
+            # Near the start of the dump the earlier anchor lines may
+            # already have been dropped from the device's buffer.
+            matched = min(count, index + 1)
+            if dump[index - matched + 1:index + 1] == anchor[count - matched:]:
+                return index + 1
+        return 0
+
+    def accumulate(self, raw_lines):
+        """Accumulates the lines of a dump of the device's logcat
+        buffer which have not already been accumulated.
+
+        :param list raw_lines: the lines of the dump as UTF-8 encoded
+            strs.
+        :returns: the index of the first accumulated line of the dump.
+        """
+        start = len(self._offsets)
+        dump = [line.strip() for line in raw_lines]
+        dump = [line for line in dump if line]
+        for index in xrange(self._find_new_lines(dump), len(dump)):
+            self.append(dump[index])
+        return start
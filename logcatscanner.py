@@ -0,0 +1,162 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import re
+from collections import namedtuple
+
+# Event names and patterns for the messages emitted by Fennec and
+# geckoview_example which are used by the tests.
+APP_START = 'app_start'
+THROBBER_START = 'throbber_start'
+THROBBER_STOP = 'throbber_stop'
+PAGE_LOAD_START = 'page_load_start'
+TP_REPORT_ROW = 'tp_report_row'
+TP_REPORT_END = 'tp_report_end'
+
+# The timestamp which starts each line of logcat -v time.
+LOGCAT_PREFIX = r'\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{3}'
+
+# Patterns are matched at the start of the line. The messages logged
+# by Gecko and GeckoViewActivity are matched only as the tag of a line
+# rather than where a message quotes them.
+GECKO_PATTERNS = {
+    # groups: zerdatime
+    APP_START: (r'%s ..Gecko.*zerdatime (\d+) - .*application start' %
+                LOGCAT_PREFIX),
+    # groups: zerdatime, Throbber or page load
+    THROBBER_START: (r'%s ..Gecko.*zerdatime (\d+) - (Throbber|page load) start' %
+                     LOGCAT_PREFIX),
+    THROBBER_STOP: (r'%s ..Gecko.*zerdatime (\d+) - (Throbber|page load) stop' %
+                    LOGCAT_PREFIX),
+    # groups: url
+    PAGE_LOAD_START: (r'%s I/GeckoViewActivity.*Starting to load page at (.*)' %
+                      LOGCAT_PREFIX),
+    # groups: page name, ; separated run times
+    TP_REPORT_ROW: r'.*\|[0-9];([a-zA-Z0-9\.\/\-]+);([0-9;]+)',
+    TP_REPORT_END: r'.*__end_tp_report',
+}
+
+# The page load stop of geckoview_example without the Throbber stop of
+# Fennec. groups: zerdatime
+PAGE_LOAD_STOP_PATTERN = (THROBBER_STOP,
+                          r'%s ..Gecko.*zerdatime (\d+) - page load stop' %
+                          LOGCAT_PREFIX)
+
+#: name is the name of the matching pattern, line is the logcat line
+#: and groups is the tuple of the pattern's groups.
+LogcatEvent = namedtuple('LogcatEvent', ['name', 'line', 'groups'])
+
+
+class LogcatScanner(object):
+    """LogcatScanner matches logcat lines against a set of named
+    patterns combined into a single regular expression and returns a
+    LogcatEvent for each matching line.
+
+    When created with a worker's Logcat, the scanner keeps its own
+    cursor so that each poll() examines only the lines which were
+    logged since the previous poll() independently of any calls to
+    Logcat.get(). The cursor starts at the first line not yet returned
+    by Logcat.get(), i.e. the lines since the last Logcat.clear().
+
+    Each line produces at most one event. Patterns are matched at the
+    start of the line. If several patterns match, the first in the
+    order of the patterns wins. Patterns may contain numbered but not
+    named groups or backreferences.
+
+    ::
+
+       scanner = LogcatScanner(worker_subprocess.logcat,
+                               [THROBBER_START, THROBBER_STOP])
+       for event in scanner.poll():
+           if event.name == THROBBER_STOP:
+               throbber_stop = int(event.groups[0])
+    """
+
+    def __init__(self, logcat=None, patterns=None, logger=None):
+        """Initializes the LogcatScanner object.
+
+        :param logcat: the worker's Logcat object used by poll() or
+            None if only scan() is used.
+        :param list patterns: the patterns to match. Each item is
+            either the name of one of the GECKO_PATTERNS or a
+            (name, regular expression) tuple such as
+            PAGE_LOAD_STOP_PATTERN.
+        :param logger: optional logger used to log each line at debug
+            level.
+        """
+        self._logcat = logcat
+        self._logger = logger
+        self._cursor = logcat.cursor() if logcat else None
+        self._pending = []
+        self._ignored_urls = set()
+        self._ignoring = False
+        # _names maps the index of the group enclosing each pattern
+        # in the combined expression to the pattern's name and number
+        # of groups.
+        self._names = {}
+        alternatives = []
+        group = 1
+        for pattern in patterns or []:
+            if isinstance(pattern, basestring):
+                name, regex = pattern, GECKO_PATTERNS[pattern]
+            else:
+                name, regex = pattern
+            groups = re.compile(regex).groups
+            self._names[group] = (name, groups)
+            alternatives.append('(%s)' % regex)
+            group += groups + 1
+        self._re = re.compile('|'.join(alternatives))
+
+    def ignore_pages(self, urls):
+        """Ignore the loads of the given urls. The PAGE_LOAD_START
+        event of an ignored url is returned but the events which follow
+        it are dropped up to and including the next THROBBER_STOP. This
+        is used to skip the about:blank and https://mozilla.org/ loads
+        of geckoview_example.
+
+        :param list urls: the urls to ignore.
+        """
+        self._ignored_urls = set(urls)
+
+    def scan(self, lines):
+        """Returns the list of LogcatEvents for lines."""
+        events = []
+        for line in lines:
+            if self._logger:
+                self._logger.debug('LogcatScanner: %s', line)
+            match = self._re.match(line)
+            if not match:
+                continue
+            name, groups = self._names[match.lastindex]
+            event = LogcatEvent(name, line,
+                                match.groups()[match.lastindex:
+                                               match.lastindex + groups])
+            if self._ignoring:
+                if name == THROBBER_STOP:
+                    self._ignoring = False
+                continue
+            if name == PAGE_LOAD_START and event.groups[0] in self._ignored_urls:
+                self._ignoring = True
+            events.append(event)
+        return events
+
+    def poll(self):
+        """Returns the list of LogcatEvents for the lines logged since
+        the previous poll() preceded by any events returned with
+        unread()."""
+        lines, self._cursor = self._logcat.read(self._cursor)
+        events = self._pending + self.scan(lines)
+        self._pending = []
+        return events
+
+    def unread(self, events):
+        """Returns events to the scanner so that they are returned
+        again by the next poll()."""
+        self._pending = list(events) + self._pending
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds for more lines to be logged."""
+        if self._pending:
+            return
+        self._logcat.wait(self._cursor, timeout)
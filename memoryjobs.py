@@ -0,0 +1,496 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import signal
+import threading
+from multiprocessing.managers import BaseManager
+
+import utils
+from jobs import JobsStorage
+
+
+class MemoryJobsStorage(JobsStorage):
+    """MemoryJobsStorage keeps the jobs in the memory of a single
+    process. It avoids the file locking of SQLiteJobsStorage on hosts
+    where many workers contend for the database. start_storage()
+    keeps the storage in a manager process which serves it to the
+    autophone process and the workers.
+
+    Each change is appended to the journal file <path>.journal as a
+    json encoded line which lists its effects before they are applied.
+    After SNAPSHOT_INTERVAL changes, the state is written to
+    <path>.snapshot and the journal is truncated. When the storage is
+    created it loads the snapshot and replays the journal so that the
+    changes made before a crash are recovered. A partially written
+    last line is ignored. Lines are flushed but not synced, so that
+    like the synchronous=normal setting of SQLiteJobsStorage a crash
+    of the process loses nothing but a crash of the host may lose the
+    latest changes.
+
+    The effects are idempotent so that a journal which was not
+    truncated after its snapshot was written can be replayed again:
+
+    * ['job', job] sets the job with job's id.
+    * ['delete_job', id] deletes the job and its tests.
+    * ['test', guid, [jobid, name, config_file, chunk, repos]] sets
+      the test.
+    * ['delete_test', guid] deletes the test.
+    * ['runtime', device, tree, runtime] sets an average runtime.
+    * ['treeherder', request] sets the Treeherder request.
+    * ['delete_treeherder', id] deletes the Treeherder request.
+    * ['clear'] deletes all of the jobs, tests and requests.
+    """
+
+    SNAPSHOT_INTERVAL = 1000
+
+    def __init__(self, path='jobs'):
+        self.journal_path = '%s.journal' % path
+        self.snapshot_path = '%s.snapshot' % path
+        # The storage is shared by the manager's threads.
+        self._lock = threading.RLock()
+        self._journal = None
+        self._changes = 0
+        self._reset()
+        self._load()
+
+    def _reset(self):
+        # _jobs maps the job ids to the jobs which are dicts of the
+        # columns of SQLiteJobsStorage's jobs table.
+        self._jobs = {}
+        self._device_jobs = {}
+        # _tests maps the guids of the tests to their [jobid, name,
+        # config_file, chunk, repos] and _job_tests maps the job ids to
+        # the guids of their tests.
+        self._tests = {}
+        self._job_tests = {}
+        self._runtimes = {}
+        self._treeherder = {}
+        self._next_job_id = 1
+        self._next_treeherder_id = 1
+
+    def _apply(self, effect):
+        op = effect[0]
+        if op == 'job':
+            job = effect[1]
+            self._jobs[job['id']] = job
+            self._device_jobs.setdefault(job['device'], set()).add(job['id'])
+            self._job_tests.setdefault(job['id'], [])
+            self._next_job_id = max(self._next_job_id, job['id'] + 1)
+        elif op == 'delete_job':
+            job = self._jobs.pop(effect[1], None)
+            if job:
+                self._device_jobs[job['device']].discard(job['id'])
+                for guid in self._job_tests.pop(job['id']):
+                    del self._tests[guid]
+        elif op == 'test':
+            guid, row = effect[1], effect[2]
+            if guid not in self._tests:
+                self._job_tests.setdefault(row[0], []).append(guid)
+            self._tests[guid] = row
+        elif op == 'delete_test':
+            row = self._tests.pop(effect[1], None)
+            if row:
+                self._job_tests[row[0]].remove(effect[1])
+        elif op == 'runtime':
+            self._runtimes[(effect[1], effect[2])] = effect[3]
+        elif op == 'treeherder':
+            request = effect[1]
+            self._treeherder[request['id']] = request
+            self._next_treeherder_id = max(self._next_treeherder_id,
+                                           request['id'] + 1)
+        elif op == 'delete_treeherder':
+            self._treeherder.pop(effect[1], None)
+        elif op == 'clear':
+            self._jobs = {}
+            self._device_jobs = {}
+            self._tests = {}
+            self._job_tests = {}
+            self._treeherder = {}
+        else:
+            raise ValueError('Unknown journal effect %s' % effect)
+
+    def _commit(self, effects):
+        """Journal and apply the effects of a change."""
+        if not effects:
+            return
+        self._journal.write(json.dumps(effects) + '\n')
+        self._journal.flush()
+        for effect in effects:
+            self._apply(effect)
+        self._changes += 1
+        if self._changes >= self.SNAPSHOT_INTERVAL:
+            self._snapshot()
+
+    def _load(self):
+        logger = utils.getLogger()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as snapshot:
+                for effect in json.load(snapshot):
+                    self._apply(effect)
+        if os.path.exists(self.journal_path):
+            changes = 0
+            with open(self.journal_path) as journal:
+                for line in journal:
+                    try:
+                        effects = json.loads(line)
+                    except ValueError:
+                        logger.warning('MemoryJobsStorage: ignoring incomplete '
+                                       'change %d in %s',
+                                       changes + 1, self.journal_path)
+                        break
+                    for effect in effects:
+                        self._apply(effect)
+                    changes += 1
+            logger.info('MemoryJobsStorage: recovered %d changes from %s',
+                        changes, self.journal_path)
+        self._snapshot()
+
+    def _snapshot(self):
+        """Write the state to the snapshot and truncate the journal."""
+        effects = []
+        for job_id in sorted(self._jobs):
+            effects.append(['job', self._jobs[job_id]])
+            for guid in self._job_tests[job_id]:
+                effects.append(['test', guid, self._tests[guid]])
+        for (device, tree), runtime in sorted(self._runtimes.items()):
+            effects.append(['runtime', device, tree, runtime])
+        for request_id in sorted(self._treeherder):
+            effects.append(['treeherder', self._treeherder[request_id]])
+        temp_path = '%s.tmp' % self.snapshot_path
+        with open(temp_path, 'w') as snapshot:
+            json.dump(effects, snapshot)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(temp_path, self.snapshot_path)
+        if self._journal:
+            self._journal.close()
+        self._journal = open(self.journal_path, 'w')
+        self._changes = 0
+
+    def _device_job_list(self, device):
+        return [self._jobs[job_id]
+                for job_id in self._device_jobs.get(device, ())]
+
+    def _job_dict(self, job):
+        """Return the job as returned by claim_next_job."""
+        return {'id': job['id'],
+                'created': job['created'],
+                'last_attempt': job['last_attempt'],
+                'build_url': job['build_url'],
+                'build_id': job['build_id'],
+                'build_type': job['build_type'],
+                'build_abi': job['build_abi'],
+                'build_platform': job['build_platform'],
+                'build_sdk': job['build_sdk'],
+                'changeset': job['changeset'],
+                'changeset_dirs': json.loads(job['changeset_dirs']),
+                'tree': job['tree'],
+                'revision': job['revision'],
+                'builder_type': job['builder_type'],
+                'enable_unittests': job['enable_unittests'],
+                'attempts': job['attempts'],
+                'istry': job['is_try']}
+
+    def _build_dict(self, job):
+        """Return the job as returned by coalesce and backfill."""
+        build = self._job_dict(job)
+        for key in ('id', 'created', 'last_attempt', 'enable_unittests',
+                    'attempts', 'istry'):
+            del build[key]
+        build['device'] = job['device']
+        build['tests'] = [tuple(self._tests[guid][1:4]) + (guid,)
+                          for guid in self._job_tests[job['id']]]
+        return build
+
+    def _test_keys(self, job_id):
+        return set([tuple(self._tests[guid][1:])
+                    for guid in self._job_tests[job_id]])
+
+    def clear_all(self):
+        with self._lock:
+            self._commit([['clear']])
+
+    def enqueue(self, build, device_jobs, allow_duplicates, now):
+        logger = utils.getLogger()
+        build_url = build['build_url']
+        new_guids = dict([(device_job[0], []) for device_job in device_jobs])
+        with self._lock:
+            effects = []
+            next_job_id = self._next_job_id
+            for device, enable_unittests, attempts, tests in device_jobs:
+                job_id = None
+                existing_tests = set()
+                if not allow_duplicates:
+                    # Jobs skipped by coalesce() are left for backfill
+                    # so that a retriggered build is queued again.
+                    for job in self._device_job_list(device):
+                        if job['build_url'] == build_url and \
+                           not job['coalesced']:
+                            job_id = job['id']
+                            existing_tests = self._test_keys(job_id)
+                            break
+                if not job_id:
+                    job_id = next_job_id
+                    next_job_id += 1
+                    effects.append(['job', {
+                        'id': job_id,
+                        'created': now,
+                        'last_attempt': None,
+                        'build_url': build_url,
+                        'build_id': build.get('build_id'),
+                        'build_type': build.get('build_type'),
+                        'build_abi': build.get('build_abi'),
+                        'build_platform': build.get('build_platform'),
+                        'build_sdk': build.get('build_sdk'),
+                        'changeset': build.get('changeset'),
+                        'changeset_dirs': json.dumps(
+                            build.get('changeset_dirs', [])),
+                        'tree': build.get('tree'),
+                        'revision': build.get('revision'),
+                        'builder_type': build.get('builder_type'),
+                        'enable_unittests': int(enable_unittests),
+                        'attempts': attempts,
+                        'device': device,
+                        'is_try': int('try' in build_url),
+                        'coalesced': 0,
+                        'coalesce_count': 0}])
+                for name, config_file, chunk, repos, guid in tests:
+                    if (name, config_file, chunk, repos) in existing_tests:
+                        logger.warning(
+                            'jobs.enqueue: duplicate test: %s, device: %s, '
+                            'name: %s, config_file: %s, chunk: %s, repos: %s',
+                            build_url, device, name, config_file, chunk, repos)
+                        continue
+                    new_guids[device].append(guid)
+                    effects.append(['test', guid,
+                                    [job_id, name, config_file, chunk, repos]])
+            self._commit(effects)
+        return new_guids
+
+    def jobs_pending(self, device):
+        with self._lock:
+            return len([job for job in self._device_job_list(device)
+                        if not job['coalesced']])
+
+    def set_job_attempts(self, job_id, attempts, device):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                self._commit([['job', dict(job, attempts=attempts)]])
+
+    def delete_expired_jobs(self, device, max_attempts, now, coalesce_expires):
+        logger = utils.getLogger()
+        # A coalesce_expires of 0 never expires the coalesced jobs.
+        expires = coalesce_expires * 86400
+        with self._lock:
+            effects = [['delete_job', job['id']]
+                       for job in self._device_job_list(device)
+                       if job['attempts'] >= max_attempts or
+                       (job['coalesced'] and expires and
+                        utils.seconds_between(job['created'], now) > expires)]
+            self._commit(effects)
+        if effects:
+            logger.debug('jobs.delete_expired_jobs: deleted %d jobs device %s',
+                         len(effects), device)
+
+    def claim_next_job(self, device, scheduler, lifo, now, max_attempts):
+        with self._lock:
+            jobs = [job for job in self._device_job_list(device)
+                    if job['attempts'] < max_attempts and not job['coalesced']]
+            if not jobs:
+                return None
+            job = min(jobs, key=lambda job: (
+                scheduler.sort_key(job,
+                                   self._runtimes.get((device, job['tree'])),
+                                   lifo, now),
+                job['id']))
+            job = dict(job, attempts=job['attempts'] + 1, last_attempt=now)
+            self._commit([['job', job]])
+            tests = [tuple(self._tests[guid][1:]) + (guid,)
+                     for guid in self._job_tests[job['id']]]
+            return self._job_dict(job), tests
+
+    def coalesce(self, build_url, devices, backlog, sample, max_attempts):
+        logger = utils.getLogger()
+        coalesced_jobs = []
+        app_name = utils.get_app_name_from_build_url(build_url)
+        columns = ('tree', 'build_type', 'build_abi', 'build_platform',
+                   'build_sdk')
+        with self._lock:
+            effects = []
+            for device in devices:
+                jobs = [job for job in self._device_job_list(device)
+                        if job['attempts'] < max_attempts and
+                        not job['coalesced']]
+                if len(jobs) <= backlog:
+                    continue
+                jobs = [job for job in jobs
+                        if job['attempts'] == 0 and not job['is_try']]
+                new_jobs = [job for job in jobs
+                            if job['build_url'] == build_url]
+                if not new_jobs:
+                    continue
+                job = new_jobs[0]
+                previous_jobs = [
+                    previous for previous in jobs
+                    if previous['id'] != job['id'] and
+                    previous['created'] <= job['created'] and
+                    [previous[c] for c in columns] == [job[c] for c in columns] and
+                    utils.get_app_name_from_build_url(
+                        previous['build_url']) == app_name]
+                if not previous_jobs:
+                    continue
+                previous = max(previous_jobs,
+                               key=lambda job: (job['created'], job['id']))
+                job_tests = self._test_keys(job['id'])
+                if not job_tests or job_tests != self._test_keys(previous['id']):
+                    continue
+                coalesce_count = previous['coalesce_count'] + 1
+                if sample and coalesce_count >= sample:
+                    continue
+                effects.append(['job', dict(previous, coalesced=1)])
+                effects.append(['job', dict(job, coalesce_count=coalesce_count)])
+                coalesced_job = self._build_dict(previous)
+                logger.debug('jobs.coalesce: %s superseded by %s device %s',
+                             coalesced_job['build_url'], build_url, device)
+                coalesced_jobs.append(coalesced_job)
+            self._commit(effects)
+        return coalesced_jobs
+
+    def backfill(self, device, tree):
+        logger = utils.getLogger()
+        with self._lock:
+            jobs = [job for job in self._jobs.values()
+                    if job['coalesced'] and
+                    (not device or job['device'] == device) and
+                    (not tree or job['tree'] == tree)]
+            jobs.sort(key=lambda job: (job['created'], job['id']))
+            backfill_jobs = [self._build_dict(job) for job in jobs
+                             if self._job_tests[job['id']]]
+            self._commit([['delete_job', job['id']] for job in jobs])
+        logger.debug('jobs.backfill: device %s tree %s: %d jobs',
+                     device, tree, len(backfill_jobs))
+        return backfill_jobs
+
+    def cancel_test(self, test_guid, device):
+        logger = utils.getLogger()
+        with self._lock:
+            row = self._tests.get(test_guid)
+            if not row:
+                logger.debug('jobs.cancel_test: test %s for device %s '
+                             'already deleted', test_guid, device)
+                return
+            job_id = row[0]
+            effects = [['delete_test', test_guid]]
+            if self._job_tests[job_id] == [test_guid]:
+                logger.debug('jobs.cancel_test: delete job_id %s device %s',
+                             job_id, device)
+                effects.append(['delete_job', job_id])
+            self._commit(effects)
+
+    def test_completed(self, test_guid, device):
+        with self._lock:
+            if test_guid in self._tests:
+                self._commit([['delete_test', test_guid]])
+
+    def job_completed(self, job_id, device, now, runtime_weight):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job:
+                return
+            effects = []
+            if job['last_attempt']:
+                runtime = utils.seconds_between(job['last_attempt'], now)
+                average = self._runtimes.get((job['device'], job['tree']))
+                if average is not None:
+                    runtime = (runtime_weight * runtime +
+                               (1 - runtime_weight) * average)
+                effects.append(['runtime', job['device'], job['tree'], runtime])
+            effects.append(['delete_job', job_id])
+            self._commit(effects)
+
+    def new_treeherder_job(self, machine, project, job_collection, now):
+        with self._lock:
+            self._commit([['treeherder', {'id': self._next_treeherder_id,
+                                          'attempts': 0,
+                                          'last_attempt': now,
+                                          'machine': machine,
+                                          'project': project,
+                                          'job_collection': job_collection}]])
+
+    def get_treeherder_jobs(self, limit, now):
+        logger = utils.getLogger()
+        with self._lock:
+            requests = [dict(self._treeherder[request_id],
+                             attempts=self._treeherder[request_id]['attempts'] + 1,
+                             last_attempt=now)
+                        for request_id in sorted(self._treeherder)[:limit]]
+            self._commit([['treeherder', request] for request in requests])
+        jobs = []
+        for request in requests:
+            job = dict(request)
+            job['job_collection'] = json.loads(request['job_collection'])
+            jobs.append(job)
+        if jobs:
+            logger.debug('jobs.get_treeherder_jobs: %s',
+                         [j['id'] for j in jobs])
+        return jobs
+
+    def treeherder_jobs_completed(self, th_ids):
+        with self._lock:
+            self._commit([['delete_treeherder', th_id] for th_id in th_ids
+                          if th_id in self._treeherder])
+
+
+class MemoryJobsStorageManager(BaseManager):
+    """MemoryJobsStorageManager keeps MemoryJobsStorages in its
+    process and serves them to the processes which share them."""
+
+
+# The MemoryJobsStorages of the manager's process indexed by path.
+_storages = {}
+
+
+def _get_storage(path):
+    if path not in _storages:
+        _storages[path] = MemoryJobsStorage(path)
+    return _storages[path]
+
+
+MemoryJobsStorageManager.register('storage', callable=_get_storage)
+
+
+def _ignore_sigint():
+    # The manager is shut down by the process which started it after
+    # its workers have stopped.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# The (proxy, manager) pairs of the storages started by this process.
+_started = []
+
+
+def start_storage(path='jobs'):
+    """Start a MemoryJobsStorageManager process and return a proxy of
+    its MemoryJobsStorage for path. The proxy may be used by the
+    processes which are forked after it is created. The manager stops
+    when stop_storage() is called or when the process which started
+    it exits normally."""
+    manager = MemoryJobsStorageManager()
+    manager.start(_ignore_sigint)
+    storage = manager.storage(path)
+    _started.append((storage, manager))
+    return storage
+
+
+def stop_storage(storage):
+    """Shut down the MemoryJobsStorageManager process of a storage
+    returned by start_storage(). Other storages are ignored."""
+    for started in _started:
+        if started[0] is storage:
+            _started.remove(started)
+            started[1].shutdown()
+            return
@@ -3,6 +3,7 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from builds import BuildCache
+from jobs import Jobs
 from worker import Crashes, PhoneWorker
 
 class AutophoneOptions(object):
@@ -59,6 +60,19 @@ class AutophoneOptions(object):
         self.build_cache_expires = BuildCache.EXPIRE_AFTER_DAYS
         self.device_ready_retry_wait = PhoneWorker.DEVICE_READY_RETRY_WAIT
         self.device_ready_retry_attempts = PhoneWorker.DEVICE_READY_RETRY_ATTEMPTS
+        self.adb_server_socket = False
+        self.adb_spool_size = 0
+        self.device_property_cache_dir = ''
+        self.device_process_list_ttl = 0
+        self.device_logcat_follow_lines = 0
+        self.device_logcat_compress = False
+        self.logcat_artifact = False
+        self.job_scheduler = ''
+        self.job_repo_weights = []
+        self.job_coalesce_backlog = 0
+        self.job_coalesce_sample = 0
+        self.job_coalesce_expires = Jobs.COALESCE_EXPIRE_AFTER_DAYS
+        self.job_storage = ''
         self.device_battery_min = PhoneWorker.DEVICE_BATTERY_MIN
         self.device_battery_max = PhoneWorker.DEVICE_BATTERY_MAX
         self.phone_retry_limit = PhoneWorker.DEVICE_READY_RETRY_ATTEMPTS
@@ -105,6 +119,19 @@ class AutophoneOptions(object):
                      'build_cache_expires',
                      'device_ready_retry_wait',
                      'device_ready_retry_attempts',
+                     'adb_server_socket',
+                     'adb_spool_size',
+                     'device_property_cache_dir',
+                     'device_process_list_ttl',
+                     'device_logcat_follow_lines',
+                     'device_logcat_compress',
+                     'logcat_artifact',
+                     'job_scheduler',
+                     'job_repo_weights',
+                     'job_coalesce_backlog',
+                     'job_coalesce_sample',
+                     'job_coalesce_expires',
+                     'job_storage',
                      'device_battery_min',
                      'device_battery_max',
                      'phone_retry_limit',
@@ -5,6 +5,7 @@
 import ConfigParser
 import datetime
 import glob
+import gzip
 import logging
 import os
 import posixpath
@@ -21,6 +22,8 @@ from mozprofile import Profile
 import utils
 from autophonecrash import AutophoneCrashProcessor
 from adb import ADBError, ADBTimeoutError
+from logcatscanner import (LogcatScanner, PAGE_LOAD_START,
+                           PAGE_LOAD_STOP_PATTERN, THROBBER_STOP)
 from logdecorator import LogDecorator
 from phonestatus import PhoneStatus, TreeherderStatus, TestStatus
 
@@ -217,6 +220,9 @@ class PhoneTest(object):
         # upload_dir will hold ANR traces, tombstones and other files
         # pulled from the device.
         self.upload_dir = None
+        # precompressed_artifacts holds the paths of the files in
+        # upload_dir which are already gzip compressed.
+        self.precompressed_artifacts = set()
         # crash_processor is an instance of AutophoneCrashProcessor that
         # is used by non-unittests to process device errors and crashes.
         self.crash_processor = None
@@ -313,6 +319,15 @@ class PhoneTest(object):
         except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
             self.platforms = self.options.platforms
 
+        # [logcat]
+        # filter_specs limits the messages read from the device's
+        # logcat to those the test uses.
+        self.logcat_filter_specs = ['*:V']
+        try:
+            self.logcat_filter_specs = self.cfg.get('logcat', 'filter_specs').split()
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            pass
+
         self.loggerdeco.info('PhoneTest: %s', self.__dict__)
 
     def __str__(self):
@@ -562,6 +577,12 @@ class PhoneTest(object):
     def name(self):
         return 'autophone-%s%s' % (self.__class__.__name__, self.name_suffix)
 
+    @property
+    def jobs_key(self):
+        """The key which identifies the test's rows in the jobs
+        database."""
+        return (self.name, self.config_file, self.chunk, tuple(self.repos))
+
     @property
     def base_device_path(self):
         if self._base_device_path:
@@ -760,6 +781,10 @@ class PhoneTest(object):
 
         Raises ADBError, ADBRootError, ADBTimeoutError
         """
+        with self.dm.shell_session():
+            return self._stop_application(max_wait_time)
+
+    def _stop_application(self, max_wait_time):
         # If the app is not already running, issuing an intent will
         # actually start the app and initialize the default
         # profile. This is problematic for a number of reasons
@@ -840,35 +865,19 @@ class PhoneTest(object):
             for line in buf:
                 self.loggerdeco.debug('create_profile: prior logcat: %s', line)
 
+        scanner = LogcatScanner(self.worker_subprocess.logcat,
+                                [PAGE_LOAD_START, PAGE_LOAD_STOP_PATTERN],
+                                logger=self.loggerdeco)
+        scanner.ignore_pages(['about:blank', 'https://mozilla.org/'])
         self.run_fennec_with_profile(self.build.app_name, self._initialize_url)
         # Check for page load before attempting to stop the application
-        found_page_load = False
-        ignore_page = False
-        re_geckoview_starting = re.compile('GeckoViewActivity.*Starting to load page at (.*)')
-        re_zerdatime = re.compile('Gecko.*: zerdatime [0-9]+ - page load stop')
-        for attempt in range(1, 11):
-            self.loggerdeco.debug('create_profile: waiting for page stop: attempt: %s',
-                                  attempt)
-            buf = self.worker_subprocess.logcat.get()
-            for line in buf:
-                self.loggerdeco.debug('create_profile: logcat: %s', line)
-                match = re_geckoview_starting.search(line)
-                if match:
-                    url = match.group(1)
-                    if url == 'about:blank' or url == 'https://mozilla.org/':
-                        self.loggerdeco.debug('create_profile: ignoring %s', line)
-                        ignore_page = True
-                elif re_zerdatime.search(line):
-                    if ignore_page:
-                        ignore_page = False
-                    else:
-                        self.loggerdeco.debug('create_profile: found page load stop')
-                        found_page_load = True
-                        break
-            if found_page_load:
-                break
-            sleep(1)
-        if not found_page_load:
+        self.loggerdeco.debug('create_profile: waiting for page stop')
+        events = self.worker_subprocess.wait_for_logcat(
+            scanner, [THROBBER_STOP], 10, test=self)[0]
+        found_page_load = events and events[-1].name == THROBBER_STOP
+        if found_page_load:
+            self.loggerdeco.debug('create_profile: found page load stop')
+        else:
             self.loggerdeco.warning('creating_profile: %s application page load stop '
                                     'not found.', self.build.app_name)
         self.stop_application()
@@ -894,11 +903,12 @@ class PhoneTest(object):
                                wait_time,
                                kill_wait_time,
                                max_wait_attempts))
-        for wait_attempt in range(1, max_wait_attempts+1):
-            self.loggerdeco.debug('wait_for_fennec: attempt %s waiting' % wait_attempt)
-            if not self.dm.process_exist(self.build.app_name):
-                return True
-            sleep(wait_time)
+        with self.dm.shell_session():
+            for wait_attempt in range(1, max_wait_attempts+1):
+                self.loggerdeco.debug('wait_for_fennec: attempt %s waiting' % wait_attempt)
+                if not self.dm.process_exist(self.build.app_name):
+                    return True
+                sleep(wait_time)
         max_killattempts = 3
         for kill_attempt in range(1, max_killattempts+1):
             try:
@@ -915,18 +925,28 @@ class PhoneTest(object):
         return False
 
     def install_local_pages(self):
+        # The pages rarely change between jobs, so only the files
+        # which differ from those already on the device are pushed.
+        # files = {'path relative to dest' : 'local path', ...}
+        files = {}
+        for push_source in self._pushes:
+            push_dest = posixpath.relpath(self._pushes[push_source],
+                                          self._paths['dest'])
+            if not os.path.isdir(push_source):
+                files[push_dest] = push_source
+                continue
+            for dirpath, dirnames, filenames in os.walk(push_source):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    relpath = os.path.relpath(path, push_source)
+                    files[posixpath.join(push_dest,
+                                         *relpath.split(os.sep))] = path
         success = False
         for attempt in range(1, self.options.phone_retry_limit+1):
             self.loggerdeco.debug('Attempt %d Installing local pages', attempt)
             try:
-                self.dm.rm(self._paths['dest'], recursive=True, force=True, root=True)
                 self.dm.mkdir(self._paths['dest'], parents=True, root=True)
-                for push_source in self._pushes:
-                    push_dest = self._pushes[push_source]
-                    if os.path.isdir(push_source):
-                        self.dm.push(push_source, push_dest)
-                    else:
-                        self.dm.push(push_source, push_dest)
+                self.dm.sync_files(files, self._paths['dest'], root=True)
                 self.dm.chmod(self._paths['dest'], recursive=True, root=True)
                 success = True
                 break
@@ -965,7 +985,8 @@ class PhoneTest(object):
         # Clear the Treeherder job details.
         self.job_details = []
         try:
-            self.worker_subprocess.logcat.reset()
+            self.worker_subprocess.logcat.reset(
+                filter_specs=self.logcat_filter_specs)
         except:
             self.loggerdeco.exception('Exception resetting logcat before test')
         self.worker_subprocess.treeherder.submit_running(
@@ -1041,8 +1062,16 @@ class PhoneTest(object):
         # Unit tests may include the logcat output already but not all of them do.
         self.worker_subprocess.log_step('Logcat')
         try:
-            for logcat_line in self.worker_subprocess.logcat.get(full=True):
-                self.loggerdeco.info("logcat: %s", logcat_line)
+            # The artifact is only uploaded when the test's results
+            # are submitted to Treeherder.
+            if (self.options.logcat_artifact and self.upload_dir and
+                self.worker_subprocess.s3_bucket and
+                self.worker_subprocess.treeherder.url and
+                self.build.revision):
+                self.save_logcat_artifact()
+            else:
+                for logcat_line in self.worker_subprocess.logcat.get(full=True):
+                    self.loggerdeco.info("logcat: %s", logcat_line)
         except:
             self.loggerdeco.exception('Exception getting logcat')
         try:
@@ -1082,14 +1111,29 @@ class PhoneTest(object):
         self.start_timestamp = None
         self.end_timestamp = None
         self.upload_dir = None
+        self.precompressed_artifacts = set()
         self.start_time = None
         self.stop_time = None
         self.unittest_logpath = None
         # Reset the logcat buffers to help prevent the device's buffer
-        # from over flowing after the test.
-        self.worker_subprocess.logcat.reset()
+        # from over flowing after the test and restore the default
+        # filter specs so that logcat read between jobs is complete.
+        self.worker_subprocess.logcat.reset(filter_specs=['*:V'])
         self.reset_result()
 
+    def save_logcat_artifact(self):
+        """Save the full logcat to the compressed artifact
+        logcat.log.gz in the upload_dir. Only a summary is logged. The
+        artifact's url is logged when it is uploaded."""
+        name = 'logcat.log.gz'
+        path = os.path.join(self.upload_dir, name)
+        with gzip.GzipFile(path, 'wb') as logcat_file:
+            count = self.worker_subprocess.logcat.save(logcat_file)
+        self.precompressed_artifacts.add(path)
+        self.loggerdeco.info('logcat: %d lines (%d bytes compressed) '
+                             'saved to artifact %s',
+                             count, os.path.getsize(path), name)
+
     def update_status(self, phone_status=None, message=None):
         if self.update_status_cb:
             self.update_status_cb(build=self.build,
@@ -1105,16 +1149,17 @@ class PhoneTest(object):
         for attempt in range(1, self.options.phone_retry_limit+1):
             try:
                 self.loggerdeco.debug('Attempt %d installing profile', attempt)
-                if self.dm.exists(self.profile_path, root=root):
-                    # If the profile already exists, chmod it to make sure
-                    # we have permission to delete it.
-                    self.dm.chmod(self.profile_path, recursive=True, root=root)
-                    self.dm.rm(self.profile_path, recursive=True,
-                               force=True, root=root)
-                self.dm.chmod(profile_path_parent, root=root)
-                self.dm.mkdir(self.profile_path, root=root)
-                self.dm.chmod(self.profile_path, root=root)
-                self.dm.push(profile.profile, self.profile_path)
+                # Create a writable profile directory in one adb shell
+                # and replace its content with the profile, pushing
+                # only the files which differ from those on the device.
+                self.dm.shell_batch_output(
+                    ['chmod 777 %s' % profile_path_parent,
+                     '[ -d %s ] || mkdir %s' % (self.profile_path,
+                                                self.profile_path),
+                     'chmod 777 %s' % self.profile_path],
+                    root=root)
+                self.dm.sync_tree(profile.profile, self.profile_path,
+                                  root=root)
                 self.dm.chmod(self.profile_path, recursive=True, root=root)
                 success = True
                 break
@@ -66,7 +66,7 @@ class S3Bucket(object):
             logger.exception(str(e))
             raise S3Error('%s' % e)
 
-    def upload(self, path, destination):
+    def upload(self, path, destination, precompressed=False):
         try:
             logger = utils.getLogger()
             key = self.bucket.get_key(destination)
@@ -75,19 +75,29 @@ class S3Bucket(object):
                 key = self.bucket.new_key(destination)
 
             ext = os.path.splitext(path)[-1]
+            # precompressed files are already gzip compressed. They
+            # are uploaded as is and served with the content type of
+            # the uncompressed file.
+            if precompressed:
+                ext = os.path.splitext(os.path.splitext(path)[0])[-1]
             if ext == '.log' or ext == '.txt':
                 key.set_metadata('Content-Type', 'text/plain')
 
-            with tempfile.NamedTemporaryFile('w+b', suffix=ext) as tf:
-                logger.debug('Compressing: %s', path)
-                with gzip.GzipFile(path, 'wb', fileobj=tf) as gz:
-                    with open(path, 'rb') as f:
-                        gz.writelines(f)
-                tf.flush()
-                tf.seek(0)
+            if precompressed:
                 key.set_metadata('Content-Encoding', 'gzip')
-                logger.debug('Setting key contents from: %s', tf.name)
-                key.set_contents_from_file(tf)
+                logger.debug('Setting key contents from: %s', path)
+                key.set_contents_from_filename(path)
+            else:
+                with tempfile.NamedTemporaryFile('w+b', suffix=ext) as tf:
+                    logger.debug('Compressing: %s', path)
+                    with gzip.GzipFile(path, 'wb', fileobj=tf) as gz:
+                        with open(path, 'rb') as f:
+                            gz.writelines(f)
+                    tf.flush()
+                    tf.seek(0)
+                    key.set_metadata('Content-Encoding', 'gzip')
+                    logger.debug('Setting key contents from: %s', tf.name)
+                    key.set_contents_from_file(tf)
 
             url = key.generate_url(expires_in=0,
                                    query_auth=False)
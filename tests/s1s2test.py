@@ -4,13 +4,12 @@
 
 import ConfigParser
 import os
-import re
 import urlparse
 
-from time import sleep
-
 import utils
 
+from logcatscanner import (LogcatScanner, APP_START, THROBBER_START,
+                           THROBBER_STOP, PAGE_LOAD_START)
 from perftest import PerfTest, PerfherderArtifact, PerfherderSuite, PerfherderOptions
 from phonetest import TreeherderStatus, TestStatus
 
@@ -314,24 +313,15 @@ class S1S2Test(PerfTest):
     def analyze_logcat(self):
         self.loggerdeco.debug('analyzing logcat')
 
-        logcat_prefix = r'\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{3}'
-        application_start = r'..Gecko.*zerdatime (\d+) - .*application start'
-        throbber_prefix = r'..Gecko.*zerdatime (\d+) -'
-        re_start_time = re.compile(r'%s %s' % (logcat_prefix, application_start))
-        re_throbber_start_time = re.compile('%s %s (Throbber|page load) start' %
-                                            (logcat_prefix, throbber_prefix))
-        re_throbber_stop_time = re.compile('%s %s (Throbber|page load) stop' %
-                                           (logcat_prefix, throbber_prefix))
+        scanner = LogcatScanner(self.worker_subprocess.logcat,
+                                [APP_START, THROBBER_START, THROBBER_STOP,
+                                 PAGE_LOAD_START],
+                                logger=self.loggerdeco)
         # geckoview_example emits page start and stop messages for
-        # about:blank prior to loading real pages. When is_about_blank
-        # is True, we will ignore any page start and stop messages.
-        # geckoview_example also will load https://mozilla.org/ if it is
-        # launched without an url.
-        ignore_page = False
-        re_about_blank_start = re.compile('%s I/GeckoViewActivity.*Starting to load page at about:blank' %
-                                          logcat_prefix)
-        re_mozilla_org_start = re.compile('%s I/GeckoViewActivity.*Starting to load page at https://mozilla.org/' %
-                                          logcat_prefix)
+        # about:blank prior to loading real pages. geckoview_example
+        # also will load https://mozilla.org/ if it is launched
+        # without an url. Ignore the messages for these pages.
+        scanner.ignore_pages(['about:blank', 'https://mozilla.org/'])
 
         start_time = 0
         throbber_start_time = 0
@@ -339,62 +329,51 @@ class S1S2Test(PerfTest):
 
         attempt = 1
         max_time = 90 # maximum time to wait for throbbers
-        wait_time = 3 # time to wait between attempts
+        wait_time = 3 # maximum time to wait for each attempt
         max_attempts = max_time / wait_time
         success = False
 
         while not success and attempt <= max_attempts:
-            buf = self.worker_subprocess.logcat.get()
-            for line in buf:
-                self.loggerdeco.debug('analyze_logcat: %s', line)
-
-                if ignore_page:
-                    self.loggerdeco.debug('analyze_logcat: ignoring %s', line)
-                    match = re_throbber_stop_time.match(line)
-                    if match:
-                        ignore_page = False
-                    continue
-                match = re_about_blank_start.match(line)
-                if match:
-                    self.loggerdeco.debug('analyze_logcat: ignoring %s', line)
-                    ignore_page = True
-                    continue
-                match = re_mozilla_org_start.match(line)
-                if match:
-                    self.loggerdeco.debug('analyze_logcat: ignoring %s', line)
-                    ignore_page = True
-                    self.loggerdeco.warning(
-                        'analyze_logcat: unexpected load of https://mozilla.org. '
-                        'geckoview_example launched without url?')
-                    continue
+            events, command = self.worker_subprocess.wait_for_logcat(
+                scanner, [THROBBER_STOP], wait_time, test=self,
+                poll_interval=wait_time)
+            for event in events:
+                if event.name == PAGE_LOAD_START:
+                    if event.groups[0] == 'https://mozilla.org/':
+                        self.loggerdeco.warning(
+                            'analyze_logcat: unexpected load of https://mozilla.org. '
+                            'geckoview_example launched without url?')
+                    continue # event
 
                 if not start_time:
-                    match = re_start_time.match(line)
-                    if match:
-                        start_time = int(match.group(1))
+                    if event.name == APP_START:
+                        start_time = int(event.groups[0])
                         self.loggerdeco.info(
                             'analyze_logcat: new start_time: %s',
                             start_time)
-                    continue # line
+                    continue # event
 
                 # We want the first throbberstart and throbberstop
                 # after the start_time.
                 if not throbber_start_time:
-                    match = re_throbber_start_time.match(line)
-                    if match:
-                        throbber_start_time = int(match.group(1))
+                    if event.name == THROBBER_START:
+                        throbber_start_time = int(event.groups[0])
                         self.loggerdeco.info(
                             'analyze_logcat: throbber_start_time: %s',
                             throbber_start_time)
-                    continue # line
+                    continue # event
 
-                match = re_throbber_stop_time.match(line)
-                if match:
-                    throbber_stop_time = int(match.group(1))
+                if event.name == THROBBER_STOP:
+                    throbber_stop_time = int(event.groups[0])
                     self.loggerdeco.info(
                         'analyze_logcat: throbber_stop_time: %s',
                         throbber_stop_time)
-                    break # line
+                    break # event
+
+            if command:
+                self.loggerdeco.info('analyze_logcat: interrupted: %s',
+                                     command['reason'])
+                break # attempt
 
             if self.handle_crashes():
                 # If fennec crashed, don't bother looking for the Throbbers
@@ -412,7 +391,6 @@ class S1S2Test(PerfTest):
                     'analyze_logcat: attempt %s, start_time: %s, '
                     'throbber_start_time: %s, throbber_stop_time: %s' %
                     (attempt, start_time, throbber_start_time, throbber_stop_time))
-                sleep(wait_time)
                 attempt += 1
 
         if not success:
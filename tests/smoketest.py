@@ -3,9 +3,9 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import datetime
-import re
 from time import sleep
 
+from logcatscanner import LogcatScanner, THROBBER_STOP
 from phonetest import PhoneTest, TreeherderStatus, TestStatus
 
 
@@ -39,29 +39,33 @@ class SmokeTest(PhoneTest):
 
         # Run test
         self.loggerdeco.debug('running fennec')
+        scanner = LogcatScanner(self.worker_subprocess.logcat,
+                                [(THROBBER_STOP, '(Throbber|page load) stop')],
+                                logger=self.loggerdeco)
         self.run_fennec_with_profile(self.build.app_name, 'about:fennec')
 
         command = None
-        fennec_launched = self.dm.process_exist(self.build.app_name)
         found_throbber = False
         start = datetime.datetime.utcnow()
-        while (not fennec_launched and (datetime.datetime.utcnow() - start
-                                        <= datetime.timedelta(seconds=60))):
-            command = self.worker_subprocess.process_autophone_cmd(test=self)
-            if command['interrupt']:
-                break
-            sleep(3)
+        with self.dm.shell_session():
             fennec_launched = self.dm.process_exist(self.build.app_name)
+            while (not fennec_launched and (datetime.datetime.utcnow() - start
+                                            <= datetime.timedelta(seconds=60))):
+                command = self.worker_subprocess.process_autophone_cmd(test=self)
+                if command['interrupt']:
+                    break
+                sleep(3)
+                fennec_launched = self.dm.process_exist(self.build.app_name)
 
         if fennec_launched:
-            found_throbber = self.check_throbber()
+            found_throbber = self.check_throbber(scanner)
             while (not found_throbber and (datetime.datetime.utcnow() - start
                                            <= datetime.timedelta(seconds=60))):
                 command = self.worker_subprocess.process_autophone_cmd(test=self)
                 if command['interrupt']:
                     break
                 sleep(3)
-                found_throbber = self.check_throbber()
+                found_throbber = self.check_throbber(scanner)
 
         if command and command['interrupt']:
             self.handle_test_interrupt(command['reason'],
@@ -89,15 +93,6 @@ class SmokeTest(PhoneTest):
         self.remove_sessionstore_files()
         return is_test_completed
 
-    def check_throbber(self):
-        re_throbber = re.compile('(Throbber|page load) stop')
-        buf = self.worker_subprocess.logcat.get()
-
-        for line in buf:
-            line = line.strip()
-            self.loggerdeco.debug('check_throbber: %s' % line)
-            match = re_throbber.search(line)
-            if match:
-                return True
-        return False
+    def check_throbber(self, scanner):
+        return len(scanner.poll()) > 0
 
@@ -4,9 +4,8 @@
 
 import ConfigParser
 import os
-import re
-from time import sleep
 
+from logcatscanner import LogcatScanner, TP_REPORT_ROW, TP_REPORT_END
 from perftest import PerfTest, PerfherderArtifact, PerfherderSuite, PerfherderOptions
 from phonetest import TreeherderStatus, TestStatus
 from utils import median, geometric_mean, host
@@ -253,21 +252,23 @@ I/GeckoDump( 2284): __startTimestamp1433438438092__endTimestamp
         """
         self.loggerdeco.debug('analyzing logcat')
 
-        re_page_data = re.compile(r'.*\|[0-9];([a-zA-Z0-9\.\/\-]+);([0-9;]+).*')
-        re_end_report = re.compile(r'.*__end_tp_report.*')
+        scanner = LogcatScanner(self.worker_subprocess.logcat,
+                                [TP_REPORT_ROW, TP_REPORT_END],
+                                logger=self.loggerdeco)
 
         attempt = 1
         max_time = 180  # maximum time to wait for tp report
-        wait_time = 3  # time to wait between attempts
+        wait_time = 3  # maximum time to wait for each attempt
         max_attempts = max_time / wait_time
 
         results = {}
         pageload_metric = {'summary': 0}
         while attempt <= max_attempts and pageload_metric['summary'] == 0:
-            buf = self.worker_subprocess.logcat.get()
-            for line in buf:
-                self.loggerdeco.debug('analyze_logcat: %s', line)
-                if re_end_report.match(line):
+            events, command = self.worker_subprocess.wait_for_logcat(
+                scanner, [TP_REPORT_END], wait_time, test=self,
+                poll_interval=wait_time)
+            for event in events:
+                if event.name == TP_REPORT_END:
                     # calculate score
                     data = []
                     for page in results:
@@ -277,20 +278,21 @@ I/GeckoDump( 2284): __startTimestamp1433438438092__endTimestamp
                     pageload_metric['summary'] = geometric_mean(data)
                     break
 
-                match = re_page_data.match(line)
-                if match:
-                    page_name = match.group(1)
-                    numbers = match.group(2)
+                if event.name == TP_REPORT_ROW:
+                    page_name, numbers = event.groups
                     if page_name and numbers:
                         page_name = page_name.split('/')[0]
                         numbers = [float(x) for x in numbers.split(';')]
                         results[page_name] = numbers
 
+            if command:
+                self.loggerdeco.info('analyze_logcat: interrupted: %s',
+                                     command['reason'])
+                break
             if self.handle_crashes():
                 # If fennec crashed, don't bother looking for pageload metric
                 break
             if pageload_metric['summary'] == 0:
-                sleep(wait_time)
                 attempt += 1
         if pageload_metric['summary'] == 0:
             self.loggerdeco.warning('Unable to find pageload metric')
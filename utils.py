@@ -4,6 +4,7 @@
 
 # get_remote_content modelled on treeherder/etc/common.py
 
+import datetime
 import json
 import logging
 import math
@@ -515,6 +516,21 @@ def generate_guid():
     return str(uuid.uuid4())
 
 
+def seconds_between(start, end):
+    """Return the seconds from start to end which are isoformat
+    strings of naive datetimes."""
+    def parse(value):
+        # The fields are sliced rather than parsed with strptime which
+        # is much slower and is called for every queued job by the job
+        # schedulers. isoformat omits the microseconds when they are
+        # 0.
+        return datetime.datetime(int(value[0:4]), int(value[5:7]),
+                                 int(value[8:10]), int(value[11:13]),
+                                 int(value[14:16]), int(value[17:19]),
+                                 int(value[20:26] or 0))
+    return (parse(end) - parse(start)).total_seconds()
+
+
 # These computational functions are taken from Talos:filter.py
 def mean(series):
     """
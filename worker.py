@@ -14,7 +14,6 @@ import posixpath
 import pytz
 import re
 import sys
-import tempfile
 import time
 import traceback
 
@@ -22,10 +21,12 @@ from time import sleep
 
 import buildserver
 import jobs
+import jobscheduler
 import utils
 from adb import ADBError, ADBTimeoutError
 from autophonetreeherder import AutophoneTreeherder
 from builds import BuildMetadata
+from logcatbuffer import LogcatBuffer
 from logdecorator import LogDecorator
 from phonestatus import PhoneStatus
 from phonetest import PhoneTest, TreeherderStatus, TestStatus, FLASH_PACKAGE
@@ -98,7 +99,9 @@ class PhoneWorker(object):
                  options,
                  autophone_queue,
                  loglevel,
-                 mailer):
+                 mailer,
+                 treeherder_requests_queued=None,
+                 jobs_storage=None):
 
         self.state = ProcessStates.STARTING
         self.tests = tests
@@ -127,6 +130,18 @@ class PhoneWorker(object):
         # process via this queue.
         self.queue = multiprocessing.Queue()
         self.lock = multiprocessing.Lock()
+        # job_available is set when a job notification has been put
+        # into the queue and is cleared by the worker before it looks
+        # for its next job, so that at most one notification is
+        # pending at a time.
+        self.job_available = multiprocessing.Event()
+        # treeherder_requests_queued is set when the worker queues a
+        # Treeherder request to wake the main process' Treeherder
+        # thread.
+        self.treeherder_requests_queued = treeherder_requests_queued
+        # jobs_storage is the JobsStorage of the main process' Jobs
+        # which the worker's Jobs shares.
+        self.jobs_storage = jobs_storage
         self.subprocess = PhoneWorkerSubProcess(dm,
                                                 self,
                                                 tests,
@@ -166,7 +181,9 @@ class PhoneWorker(object):
 
     def new_job(self):
         self.loggerdeco.debug('PhoneWorker:new_job')
-        self.queue.put_nowait(('job', None))
+        if not self.job_available.is_set():
+            self.job_available.set()
+            self.queue.put_nowait(('job', None))
 
     def reboot(self):
         self.loggerdeco.debug('PhoneWorker:reboot')
@@ -236,52 +253,67 @@ class Logcat(object):
     def __init__(self, worker_subprocess):
         self.worker_subprocess = worker_subprocess
         self.logger = worker_subprocess.loggerdeco
-        self._accumulated_logcat = []
+        self._accumulated_logcat = LogcatBuffer()
+        # If device_logcat_follow_lines is set, logcat is read from a
+        # single long lived adb logcat process. Lines are identified
+        # by cursors which are indexes into _accumulated_logcat or
+        # the follower's sequence numbers. _cursor is the cursor of
+        # the first line not yet returned by get() and _reset_cursor
+        # is the cursor of the first line following the last reset().
+        self._follower = None
+        self._cursor = 0
+        self._reset_cursor = 0
+        # _filter_specs are the logcat filter specs used to select the
+        # messages read from the device. They are set by reset() to
+        # the test's logcat profile.
+        self._filter_specs = ['*:V']
+        self._start_follower()
         self.logger.debug('Logcat()')
 
-    def get(self, full=False):
-        """Return the contents of logcat as list of strings.
-
-        :param full: optional boolean which defaults to False. If full
-                     is False, then get() will only return logcat
-                     output since the last call to clear(). If
-                     full is True, then get() will return all
-                     logcat output since the test was initialized or
-                     teardown_job was last called.
+    def _start_follower(self):
+        follow_lines = self.worker_subprocess.options.device_logcat_follow_lines
+        if follow_lines:
+            self._follower = self.worker_subprocess.dm.get_logcat_follower(
+                filter_specs=self._filter_specs, max_lines=follow_lines)
+            self._follower.start()
+
+    def close(self):
+        """Stops following logcat."""
+        if self._follower:
+            self._follower.stop()
+            self._follower = None
+
+    def cursor(self):
+        """Return the cursor of the first line which has not been
+        returned by get()."""
+        return self._cursor
+
+    def read(self, cursor, compress=False):
+        """Return a tuple of the list of logcat lines starting at
+        cursor and the cursor following the last line. read() does
+        not change what get() returns.
+
+        :param compress: optional boolean which defaults to False. If
+                         compress is True, the dump of the device's
+                         logcat buffer is compressed on the device
+                         before it is transferred. It is ignored when
+                         following logcat.
         """
+        if self._follower:
+            return self._read_follower(cursor)
 
-        # Get the datetime from the last logcat message
-        # previously collected. Note that with the time
-        # format, logcat lines begin with a date time of the
-        # form: 09-17 16:45:04.370 which is the first 18
-        # characters of the line.
-        if self._accumulated_logcat:
-            logcat_datestr = self._accumulated_logcat[-1][:18]
-        else:
-            logcat_datestr = '00-00 00:00:00.000'
-
-        self.logger.debug('Logcat.get() since %s', logcat_datestr)
-
-        # adb logcat can return lines with bogus dates where the MM-DD
-        # is not correct. This in particular has happened on a Samsung
-        # Galaxy S3 where Vold emits lines with the fixed date
-        # 11-30. It is not known if this is a general problem with
-        # other devices.
-
-        # This incorrect date causes problems when attempting to use
-        # the logcat dates to eliminate duplicates. It also conflicts
-        # with the strategy used in analyze_logcat to determine a
-        # potential year change during a test run. To distinguish
-        # between false year changes, we can decide that if the
-        # previous date and the current date are different by more
-        # than an hour, a decision must be made on which date is
-        # legitimate.
+        self.logger.debug('Logcat.read() since line %d', cursor)
+        self._accumulate(compress)
+        return (self._accumulated_logcat.lines(cursor),
+                len(self._accumulated_logcat))
 
+    def _accumulate(self, compress):
+        """Dumps the device's logcat buffer and accumulates the new
+        lines."""
         for attempt in range(1, self.worker_subprocess.options.phone_retry_limit+1):
             try:
-                raw_logcat = [
-                    unicode(x, 'UTF-8', errors='replace').strip()
-                    for x in self.worker_subprocess.dm.get_logcat(filter_specs=['*:V'])]
+                raw_logcat = self.worker_subprocess.dm.get_logcat(
+                    filter_specs=self._filter_specs, compress=compress)
                 break
             except ADBError:
                 self.logger.exception('Attempt %d get logcat', attempt)
@@ -289,104 +321,105 @@ class Logcat(object):
                     raise
                 sleep(self.worker_subprocess.options.phone_retry_wait)
 
-        current_logcat = []
-        prev_line_date = None
-        curr_line_date = None
-        curr_year = datetime.datetime.utcnow().year
-        hour = datetime.timedelta(hours=1)
+        self._accumulated_logcat.accumulate(raw_logcat)
 
-        for line in raw_logcat:
-            try:
-                curr_line_date = datetime.datetime.strptime('%4d-%s' % (
-                    curr_year, line[:18]), '%Y-%m-%d %H:%M:%S.%f')
-            except ValueError:
-                curr_line_date = None
-            if curr_line_date and prev_line_date:
-                delta = curr_line_date - prev_line_date
-                prev_line_datestr = prev_line_date.strftime('%m-%d %H:%M:%S.%f')
-                if delta <= -hour:
-                    # The previous line's date is one or more hours in
-                    # the future compared to the current line. Keep
-                    # the current lines which are before the previous
-                    # line's date.
-                    new_current_logcat = []
-                    for x in current_logcat:
-                        if x < prev_line_datestr:
-                            if self.worker_subprocess.options.verbose:
-                                self.logger.debug('Logcat.get(): Discarding future line: %s', x)
-                        else:
-                            if self.worker_subprocess.options.verbose:
-                                self.logger.debug('Logcat.get(): keeping line: %s', x)
-                            new_current_logcat.append(x)
-                    current_logcat = new_current_logcat
-                elif delta >= hour:
-                    # The previous line's date is one or more hours in
-                    # the past compared to the current line. Keep the
-                    # current lines which are after the previous
-                    # line's date.
-                    new_current_logcat = []
-                    for x in current_logcat:
-                        if x > prev_line_datestr:
-                            if self.worker_subprocess.options.verbose:
-                                self.logger.debug('Logcat.get(): Discarding past line: %s', x)
-                        else:
-                            if self.worker_subprocess.options.verbose:
-                                self.logger.debug('Logcat.get(): keeping line: %s', x)
-                            new_current_logcat.append(x)
-                    current_logcat = new_current_logcat
-            # Keep the messages which are on or after the last accumulated
-            # logcat date.
-            if line >= logcat_datestr:
-                current_logcat.append(line)
-            prev_line_date = curr_line_date
-
-        # In order to eliminate the possible duplicate
-        # messages, partition the messages by before, on and
-        # after the logcat_datestr.
-        accumulated_logcat_before = []
-        accumulated_logcat_now = []
-        for x in self._accumulated_logcat:
-            if x < logcat_datestr:
-                accumulated_logcat_before.append(x)
-            elif x[:18] == logcat_datestr:
-                accumulated_logcat_now.append(x)
-
-        current_logcat_now = []
-        current_logcat_after = []
-        for x in current_logcat:
-            if x[:18] == logcat_datestr:
-                current_logcat_now.append(x)
-            elif x > logcat_datestr:
-                current_logcat_after.append(x)
-
-        # Remove any previously received messages from
-        # current_logcat_now for the logcat_datestr.
-        current_logcat_now = set(current_logcat_now).difference(
-            set(accumulated_logcat_now))
-        current_logcat_now = list(current_logcat_now)
-        current_logcat_now.sort()
-
-        current_logcat = current_logcat_now + current_logcat_after
-        self._accumulated_logcat += current_logcat
-
-        if full:
-            return self._accumulated_logcat
-        return current_logcat
-
-    def reset(self):
-        """Clears the Logcat buffers and the device's logcat buffer."""
-        self.logger.debug('Logcat.reset()')
-        self.__init__(self.worker_subprocess)
+    @property
+    def following(self):
+        """True if logcat is followed rather than dumped."""
+        return self._follower is not None
+
+    def wait(self, cursor, timeout):
+        """Wait up to timeout seconds for a line following cursor to
+        be logged. When not following logcat, the device's buffer is
+        only read by read() so wait() simply sleeps.
+        """
+        if self._follower:
+            self._follower.wait_for_lines(cursor, timeout)
+        else:
+            sleep(timeout)
+
+    def get(self, full=False):
+        """Return the contents of logcat as list of strings.
+
+        :param full: optional boolean which defaults to False. If full
+                     is False, then get() will only return logcat
+                     output since the last call to clear(). If
+                     full is True, then get() will return all
+                     logcat output since the test was initialized or
+                     teardown_job was last called. The final dump of
+                     the device's logcat buffer is compressed on the
+                     device if the device_logcat_compress option is
+                     set.
+        """
+        compress = full and self.worker_subprocess.options.device_logcat_compress
+        lines, self._cursor = self.read(self._cursor, compress=compress)
+        if not full:
+            return lines
+        if self._follower:
+            return self._read_follower(self._reset_cursor)[0]
+        return self._accumulated_logcat.lines()
+
+    def save(self, fileobj):
+        """Writes all logcat output since the test was initialized or
+        teardown_job was last called to fileobj as UTF-8 encoded lines.
+        Unlike get(full=True), the lines are copied without being
+        decoded or split into a list. Returns the number of lines
+        written.
+        """
+        if self._follower:
+            lines, self._cursor = self._follower.get_lines(self._reset_cursor)
+            for line in lines:
+                fileobj.write(line)
+                fileobj.write('\n')
+            return len(lines)
+        self._accumulate(self.worker_subprocess.options.device_logcat_compress)
+        self._cursor = len(self._accumulated_logcat)
+        return self._accumulated_logcat.write(fileobj)
+
+    def _read_follower(self, cursor):
+        lines, cursor = self._follower.get_lines(cursor)
+        return ([unicode(x, 'UTF-8', errors='replace').strip()
+                 for x in lines], cursor)
+
+    def reset(self, filter_specs=None):
+        """Clears the Logcat buffers and the device's logcat buffer.
+
+        :param filter_specs: optional list of logcat filter specs. If
+                             given, only the messages selected by
+                             filter_specs are read from the device
+                             from now on. Otherwise the current filter
+                             specs are kept.
+        """
+        self.logger.debug('Logcat.reset(%s)', filter_specs)
+        restart = filter_specs is not None and filter_specs != self._filter_specs
+        if filter_specs is not None:
+            self._filter_specs = list(filter_specs)
+        if self._follower and restart:
+            self.close()
         self.worker_subprocess.dm.clear_logcat()
+        if restart:
+            self._start_follower()
+        if self._follower:
+            self._cursor = self._reset_cursor = self._follower.sequence
+            return
+        self._accumulated_logcat = LogcatBuffer()
+        self._cursor = self._reset_cursor = 0
 
     def clear(self):
         """Accumulates current logcat buffers, then clears the device's logcat
         buffers. clear() is used to prevent the device's logcat buffer
         from overflowing while not losing any output.
+
+        When following logcat, the device's logcat buffer is read as
+        it is written and is not cleared.
         """
         self.logger.debug('Logcat.clear()')
+        if self._follower:
+            self._cursor = self._follower.sequence
+            return
         self.get()
         self.worker_subprocess.dm.clear_logcat()
+        self._accumulated_logcat.cleared()
 
 
 class PhoneWorkerSubProcess(object):
@@ -405,6 +438,9 @@ class PhoneWorkerSubProcess(object):
         self.state = ProcessStates.RUNNING
         self.parent_worker = parent_worker
         self.tests = tests
+        # tests_by_key is used by Jobs.get_next_job to find the tests
+        # of a job.
+        self.tests_by_key = dict([(t.jobs_key, t) for t in tests])
         self.dm = dm
         self.phone = phone
         self.options = options
@@ -436,6 +472,9 @@ class PhoneWorkerSubProcess(object):
         self.s3_bucket = None
         self.treeherder = None
         self.logcat = None
+        # An interrupting command received by wait_for_logcat which is
+        # returned by the next call to process_autophone_cmd.
+        self._pending_command = None
         # Treeherder log step processing.
         self.log_step_formatstring = "%s %s %s (results: 0, elapsed: %d secs) (at %s) %s"
         self.log_step_stack = []
@@ -564,6 +603,19 @@ class PhoneWorkerSubProcess(object):
         # Later when we want to clear the existing log, we'll
         # just truncate it.
 
+    def _check_path_commands(self, path):
+        """Returns the list of shell_batch commands used to check if
+        path is writable by creating a file in a subdirectory of
+        the path.
+        """
+        d = posixpath.join(path, 'autophone_check_path')
+        return [('rm -r %s || true' % d, True),
+                ('mkdir -p %s' % d, True),
+                ('chmod 777 %s' % d, True),
+                ('echo autophone test > %s' % posixpath.join(d, 'path_check'),
+                 False),
+                ('rm -r %s' % d, True)]
+
     def _check_path(self, path):
         """_check_path(path) checks if path is writable
         by creating a file in a subdirectory of the path.
@@ -571,16 +623,7 @@ class PhoneWorkerSubProcess(object):
         exception, the path is accessible.
         """
         self.loggerdeco.debug('Checking path %s.', path)
-        d = posixpath.join(path, 'autophone_check_path')
-        self.dm.rm(d, recursive=True, force=True, root=True)
-        self.dm.mkdir(d, parents=True, root=True)
-        self.dm.chmod(d, recursive=True, root=True)
-        with tempfile.NamedTemporaryFile() as tmp:
-            tmp.write('autophone test\n')
-            tmp.flush()
-            self.dm.push(tmp.name,
-                         posixpath.join(d, 'path_check'))
-        self.dm.rm(d, recursive=True, root=True)
+        self.dm.shell_batch_output(self._check_path_commands(path))
 
     def start_usbwatchdog(self):
         try:
@@ -652,6 +695,8 @@ class PhoneWorkerSubProcess(object):
                     phone_status = PhoneStatus.DISCONNECTED
                     break
 
+                # SELinux must be made permissive before the paths
+                # can be checked.
                 if self.dm.selinux:
                     if self.dm.shell_output('getenforce') != 'Permissive':
                         self.dm.shell_output("setenforce Permissive", root=True)
@@ -659,8 +704,16 @@ class PhoneWorkerSubProcess(object):
                             phone_status = PhoneStatus.ERROR
                             msg = 'Attempt: %d, SELinux is not permissive' % attempt
 
-                self._check_path('/data/local/tmp')
-                self._check_path(self.dm.test_root)
+                # Check the paths and get the process list in a single
+                # round trip to the device.
+                self.loggerdeco.debug('Checking paths /data/local/tmp, %s.',
+                                      self.dm.test_root)
+                cmds = []
+                cmds.extend(self._check_path_commands('/data/local/tmp'))
+                cmds.extend(self._check_path_commands(self.dm.test_root))
+                cmds.append('ps')
+                outputs = self.dm.shell_batch_output(cmds, timeout=60)
+                proc_list = self.dm.parse_process_list(outputs[-1])
 
                 if require_ip_address:
                     ip_address = self.dm.get_ip_address()
@@ -701,7 +754,8 @@ class PhoneWorkerSubProcess(object):
                 if phone_status == PhoneStatus.OK:
                     self.dm.shell_output("setprop usbwatchdog.heartbeat %s" % time.time(),
                                          root=True)
-                    if not self.dm.process_exist(self.options.usbwatchdog_appname):
+                    if not self.dm.process_exist(self.options.usbwatchdog_appname,
+                                                 proc_list=proc_list):
                         self.start_usbwatchdog()
                     break
             except (ADBError, ADBTimeoutError), e:
@@ -1055,6 +1109,9 @@ class PhoneWorkerSubProcess(object):
            (not self.last_ping or \
             datetime.timedelta(seconds=self.options.phone_ping_interval)):
             self.ping()
+        # Remove the jobs which have exceeded their attempts while the
+        # device is idle.
+        self.jobs.delete_expired_jobs()
 
     def handle_job(self, job):
         if self.options.treeherder_url:
@@ -1220,6 +1277,10 @@ class PhoneWorkerSubProcess(object):
         then check on the phone's status to see if the device is healthy
         enough to continue testing.
         """
+        if self._pending_command:
+            command = self._pending_command
+            self._pending_command = None
+            return command
         while True:
             try:
                 self.heartbeat()
@@ -1238,6 +1299,66 @@ class PhoneWorkerSubProcess(object):
                             'reason': reason,
                             'test_result': TreeherderStatus.RETRY}
 
+    def wait_for_logcat(self, scanner, names, timeout, test=None,
+                        poll_interval=1):
+        """Wait until the scanner finds a logcat event whose name is
+        in names, timeout seconds pass or an Autophone command
+        interrupts the wait.
+
+        When following logcat, the wait ends as soon as the matching
+        line is logged. Otherwise the device's logcat buffer is read
+        every poll_interval seconds. The lines logged after the last
+        read are left for the next wait rather than read again at the
+        end of the wait.
+
+        :param scanner: LogcatScanner created with the worker's Logcat.
+        :param list names: the names of the events to wait for.
+        :param timeout: the maximum time in seconds to wait.
+        :param test: currently running test used to determine if a
+            cancel_test request pertains to it.
+        :param poll_interval: the seconds between reads of the device's
+            logcat buffer when logcat is not followed.
+        :returns: tuple (events, command). events is the list of the
+            events found, ending with the matching event if one was
+            found. Any events following it are left with the scanner.
+            command is the interrupting command or None. The
+            interrupting command is also returned by the next call to
+            process_autophone_cmd.
+        """
+        deadline = time.time() + timeout
+        events = []
+        following = self.logcat.following
+        if following:
+            poll_interval = 1
+        # A followed logcat can wake the scanner for every new line,
+        # so only send heartbeats and check the command queue about
+        # once a second.
+        last_heartbeat = 0
+        while True:
+            polled = scanner.poll()
+            for index, event in enumerate(polled):
+                events.append(event)
+                if event.name in names:
+                    scanner.unread(polled[index + 1:])
+                    return events, None
+            if time.time() - last_heartbeat >= 1:
+                last_heartbeat = time.time()
+                try:
+                    self.heartbeat()
+                    request = self.queue.get_nowait()
+                    command = self.handle_cmd(request, current_test=test)
+                    if command['interrupt']:
+                        self._pending_command = command
+                        return events, command
+                except Queue.Empty:
+                    pass
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return events, None
+            scanner.wait(min(remaining, poll_interval))
+            if not following and time.time() >= deadline:
+                return events, None
+
     def main_loop(self):
         self.loggerdeco.debug('main_loop')
         # Commands take higher priority than jobs, so we deal with all
@@ -1270,6 +1391,11 @@ class PhoneWorkerSubProcess(object):
                     # before attempting to get the next message.
                     time.sleep(60)
                 else:
+                    # Clear job_available before looking for a job so
+                    # that jobs queued after the query send a new
+                    # notification which wakes us from waiting on the
+                    # command queue.
+                    self.parent_worker.job_available.clear()
                     job = self.jobs.get_next_job(lifo=self.options.lifo, worker=self)
                     if job:
                         if not self.is_disabled():
@@ -1373,7 +1499,12 @@ class PhoneWorkerSubProcess(object):
 
         self.jobs = jobs.Jobs(self.mailer,
                               default_device=self.phone.id,
-                              allow_duplicates=self.options.allow_duplicate_jobs)
+                              allow_duplicates=self.options.allow_duplicate_jobs,
+                              scheduler=jobscheduler.get_scheduler(
+                                  self.options.job_scheduler,
+                                  self.options.job_repo_weights),
+                              coalesce_expires=self.options.job_coalesce_expires,
+                              storage=self.parent_worker.jobs_storage)
 
         self.loggerdeco.info('Worker: Connected.')
 
@@ -1383,13 +1514,18 @@ class PhoneWorkerSubProcess(object):
             self.s3_bucket = S3Bucket(self.options.s3_upload_bucket,
                                       self.options.aws_access_key_id,
                                       self.options.aws_access_key)
-        self.treeherder = AutophoneTreeherder(self,
-                                              self.options,
-                                              self.jobs,
-                                              s3_bucket=self.s3_bucket,
-                                              mailer=self.mailer)
+        self.treeherder = AutophoneTreeherder(
+            self,
+            self.options,
+            self.jobs,
+            s3_bucket=self.s3_bucket,
+            mailer=self.mailer,
+            requests_queued=self.parent_worker.treeherder_requests_queued)
         self.update_status(phone_status=PhoneStatus.IDLE)
         self.dm.power_on()
         self.start_usbwatchdog()
         self.ping()
-        self.main_loop()
+        try:
+            self.main_loop()
+        finally:
+            self.logcat.close()